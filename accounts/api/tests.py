@@ -1,6 +1,10 @@
 from utils.testcases import TestCase
 from rest_framework.test import APIClient
 from django.core.files.uploadedfile import SimpleUploadedFile
+from accounts.services import UserService
+from django.test import override_settings
+from twitter.cache import NEWSFEEDS_PATTERNN, USER_LAST_SEEN_KEY
+from utils.cache.redis_client import RedisClient
 
 
 LOGIN_URL ='/api/accounts/login/'
@@ -49,6 +53,16 @@ class AccountApiTests(TestCase):
         response = self.client.get(path=LOGIN_STATUS_URL)
         self.assertEqual(response.data['has_logged_in'], True)
 
+        # newsfeeds are prefetched after login
+        self.create_newsfeed(self.user, self.create_tweet(self.user))
+        RedisClient.clear()
+        self.client.post(path=LOGIN_URL, data={
+            'username': self.user.username,
+            'password': 'correct password',
+        })
+        key = NEWSFEEDS_PATTERNN.format(user_id=self.user.id)
+        self.assertEqual(RedisClient.get_connection(key).exists(key), True)
+
     def test_logout(self):
 
         # login first
@@ -117,6 +131,42 @@ class AccountApiTests(TestCase):
         response = self.client.get(LOGIN_STATUS_URL)
         self.assertEqual(response.data['has_logged_in'], True)
 
+    def test_last_seen(self):
+        self.assertEqual(UserService.get_active_user_ids([self.user.id], 60), set())
+
+        # anonymous requests are not recorded
+        self.client.get(LOGIN_STATUS_URL)
+        self.assertEqual(UserService.get_active_user_ids([self.user.id], 60), set())
+
+        # user authenticated by DRF is recorded
+        user, client = self.create_user_and_client('someone')
+        client.get(LOGIN_STATUS_URL)
+        self.assertEqual(
+            UserService.get_active_user_ids([self.user.id, user.id], 60),
+            {user.id},
+        )
+        self.assertEqual(
+            UserService.get_active_user_ids([self.user.id, user.id], None),
+            {self.user.id, user.id},
+        )
+
+    @override_settings(USER_LAST_SEEN_INTERVAL=60)
+    def test_last_seen_interval(self):
+        UserService.last_seen_touched.clear()
+        conn = RedisClient.get_connection()
+        user, client = self.create_user_and_client('someone')
+        client.get(LOGIN_STATUS_URL)
+        last_seen = conn.zscore(USER_LAST_SEEN_KEY, user.id)
+        self.assertEqual(last_seen is not None, True)
+
+        # written once in the interval
+        client.get(LOGIN_STATUS_URL)
+        self.assertEqual(conn.zscore(USER_LAST_SEEN_KEY, user.id), last_seen)
+        UserService.last_seen_touched.set(user.id, last_seen - 60)
+        client.get(LOGIN_STATUS_URL)
+        self.assertEqual(conn.zscore(USER_LAST_SEEN_KEY, user.id) > last_seen, True)
+        UserService.last_seen_touched.clear()
+
 
 class UserProfileApiTests(TestCase):
 
@@ -9,6 +9,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from accounts.models import UserProfile
+from newsfeeds.services import NewsFeedService
 from accounts.api.serializers import (
     UserSerializer,
     LoginSerializer,
@@ -70,6 +71,7 @@ class AccountViewSet(viewsets.ViewSet):
 
         # user is good, make login
         django_login(request, user)
+        NewsFeedService.on_login(user.id)
         return Response({'success': True,
                          'user': UserSerializer(instance=user).data,
                          })
@@ -4,4 +4,17 @@ Function for clear cache signals of UserProfile
 def profile_changed(sender, instance, **kwargs):
     # import written inside the function to prevent reference loops
     from accounts.services import UserService
-    UserService.invalidate_profile(instance.user_id)
\ No newline at end of file
+    UserService.invalidate_profile(instance.user_id)
+
+
+def profile_saved(sender, instance, **kwargs):
+    from accounts.services import UserService
+    UserService.update_profile_cache(instance)
+
+
+def user_created(sender, instance, created, **kwargs):
+    # drop the profile cached as not found before the user was created
+    if not created:
+        return
+    from accounts.services import UserService
+    UserService.invalidate_profile(instance.id)
@@ -0,0 +1,19 @@
+from accounts.services import UserService
+
+
+class LastSeenMiddleware:
+    """
+    Record the time of the last request of authenticated users.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # check after the view is called,
+        # since DRF authenticates the user in the view and updates request.user
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            UserService.touch_last_seen(user.id)
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_auto_20220110_0620'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='is_pull_mode',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Written by hand: a data migration flagging the users already in pull mode.
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+
+
+def set_pull_mode_users(apps, schema_editor):
+    # the users in pull mode were only kept in Redis,
+    # keep the ones having more followers than the limit
+    Friendship = apps.get_model('friendships', 'Friendship')
+    UserProfile = apps.get_model('accounts', 'UserProfile')
+    user_ids = (
+        Friendship.objects.order_by().values('to_user_id')
+        .annotate(follower_count=Count('id'))
+        .filter(follower_count__gt=settings.NEWSFEED_FANOUT_FOLLOWER_LIMIT)
+        .values_list('to_user_id', flat=True)
+    )
+    for user_id in user_ids:
+        UserProfile.objects.update_or_create(
+            user_id=user_id,
+            defaults={'is_pull_mode': True},
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_userprofile_is_pull_mode'),
+        ('friendships', '0003_auto_20211203_2217'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_pull_mode_users, migrations.RunPython.noop),
+    ]
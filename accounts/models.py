@@ -1,8 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save, pre_delete
-from accounts.listeners import profile_changed
-from utils.listeners import invalidate_object_cache
+from accounts.listeners import profile_changed, profile_saved, user_created
+from utils.listeners import invalidate_object_cache, update_object_cache
 
 
 class UserProfile(models.Model):
@@ -11,6 +11,8 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.SET_NULL, null=True)
     avatar = models.FileField(null=True)
     nickname = models.CharField(null=True, max_length=20)
+    # tweets of pull mode users are not fanned out, see NewsFeedService
+    is_pull_mode = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -37,6 +39,7 @@ User.profile = property(get_profile)
 # For memcached
 # hook up with listeners to invalidate cache
 pre_delete.connect(invalidate_object_cache, sender=User)
-post_save.connect(invalidate_object_cache, sender=User)
+post_save.connect(update_object_cache, sender=User)
+post_save.connect(user_created, sender=User)
 pre_delete.connect(profile_changed, sender=UserProfile)
-post_save.connect(profile_changed, sender=UserProfile)
\ No newline at end of file
+post_save.connect(profile_saved, sender=UserProfile)
\ No newline at end of file
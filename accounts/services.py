@@ -2,26 +2,217 @@ from accounts.models import UserProfile
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import caches
-from twitter.cache import USER_PATTERN, USER_PROFILE_PATTERN
+from twitter.cache import USER_PATTERN, USER_PROFILE_PATTERN, USER_LAST_SEEN_KEY
+from utils.cache.identity_map import IdentityMap
+from utils.cache.local_cache import LocalCache, LRUCache
+from utils.cache.memcached_helper import MISSING, NOT_FOUND, MemcachedHelper
+from utils.cache.metrics import CacheMetrics
+from utils.cache.redis_client import RedisClient
+
+import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
+# users whose last seen time written by this process is remembered,
+# a user dropped from it is written again on next request
+LAST_SEEN_CACHE_SIZE = 100000
+LAST_SEEN_CACHE_TTL = 3600
 
 
 class UserService:
+    # user id -> when this process last recorded the user as seen
+    last_seen_touched = LRUCache(LAST_SEEN_CACHE_SIZE, LAST_SEEN_CACHE_TTL)
 
     @classmethod
     def get_profile_through_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        profile = cache.get(key)
+        # read once per request
+        profile = IdentityMap.get(UserProfile.__name__, key)
+        if profile is None:
+            profile = cls._get_profile(user_id, key)
+            IdentityMap.set(UserProfile.__name__, key, profile)
+        return profile
+
+    @classmethod
+    def _get_profile(cls, user_id, key):
+        profile = LocalCache.get(UserProfile.__name__, key)
         if profile is not None:
             return profile
 
-        # if there is not profile, create one
-        profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
-        cache.set(key, profile)
+        generation = LocalCache.get_generation()
+        profile = MemcachedHelper.get_cached_objects(UserProfile, [key]).get(key, MISSING)
+        if profile is not MISSING:
+            CacheMetrics.record_hits(USER_PROFILE_PATTERN)
+            if profile == NOT_FOUND:
+                raise UserProfile.DoesNotExist('User {} does not exist.'.format(user_id))
+            LocalCache.set(UserProfile.__name__, key, profile, generation)
+            return profile
+
+        CacheMetrics.record_misses(USER_PROFILE_PATTERN)
+        start = time.perf_counter()
+        profile = UserProfile.objects.filter(user_id=user_id).first()
+        if profile is None:
+            # a profile can not be created for a user who does not exist
+            if not User.objects.filter(id=user_id).exists():
+                MemcachedHelper.set_loaded_objects(
+                    UserProfile,
+                    {key: NOT_FOUND},
+                    settings.CACHE_NOT_FOUND_TIMEOUT,
+                )
+                raise UserProfile.DoesNotExist('User {} does not exist.'.format(user_id))
+            # if there is not profile, create one
+            profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
+        size = MemcachedHelper.set_loaded_objects(UserProfile, {key: profile})
+        CacheMetrics.record_rebuild(USER_PROFILE_PATTERN, time.perf_counter() - start, size=size)
+        LocalCache.set(UserProfile.__name__, key, profile, generation)
         return profile
 
+    @classmethod
+    def prefetch_profiles(cls, users):
+        """
+        Load the profiles of users with one Memcached round trip, the profiles
+        not in cache are loaded from DB in one query. They are kept on the
+        users, so `user.profile` needs no more round trip.
+        """
+        users = [user for user in users if not hasattr(user, '_cached_user_profile')]
+        keys = {user.id: USER_PROFILE_PATTERN.format(user_id=user.id) for user in users}
+        # profiles read in the request
+        request_profiles = IdentityMap.get_many(UserProfile.__name__, keys.values())
+        for user in users:
+            if keys[user.id] in request_profiles:
+                setattr(user, '_cached_user_profile', request_profiles[keys[user.id]])
+        users = [user for user in users if keys[user.id] not in request_profiles]
+        keys = {user.id: keys[user.id] for user in users}
+        local_profiles = LocalCache.get_many(UserProfile.__name__, list(keys.values()))
+        generation = LocalCache.get_generation()
+        cached_profiles = MemcachedHelper.get_cached_objects(UserProfile, [
+            key for key in keys.values() if key not in local_profiles
+        ]) if len(local_profiles) < len(keys) else {}
+        CacheMetrics.record_hits(USER_PROFILE_PATTERN, len(cached_profiles))
+        # users who do not exist are not in the prefetched users
+        cached_profiles = {
+            key: profile
+            for key, profile in cached_profiles.items()
+            if profile != NOT_FOUND
+        }
+        LocalCache.set_many(UserProfile.__name__, cached_profiles, generation)
+        cached_profiles.update(local_profiles)
+        profiles = {
+            user_id: cached_profiles[key]
+            for user_id, key in keys.items()
+            if key in cached_profiles
+        }
+
+        missed_ids = [user_id for user_id in keys if user_id not in profiles]
+        if missed_ids:
+            CacheMetrics.record_misses(USER_PROFILE_PATTERN, len(missed_ids))
+            start = time.perf_counter()
+            loaded_profiles = {
+                profile.user_id: profile
+                for profile in UserProfile.objects.filter(user_id__in=missed_ids)
+            }
+            size = MemcachedHelper.set_loaded_objects(UserProfile, {
+                keys[user_id]: profile
+                for user_id, profile in loaded_profiles.items()
+            })
+            duration = time.perf_counter() - start
+            for profile in loaded_profiles.values():
+                CacheMetrics.record_rebuild(
+                    USER_PROFILE_PATTERN,
+                    duration / len(loaded_profiles),
+                    size=size // len(loaded_profiles),
+                )
+            profiles.update(loaded_profiles)
+            LocalCache.set_many(UserProfile.__name__, {
+                keys[user_id]: profile
+                for user_id, profile in loaded_profiles.items()
+            }, generation)
+
+        # users without profile create them by get_profile_through_cache() on access
+        for user in users:
+            if user.id in profiles:
+                setattr(user, '_cached_user_profile', profiles[user.id])
+        IdentityMap.set_many(UserProfile.__name__, {
+            keys[user_id]: profile
+            for user_id, profile in profiles.items()
+        })
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+        LocalCache.invalidate(UserProfile.__name__, key)
+        IdentityMap.discard(UserProfile.__name__, key)
+
+    @classmethod
+    def update_profile_cache(cls, profile):
+        """
+        Write a saved profile through to cache if UserProfile is in
+        CACHE_WRITE_THROUGH_MODELS, or drop it from cache.
+        """
+        if UserProfile.__name__ not in settings.CACHE_WRITE_THROUGH_MODELS:
+            cls.invalidate_profile(profile.user_id)
+            return
+        # the user of the profile is set to NULL
+        if profile.user_id is None:
+            return
+        key = USER_PROFILE_PATTERN.format(user_id=profile.user_id)
+        MemcachedHelper.write_through(UserProfile.__name__, key, profile)
+
+    @classmethod
+    def touch_last_seen(cls, user_id):
+        """
+        Record the user as seen now, skipped if this process has recorded
+        it in the last USER_LAST_SEEN_INTERVAL seconds.
+        """
+        now = time.time()
+        touched_at = cls.last_seen_touched.get(user_id)
+        if touched_at is not None and now - touched_at < settings.USER_LAST_SEEN_INTERVAL:
+            return
+        cls.last_seen_touched.set(user_id, now)
+        conn = RedisClient.get_connection()
+        conn.zadd(USER_LAST_SEEN_KEY, {user_id: now})
+
+    @classmethod
+    def clear_expired_last_seen(cls):
+        """
+        Drop the users not seen in USER_LAST_SEEN_RETENTION,
+        otherwise the set keeps every user who has ever logged in.
+        """
+        conn = RedisClient.get_connection()
+        expired_at = time.time() - settings.USER_LAST_SEEN_RETENTION
+        conn.zremrangebyscore(USER_LAST_SEEN_KEY, '-inf', expired_at)
+
+    @classmethod
+    def get_active_user_ids(cls, user_ids, window):
+        """
+        Return the ids of users who are seen in the last `window` seconds.
+        """
+        if window is None:
+            return set(user_ids)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.zscore(USER_LAST_SEEN_KEY, user_id)
+        since = time.time() - window
+        return {
+            user_id
+            for user_id, last_seen in zip(user_ids, pipeline.execute())
+            if last_seen is not None and last_seen >= since
+        }
+
+    @classmethod
+    def get_recently_active_user_ids(cls, limit):
+        """
+        Return the ids of the users seen most recently. Users who logged in
+        most recently are used if the last seen times are lost,
+        e.g. Redis is restarted.
+        """
+        conn = RedisClient.get_connection()
+        user_ids = [int(user_id) for user_id in conn.zrevrange(USER_LAST_SEEN_KEY, 0, limit - 1)]
+        if user_ids:
+            return user_ids
+        return list(
+            User.objects.filter(last_login__isnull=False)
+            .order_by('-last_login')
+            .values_list('id', flat=True)[:limit]
+        )
@@ -4,6 +4,8 @@ from comments.models import Comment
 from accounts.api.serializers import UserSerializerForComment
 from tweets.models import Tweet
 from likes.services import LikeService
+from utils.counters import CounterService
+from utils.serializers import PrefetchThroughCacheListSerializer
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -23,9 +25,12 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PrefetchThroughCacheListSerializer
+        prefetch_through_cache = ('user',)
+        prefetch_counts = ('likes_count',)
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        return CounterService.get_count(obj, 'likes_count')
 
     def get_has_liked(self, obj):
         return LikeService.has_liked(self.context['request'].user, obj)
@@ -62,5 +67,6 @@ class CommentSerializerForUpdate(serializers.ModelSerializer):
 
     def update(self, instance, validated_data):
         instance.content = validated_data['content']
-        instance.save()
+        # the counters are changed by F() expressions, do not write them back
+        instance.save(update_fields=['content', 'updated_at'])
         return instance
\ No newline at end of file
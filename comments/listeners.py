@@ -0,0 +1,19 @@
+"""
+Keep the comments_count of the commented tweets, called by models.py
+"""
+def incr_comments_count(sender, instance, created, **kwargs):
+    if not created or instance.tweet_id is None:
+        return
+
+    from tweets.models import Tweet
+    from utils.counters import CounterService
+    CounterService.incr(Tweet, instance.tweet_id, 'comments_count', 1)
+
+
+def decr_comments_count(sender, instance, **kwargs):
+    if instance.tweet_id is None:
+        return
+
+    from tweets.models import Tweet
+    from utils.counters import CounterService
+    CounterService.incr(Tweet, instance.tweet_id, 'comments_count', -1)
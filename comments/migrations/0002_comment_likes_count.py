@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2022-01-20 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='likes_count',
+            field=models.IntegerField(default=0, null=True),
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_delete, post_save
+from comments.listeners import decr_comments_count, incr_comments_count
 from tweets.models import Tweet
 from likes.models import Like
 from utils.cache.memcached_helper import MemcachedHelper
@@ -13,6 +15,8 @@ class Comment(models.Model):
     content = models.TextField(max_length=140)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # denormalized counter, see utils/counters.py
+    likes_count = models.IntegerField(default=0, null=True)
 
     class Meta:
         index_together = (('tweet', 'created_at'),)
@@ -27,7 +31,7 @@ class Comment(models.Model):
 
     @property
     def cached_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.user_id)
+        return MemcachedHelper.get_related_object_through_cache(self, 'user')
 
     def __str__(self):
         return '{} - {} comments {} at tweet {}'.format(
@@ -35,4 +39,9 @@ class Comment(models.Model):
             self.user,
             self.content,
             self.tweet_id
-        )
\ No newline at end of file
+        )
+
+
+# hook up with listeners to keep the comments_count of tweets
+post_save.connect(incr_comments_count, sender=Comment)
+post_delete.connect(decr_comments_count, sender=Comment)
@@ -4,6 +4,7 @@ from django.contrib.auth.models import User
 from accounts.api.serializers import UserSerializerForFriendship
 from friendships.models import Friendship
 from friendships.services import FriendshipService
+from utils.serializers import PrefetchThroughCacheListSerializer
 
 
 class FollowingUserIdSetMixin:
@@ -33,6 +34,8 @@ class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'is_mutual', 'has_followed')
+        list_serializer_class = PrefetchThroughCacheListSerializer
+        prefetch_through_cache = ('from_user',)
 
     def get_has_followed(self, obj):
         return obj.from_user_id in self.following_user_id_set
@@ -45,6 +48,8 @@ class FollowingSerializer(FollowerSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'is_mutual', 'has_followed')
+        list_serializer_class = PrefetchThroughCacheListSerializer
+        prefetch_through_cache = ('to_user',)
 
     def get_has_followed(self, obj):
         return obj.to_user_id in self.following_user_id_set
@@ -10,6 +10,7 @@ from friendships.api.serializers import (
     FriendshipSerializerForCreate,
 )
 from friendships.api.pagination import FriendshipPagination
+from newsfeeds.services import NewsFeedService
 
 
 class FriendshipViewSet(viewsets.GenericViewSet):
@@ -61,6 +62,8 @@ class FriendshipViewSet(viewsets.GenericViewSet):
                 'errors': serializer.errors,
             }, status=status.HTTP_400_BAD_REQUEST)
         serializer.save()
+        # show the recent tweets of the followed user in newsfeeds
+        NewsFeedService.on_follow(request.user.id, following_user.id)
         return Response({
                 'success': True,
                 'is_mutual': data['is_mutual'],
@@ -89,6 +92,8 @@ class FriendshipViewSet(viewsets.GenericViewSet):
         ).delete()
 
         self.set_mutual_following(data, follow_type='unfollow')
+        if deleted:
+            NewsFeedService.on_unfollow(request.user.id, unfollow_user.id)
 
         return Response({
             'success': True,
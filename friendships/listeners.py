@@ -5,4 +5,17 @@ Called by models.py
 """
 def invalidate_following_cache(sender, instance, **kwargs):
     from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
\ No newline at end of file
+    FriendshipService.invalidate_following_cache(instance.from_user_id)
+
+
+def incr_follower_count(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    from friendships.services import FriendshipService
+    FriendshipService.incr_follower_count(instance.to_user_id, 1)
+
+
+def decr_follower_count(sender, instance, **kwargs):
+    from friendships.services import FriendshipService
+    FriendshipService.incr_follower_count(instance.to_user_id, -1)
@@ -1,7 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save, pre_delete
-from friendships.listeners import invalidate_following_cache
+from friendships.listeners import (
+    decr_follower_count,
+    incr_follower_count,
+    invalidate_following_cache,
+)
 from utils.cache.memcached_helper import MemcachedHelper
 
 
@@ -37,13 +41,15 @@ class Friendship(models.Model):
 
     @property
     def cached_from_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
+        return MemcachedHelper.get_related_object_through_cache(self, 'from_user')
 
     @property
     def cached_to_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
+        return MemcachedHelper.get_related_object_through_cache(self, 'to_user')
 
 
 # hook up with listeners to invalidate cache
 pre_delete.connect(invalidate_following_cache, sender=Friendship)
-post_save.connect(invalidate_following_cache, sender=Friendship)
\ No newline at end of file
+post_save.connect(invalidate_following_cache, sender=Friendship)
+post_save.connect(incr_follower_count, sender=Friendship)
+pre_delete.connect(decr_follower_count, sender=Friendship)
\ No newline at end of file
@@ -1,32 +1,93 @@
 from django.conf import settings
 from django.core.cache import caches
+from django.db.models import Count, Q
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import FOLLOWER_COUNT_PATTERN, FOLLOWINGS_PATTERN
+from utils.cache.memcached_serializers import IdSetSerializer
+from utils.cache.metrics import CacheMetrics
+from utils.cache.redis_client import RedisClient
+
+import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# only the cached counters are changed, the others are loaded from DB when read
+INCR_FOLLOWER_COUNT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
 
 class FriendshipService:
 
     @classmethod
-    def get_followers(cls, user):
+    def get_follower_ids_in_batches(cls, user_id, batch_size):
+        """
+        Yield follower ids batch by batch, so the memory usage is bounded
+        no matter how many followers the user has.
+        """
+        for follower_ids, _ in cls.get_follower_batches(user_id, batch_size):
+            yield follower_ids
+
+    @classmethod
+    def get_follower_batches(cls, user_id, batch_size, cursor=None):
+        """
+        Yield (follower ids, cursor) batch by batch, the cursor is the
+        (created_at, id) of the last friendship in the batch.
+        Iterating again from a yielded cursor continues after that batch.
+        Keyset pagination on the (to_user_id, created_at) index is used,
+        each batch is an index range scan rather than a growing OFFSET.
+        """
+        queryset = Friendship.objects.filter(to_user_id=user_id).order_by('created_at', 'id')
+        while True:
+            batch = queryset
+            if cursor is not None:
+                last_created_at, last_id = cursor
+                batch = batch.filter(
+                    Q(created_at__gt=last_created_at) |
+                    Q(created_at=last_created_at, id__gt=last_id)
+                )
+            rows = list(batch.values_list('id', 'created_at', 'from_user_id')[:batch_size])
+            if not rows:
+                return
+            last_id, last_created_at, _ = rows[-1]
+            cursor = (last_created_at, last_id)
+            yield [from_user_id for _, _, from_user_id in rows], cursor
 
-        # It will cause N + 1 Queries using the following query:
-        #
-        # friendships = Friendship.objects.filter(to_user=user)
-        # return [friendship.from_user for friendship in friendships]
-        #
-        # The above query will make query to DB for every friendship.from_user
+    @classmethod
+    def get_follower_count(cls, user_id):
+        """
+        The count is cached in Redis and changed on follow and unfollow,
+        so it is counted in DB once per REDIS_KEY_EXPIRE_TIME.
+        """
+        key = FOLLOWER_COUNT_PATTERN.format(user_id=user_id)
+        conn = RedisClient.get_connection(key)
+        count = conn.get(key)
+        if count is not None:
+            CacheMetrics.record_hits(FOLLOWER_COUNT_PATTERN)
+            return int(count)
+        CacheMetrics.record_misses(FOLLOWER_COUNT_PATTERN)
+        count = Friendship.objects.filter(to_user_id=user_id).count()
+        # keep the counter loaded by a concurrent reader
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME, nx=True)
+        return count
+
+    @classmethod
+    def incr_follower_count(cls, user_id, delta):
+        key = FOLLOWER_COUNT_PATTERN.format(user_id=user_id)
+        RedisClient.get_connection(key).eval(INCR_FOLLOWER_COUNT_SCRIPT, 1, key, delta)
 
-        # The following query using prefetch_related() only perform 2 queries in DB.
-        # It's equal to using an IN Query:
-        # friendships = Friendship.objects.filter(to_user=user)
-        # follower_ids = [friendship.from_user_id for friendship in friendships]
-        # followers = User.objects.filter(id__in=follower_ids)
-        friendships = Friendship.objects.filter(
-            to_user=user,
-        ).prefetch_related('from_user')
-        return [friendship.from_user for friendship in friendships]
+    @classmethod
+    def get_user_ids_with_followers_more_than(cls, limit):
+        # order_by() clears the default ordering, which would be added to GROUP BY
+        return list(
+            Friendship.objects.order_by().values('to_user_id')
+            .annotate(follower_count=Count('id'))
+            .filter(follower_count__gt=limit)
+            .values_list('to_user_id', flat=True)
+        )
 
     @classmethod
     def has_followed(cls, from_user, to_user):
@@ -38,15 +99,26 @@ class FriendshipService:
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        user_id_set = cache.get(key)
+        # an empty set is cached too, for users following nobody,
+        # a set cached in an older format is a miss
+        user_id_set = IdSetSerializer.deserialize(cache.get(key))
         if user_id_set is not None:
+            CacheMetrics.record_hits(FOLLOWINGS_PATTERN)
             return user_id_set
+        CacheMetrics.record_misses(FOLLOWINGS_PATTERN)
+        start = time.perf_counter()
         friendships = Friendship.objects.filter(from_user_id=from_user_id)
         user_id_set = set([
             fs.to_user_id
             for fs in friendships
         ])
-        cache.set(key, user_id_set)
+        data = IdSetSerializer.serialize(user_id_set)
+        cache.set(key, data)
+        CacheMetrics.record_rebuild(
+            FOLLOWINGS_PATTERN,
+            time.perf_counter() - start,
+            size=len(data),
+        )
         return user_id_set
 
     @classmethod
@@ -21,4 +21,49 @@ class FriendshipServiceTests(TestCase):
 
         Friendship.objects.filter(from_user=self.user1, to_user=self.user2).delete()
         user_id_ser = FriendshipService.get_following_user_id_set(self.user1)
-        self.assertEqual(user_id_ser, {user3.id, user4.id})
\ No newline at end of file
+        self.assertEqual(user_id_ser, {user3.id, user4.id})
+
+    def test_get_follower_ids_in_batches(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(5)]
+        for follower in followers:
+            Friendship.objects.create(from_user=follower, to_user=self.user1)
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+
+        batches = list(FriendshipService.get_follower_ids_in_batches(self.user1.id, 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(
+            [follower_id for batch in batches for follower_id in batch],
+            [follower.id for follower in followers],
+        )
+
+        # followers with the same created_at are neither skipped nor repeated
+        Friendship.objects.filter(to_user=self.user1).update(
+            created_at=Friendship.objects.first().created_at,
+        )
+        batches = list(FriendshipService.get_follower_ids_in_batches(self.user1.id, 2))
+        self.assertEqual(
+            sorted(follower_id for batch in batches for follower_id in batch),
+            [follower.id for follower in followers],
+        )
+
+        batches = list(FriendshipService.get_follower_ids_in_batches(self.user2.id, 2))
+        self.assertEqual(batches, [[self.user1.id]])
+
+    def test_get_follower_count(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(3)]
+        Friendship.objects.create(from_user=followers[0], to_user=self.user1)
+        self.assertEqual(FriendshipService.get_follower_count(self.user1.id), 1)
+
+        # counted in DB once, then changed by follow and unfollow
+        Friendship.objects.create(from_user=followers[1], to_user=self.user1)
+        Friendship.objects.create(from_user=followers[2], to_user=self.user1)
+        Friendship.objects.filter(from_user=followers[0], to_user=self.user1).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_follower_count(self.user1.id), 2)
+
+        # only the cached counters are changed
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        with self.assertNumQueries(1):
+            self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 1)
+        self.clear_cache()
+        self.assertEqual(FriendshipService.get_follower_count(self.user1.id), 2)
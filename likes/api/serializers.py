@@ -5,6 +5,7 @@ from accounts.api.serializers import UserSerializerForLike
 from comments.models import Comment
 from likes.models import Like
 from tweets.models import Tweet
+from utils.serializers import PrefetchThroughCacheListSerializer
 
 
 class LikeSerializer(serializers.ModelSerializer):
@@ -13,6 +14,8 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PrefetchThroughCacheListSerializer
+        prefetch_through_cache = ('user',)
 
 
 """
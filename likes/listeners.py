@@ -0,0 +1,18 @@
+"""
+Keep the likes_count of the liked tweets and comments, called by models.py
+"""
+def incr_likes_count(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    from django.contrib.contenttypes.models import ContentType
+    from utils.counters import CounterService
+    model_class = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    CounterService.incr(model_class, instance.object_id, 'likes_count', 1)
+
+
+def decr_likes_count(sender, instance, **kwargs):
+    from django.contrib.contenttypes.models import ContentType
+    from utils.counters import CounterService
+    model_class = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    CounterService.incr(model_class, instance.object_id, 'likes_count', -1)
@@ -2,6 +2,8 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.db.models.signals import post_delete, post_save
+from likes.listeners import decr_likes_count, incr_likes_count
 from utils.cache.memcached_helper import MemcachedHelper
 
 """
@@ -31,7 +33,7 @@ class Like(models.Model):
 
     @property
     def cached_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.user_id)
+        return MemcachedHelper.get_related_object_through_cache(self, 'user')
 
     def __str__(self):
         return '{} - {} liked {} {}'.format(
@@ -39,4 +41,9 @@ class Like(models.Model):
             self.user,
             self.content_type,
             self.object_id,
-        )
\ No newline at end of file
+        )
+
+
+# hook up with listeners to keep the counters of liked objects
+post_save.connect(incr_likes_count, sender=Like)
+post_delete.connect(decr_likes_count, sender=Like)
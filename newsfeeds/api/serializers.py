@@ -1,10 +1,17 @@
 from rest_framework import serializers
 from newsfeeds.models import NewsFeed
 from tweets.api.serializers import TweetSerializer
+from utils.serializers import PrefetchThroughCacheListSerializer
 
 class NewsFeedSerializer(serializers.ModelSerializer):
     tweet = TweetSerializer()
 
     class Meta:
         model = NewsFeed
-        fields = ('id', 'created_at', 'user', 'tweet')
\ No newline at end of file
+        # the tweets pulled from pull mode users are not saved as newsfeeds,
+        # their id is the negated tweet id, see NewsFeedService.tweets_to_newsfeeds()
+        fields = ('id', 'created_at', 'user', 'tweet')
+        list_serializer_class = PrefetchThroughCacheListSerializer
+        # tweets are filled from Memcached by NewsFeedService.fill_tweets()
+        prefetch_through_cache = ('tweet.user',)
+        prefetch_counts = ('tweet.likes_count', 'tweet.comments_count')
\ No newline at end of file
@@ -1,15 +1,20 @@
+from accounts.models import UserProfile
 from utils.testcases import TestCase
+from django.test import override_settings
 from rest_framework.test import APIClient
 from friendships.models import Friendship
 from utils.pagination import EndlessPagination
 from django.conf import settings
 from newsfeeds.services import NewsFeedService
 from newsfeeds.models import NewsFeed
+from tweets.services import TweetService
+from utils.job_queue import JobQueue
 
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEETS_URL = '/api/tweets/'
 FOLLOW_URL = '/api/friendships/{}/follow/'
+UNFOLLOW_URL = '/api/friendships/{}/unfollow/'
 
 
 class NewsFeedApiTests(TestCase):
@@ -191,4 +196,223 @@ class NewsFeedApiTests(TestCase):
 
         # cache expired
         self.clear_cache()
-        _test_newsfeeds_after_new_feed_pushed()
\ No newline at end of file
+        _test_newsfeeds_after_new_feed_pushed()
+
+    @override_settings(NEWSFEED_FANOUT_FOLLOWER_LIMIT=2)
+    def test_pull_mode_user(self):
+        page_size = EndlessPagination.page_size
+        star = self.create_user('star')
+        star_client = APIClient()
+        star_client.force_authenticate(star)
+        followers = [self.user1, self.user2, self.create_user('user3')]
+
+        # tweets before pull mode are fanned out
+        self.create_friendship(self.user1, star)
+        response = star_client.post(POST_TWEETS_URL, {'content': 'before pull mode'})
+        old_tweet_id = response.data['tweet']['id']
+        for follower in followers[1:]:
+            self.create_friendship(follower, star)
+
+        # tweets in pull mode are only in star's own newsfeeds
+        tweet_ids = []
+        for i in range(page_size):
+            response = star_client.post(POST_TWEETS_URL, {'content': 'tweet {}'.format(i)})
+            tweet_ids.append(response.data['tweet']['id'])
+        tweet_ids = tweet_ids[::-1]
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 0)
+        self.assertEqual(NewsFeed.objects.filter(user=star).count(), page_size + 1)
+
+        # followers pull the tweets when reading
+        feed_tweet = self.create_tweet(self.user2)
+        self.create_newsfeed(self.user1, feed_tweet)
+
+        def _test_pulled_newsfeeds():
+            results = self._paginate_to_get_newsfeeds(self.user1_client)
+            self.assertEqual(
+                [result['tweet']['id'] for result in results],
+                [feed_tweet.id] + tweet_ids + [old_tweet_id],
+            )
+            # every page renders the same id for a pulled tweet
+            self.assertEqual(
+                [result['id'] for result in results[1:-1]],
+                [-tweet_id for tweet_id in tweet_ids],
+            )
+            response = self.user1_client.get(NEWSFEEDS_URL)
+            self.assertEqual(response.data['has_next_page'], True)
+            self.assertEqual(len(response.data['results']), page_size)
+            # pulled tweets are not saved as newsfeeds, the id is derived from the tweet
+            self.assertEqual(response.data['results'][0]['id'] > 0, True)
+            self.assertEqual(
+                response.data['results'][1]['id'],
+                -response.data['results'][1]['tweet']['id'],
+            )
+
+        _test_pulled_newsfeeds()
+        # cache expired
+        self.clear_cache()
+        _test_pulled_newsfeeds()
+
+        # star's tweets are still pulled when followers decrease
+        Friendship.objects.filter(from_user=self.user2, to_user=star).delete()
+        response = star_client.post(POST_TWEETS_URL, {'content': 'still pulled'})
+        self.assertEqual(NewsFeed.objects.filter(user=self.user1).count(), 2)
+        response = self.user1_client.get(NEWSFEEDS_URL)
+        self.assertEqual(
+            response.data['results'][0]['tweet']['id'],
+            star.tweet_set.order_by('-created_at').first().id,
+        )
+        # and when the cached pull mode users are lost
+        self.assertEqual(UserProfile.objects.get(user=star).is_pull_mode, True)
+        self.clear_cache()
+        self.assertEqual(NewsFeedService.is_pull_mode_user(star.id), True)
+        response = self.user1_client.get(NEWSFEEDS_URL)
+        self.assertEqual(
+            [result['tweet']['id'] for result in response.data['results']][2:],
+            tweet_ids[:page_size - 2],
+        )
+
+    @override_settings(NEWSFEED_FANOUT_FOLLOWER_LIMIT=1)
+    def test_pull_mode_pagination_beyond_cache(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        star = self.create_user('star')
+        self.create_friendship(self.user1, star)
+        self.create_friendship(self.user2, star)
+        self.create_friendship(self.user1, self.user2)
+        tweets = []
+        # both the pushed and pulled lists are beyond the cache limit
+        for i in range(list_limit * 2 + 5):
+            user = star if i % 2 else self.user2
+            tweet = self.create_tweet(user, 'tweet {}'.format(i))
+            NewsFeedService.fanout_to_followers(tweet)
+            tweets.append(tweet)
+        tweets = tweets[::-1]
+
+        results = self._paginate_to_get_newsfeeds(self.user1_client)
+        self.assertEqual(
+            [result['tweet']['id'] for result in results],
+            [tweet.id for tweet in tweets],
+        )
+
+    @override_settings(NEWSFEED_FANOUT_FOLLOWER_LIMIT=1)
+    def test_pull_mode_refresh(self):
+        page_size = EndlessPagination.page_size
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        star = self.create_user('star')
+        self.create_friendship(self.user1, star)
+        self.create_friendship(self.user2, star)
+        self.create_friendship(self.user1, self.user2)
+        tweets = []
+        # both the pushed and pulled lists are full in cache
+        for i in range(list_limit * 2 + 5):
+            user = star if i % 2 else self.user2
+            tweet = self.create_tweet(user, 'tweet {}'.format(i))
+            NewsFeedService.fanout_to_followers(tweet)
+            tweets.append(tweet)
+        tweets = tweets[::-1]
+
+        # the newer tweets are in cache
+        response = self.user1_client.get(NEWSFEEDS_URL, {
+            'created_at__gt': tweets[11].created_at,
+        })
+        self.assertEqual(
+            [result['tweet']['id'] for result in response.data['results']],
+            [tweet.id for tweet in tweets[:11]],
+        )
+
+        # the newer tweets are beyond the cached lists, read from DB
+        response = self.user1_client.get(NEWSFEEDS_URL, {
+            'created_at__gt': tweets[-1].created_at,
+        })
+        self.assertEqual(
+            [result['tweet']['id'] for result in response.data['results']],
+            [tweet.id for tweet in tweets[:page_size]],
+        )
+
+    def test_follow_and_unfollow(self):
+        # user2 has newsfeeds in cache
+        feed_tweet = self.create_tweet(self.user2, 'my own tweet')
+        self.create_newsfeed(self.user2, feed_tweet)
+        self.user2_client.get(NEWSFEEDS_URL)
+
+        tweets = [self.create_tweet(self.user1, 'tweet {}'.format(i)) for i in range(3)]
+        self.create_newsfeed(self.user2, self.create_tweet(self.user2, 'newest tweet'))
+
+        # recent tweets are in newsfeeds after following, ordered by tweet time
+        self.user2_client.post(FOLLOW_URL.format(self.user1.id))
+        expected_tweet_ids = [
+            NewsFeed.objects.filter(user=self.user2).order_by('-created_at').first().tweet_id,
+            tweets[2].id,
+            tweets[1].id,
+            tweets[0].id,
+            feed_tweet.id,
+        ]
+
+        def _get_newsfeed_tweet_ids():
+            response = self.user2_client.get(NEWSFEEDS_URL)
+            return [result['tweet']['id'] for result in response.data['results']]
+
+        self.assertEqual(_get_newsfeed_tweet_ids(), expected_tweet_ids)
+        # the cache is merged rather than reloaded from DB
+        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual([f.tweet_id for f in cached_newsfeeds], expected_tweet_ids)
+        self.clear_cache()
+        self.assertEqual(_get_newsfeed_tweet_ids(), expected_tweet_ids)
+
+        # following again is idempotent
+        self.user2_client.post(FOLLOW_URL.format(self.user1.id))
+        NewsFeedService.backfill_newsfeeds(self.user2.id, self.user1.id)
+        self.assertEqual(_get_newsfeed_tweet_ids(), expected_tweet_ids)
+
+        # tweets are removed after unfollowing
+        self.user2_client.post(UNFOLLOW_URL.format(self.user1.id))
+        expected_tweet_ids = [expected_tweet_ids[0], feed_tweet.id]
+        self.assertEqual(_get_newsfeed_tweet_ids(), expected_tweet_ids)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 2)
+        self.clear_cache()
+        self.assertEqual(_get_newsfeed_tweet_ids(), expected_tweet_ids)
+
+    @override_settings(JOB_QUEUE_ALWAYS_EAGER=False)
+    def test_deleted_tweets(self):
+        page_size = EndlessPagination.page_size
+        self.create_friendship(self.user2, self.user1)
+        tweets = []
+        for i in range(page_size + 2):
+            tweet = self.create_tweet(self.user1, 'tweet {}'.format(i))
+            self.create_newsfeed(self.user2, tweet)
+            tweets.append(tweet)
+        tweets = tweets[::-1]
+        self.user2_client.get(NEWSFEEDS_URL)
+
+        # deleted tweets are filtered out before they are swept from cache
+        for tweet in tweets[:2]:
+            response = self.user1_client.delete('/api/tweets/{}/'.format(tweet.id))
+            self.assertEqual(response.status_code, 200)
+        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual(cached_newsfeeds[0].tweet_id, tweets[0].id)
+
+        def _test_newsfeeds_without_deleted():
+            response = self.user2_client.get(NEWSFEEDS_URL)
+            results = response.data['results']
+            # the page is still full
+            self.assertEqual(len(results), page_size)
+            self.assertEqual(response.data['has_next_page'], False)
+            self.assertEqual(
+                [result['tweet']['id'] for result in results],
+                [tweet.id for tweet in tweets[2:]],
+            )
+
+        _test_newsfeeds_without_deleted()
+
+        # the sweeper removes them from cache and newsfeeds
+        while JobQueue.run_next_job(timeout=1):
+            pass
+        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual(cached_newsfeeds[0].tweet_id, tweets[2].id)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), page_size)
+        cached_tweets = TweetService.get_cached_tweets(self.user1.id)
+        self.assertEqual(cached_tweets[0].id, tweets[2].id)
+        _test_newsfeeds_without_deleted()
+
+        # newsfeeds loaded from DB do not have the deleted tweets
+        self.clear_cache()
+        _test_newsfeeds_without_deleted()
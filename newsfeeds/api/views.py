@@ -1,8 +1,8 @@
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
-from newsfeeds.models import NewsFeed
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.services import NewsFeedService
+from tweets.models import Tweet
 from utils.pagination import EndlessPagination
 
 
@@ -11,16 +11,31 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
     pagination_class = EndlessPagination
 
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        user_id = request.user.id
+        # tweets of pull mode users are not fanned out, merge them when reading
+        pull_user_ids = NewsFeedService.get_pull_mode_following_ids(user_id)
+        # only the cached newsfeeds of the page are read
+        cached_newsfeeds, is_complete = NewsFeedService.get_cached_newsfeeds_with_pulled_tweets(
+            user_id,
+            pull_user_ids,
+            **self.paginator.get_cache_window(request),
+        )
+        page = self.paginator.paginate_cached_list(cached_newsfeeds, request, is_complete)
         # the wanted data is not in cache, need to fetch from DB
         if page is None:
-            queryset = NewsFeed.objects.filter(user=request.user)
-            page = self.paginate_queryset(queryset)
+            queryset = NewsFeedService.get_visible_newsfeeds(user_id)
+            if not pull_user_ids:
+                page = self.paginate_queryset(queryset)
+            else:
+                page = self.paginator.paginate_merged_querysets([
+                    queryset.exclude(tweet__user_id__in=pull_user_ids),
+                    Tweet.objects.filter(user_id__in=pull_user_ids, is_deleted=False),
+                ], request)
+                page = NewsFeedService.tweets_to_newsfeeds(user_id, page)
         serializer = NewsFeedSerializer(
             page,
             # for TweetSerializer.get_has_liked()
             context={'request': request},
             many=True,
         )
-        return self.get_paginated_response(serializer.data)
\ No newline at end of file
+        return self.get_paginated_response(serializer.data)
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedEntrySerializer
+from tweets.models import Tweet
+from tweets.services import TweetEntrySerializer
+
+import datetime
+import timeit
+import tracemalloc
+
+
+class Command(BaseCommand):
+    help = 'Compare CPU time and memory per item of reading a cached timeline ' \
+           'as CachedEntry objects and as model instances.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--items',
+            type=int,
+            default=200,
+            help='Number of entries in the timeline.',
+        )
+        parser.add_argument('--number', type=int, default=100, help='Number of reads.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        items = options['items']
+        # objects are not saved, they are only used for serialization
+        timelines = (
+            (TweetEntrySerializer, [
+                Tweet(id=index, user_id=1, created_at=now - datetime.timedelta(seconds=index))
+                for index in range(items)
+            ]),
+            (NewsFeedEntrySerializer, [
+                NewsFeed(
+                    id=index,
+                    user_id=1,
+                    tweet_id=index,
+                    created_at=now - datetime.timedelta(seconds=index),
+                )
+                for index in range(items)
+            ]),
+        )
+
+        self.stdout.write('{:<10}{:<16}{:>12}{:>14}'.format(
+            'model', 'type', 'us/item', 'bytes/item',
+        ))
+        for entry_serializer, objects in timelines:
+            serialized_list = [entry_serializer.serialize(obj) for obj in objects]
+            for name, read in (
+                ('CachedEntry', self.read_entries),
+                ('model', self.read_models),
+            ):
+                seconds = timeit.timeit(
+                    lambda: read(entry_serializer, serialized_list),
+                    number=options['number'],
+                )
+                self.stdout.write('{:<10}{:<16}{:>12.2f}{:>14.0f}'.format(
+                    entry_serializer.model_class.__name__,
+                    name,
+                    seconds / options['number'] / items * 1e6,
+                    self.get_allocated_bytes(read, entry_serializer, serialized_list) / items,
+                ))
+
+    def read_entries(self, entry_serializer, serialized_list):
+        entries = [entry_serializer.deserialize(data) for data in serialized_list]
+        # the fields read by windowing, merging and filling tweets
+        for entry in entries:
+            entry.id, entry.created_at
+        return entries
+
+    def read_models(self, entry_serializer, serialized_list):
+        instances = [entry_serializer.deserialize(data).to_model() for data in serialized_list]
+        for instance in instances:
+            instance.id, instance.created_at
+        return instances
+
+    def get_allocated_bytes(self, read, entry_serializer, serialized_list):
+        # memory held by the objects read
+        tracemalloc.start()
+        try:
+            objects = read(entry_serializer, serialized_list)
+            allocated_bytes, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del objects
+        return allocated_bytes
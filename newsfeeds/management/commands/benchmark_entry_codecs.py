@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.utils import timezone
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedEntrySerializer
+from tweets.models import Tweet
+from tweets.services import TweetEntrySerializer
+from utils.cache.redis_serializers import CODECS, DjangoModelSerializer
+
+import timeit
+
+
+class Command(BaseCommand):
+    help = 'Compare bytes per object and encode/decode throughput of ' \
+           'DjangoModelSerializer and the codecs of timeline entries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--number',
+            type=int,
+            default=10000,
+            help='Number of objects encoded and decoded.',
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        # objects are not saved, they are only used for serialization
+        tweet = Tweet(
+            id=123456789,
+            user_id=123456,
+            content='x' * 140,
+            created_at=now,
+            updated_at=now,
+        )
+        newsfeed = NewsFeed(id=987654321, user_id=654321, tweet_id=tweet.id, created_at=now)
+
+        self.stdout.write('{:<10}{:<24}{:>8}{:>14}{:>14}'.format(
+            'model', 'serializer', 'bytes', 'encode/s', 'decode/s',
+        ))
+        for obj, entry_serializer in (
+            (tweet, TweetEntrySerializer),
+            (newsfeed, NewsFeedEntrySerializer),
+        ):
+            self.report(obj, 'DjangoModelSerializer', DjangoModelSerializer, options['number'])
+            for codec_name in CODECS:
+                with override_settings(REDIS_ENTRY_CODEC=codec_name):
+                    self.report(obj, codec_name, entry_serializer, options['number'])
+
+    def report(self, obj, name, serializer, number):
+        serialized_data = serializer.serialize(obj)
+        if isinstance(serialized_data, str):
+            serialized_data = serialized_data.encode()
+        encode_seconds = timeit.timeit(lambda: serializer.serialize(obj), number=number)
+        decode_seconds = timeit.timeit(
+            lambda: serializer.deserialize(serialized_data),
+            number=number,
+        )
+        self.stdout.write('{:<10}{:<24}{:>8}{:>14.0f}{:>14.0f}'.format(
+            obj.__class__.__name__,
+            name,
+            len(serialized_data),
+            number / encode_seconds,
+            number / decode_seconds,
+        ))
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedEntrySerializer
+from utils.benchmark import RedisCounter
+from utils.cache.redis_client import RedisClient
+from utils.cache.redis_helper import RedisHelper
+
+import time
+
+BENCHMARK_KEY_PATTERN = 'benchmark:newsfeeds:{user_id}'
+
+
+class Command(BaseCommand):
+    help = 'Compare Redis round trips of pushing a newsfeed to every follower ' \
+           'one by one and in batch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--followers',
+            default='1000,10000,100000',
+            help='Comma separated numbers of followers.',
+        )
+
+    def handle(self, *args, **options):
+        for followers in [int(n) for n in options['followers'].split(',')]:
+            keys = [
+                BENCHMARK_KEY_PATTERN.format(user_id=user_id)
+                for user_id in range(followers)
+            ]
+            # newsfeeds are not saved, they are only used for serialization
+            newsfeeds = [
+                NewsFeed(id=user_id, user_id=user_id, tweet_id=1)
+                for user_id in range(followers)
+            ]
+
+            for name, push in (
+                ('one by one', self.push_one_by_one),
+                ('batch', self.push_in_batch),
+            ):
+                self.prepare_keys(keys)
+                with RedisCounter() as counter:
+                    start = time.perf_counter()
+                    push(keys, newsfeeds)
+                    duration = time.perf_counter() - start
+                self.stdout.write(
+                    '{} followers, {}: {} round trips, {:.3f}s'.format(
+                        followers, name, counter.round_trips, duration,
+                    )
+                )
+            RedisHelper.delete_keys(keys)
+
+    def prepare_keys(self, keys):
+        # every follower has the newsfeeds list in cache
+        RedisHelper.delete_keys(keys)
+        for conn, node_keys in RedisClient.group_by_connection(keys):
+            pipeline = conn.pipeline(transaction=False)
+            for key in node_keys:
+                pipeline.rpush(key, 'placeholder')
+            pipeline.execute()
+
+    def push_one_by_one(self, keys, newsfeeds):
+        # the path before batching: EXISTS, LPUSH and LTRIM for every key
+        for key, newsfeed in zip(keys, newsfeeds):
+            conn = RedisClient.get_connection(key)
+            if not conn.exists(key):
+                continue
+            conn.lpush(key, NewsFeedEntrySerializer.serialize(newsfeed))
+            conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+
+    def push_in_batch(self, keys, newsfeeds):
+        RedisHelper.push_objects(list(zip(keys, newsfeeds)), NewsFeedEntrySerializer)
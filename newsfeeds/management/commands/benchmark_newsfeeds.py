@@ -0,0 +1,99 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from newsfeeds.api.views import NewsFeedViewSet
+from newsfeeds.management.commands.generate_social_graph import SYNTHETIC_USERNAME_PREFIX
+from newsfeeds.services import NewsFeedService
+from rest_framework.test import APIRequestFactory, force_authenticate
+from tweets.models import Tweet
+from twitter.cache import NEWSFEEDS_PATTERNN
+from utils.benchmark import measure, summarize
+from utils.cache.redis_client import RedisClient
+
+import json
+import random
+import subprocess
+
+NEWSFEEDS_URL = '/api/newsfeeds/'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark fanout, newsfeed reads and newsfeed cache rebuilds ' \
+           'on the users created by generate_social_graph. Print the result as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--samples',
+            type=int,
+            default=100,
+            help='Number of calls of each benchmark.',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the result to the file.')
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        users = list(
+            User.objects.filter(username__startswith=SYNTHETIC_USERNAME_PREFIX)
+            .annotate(follower_count=Count('follower_friendship'))
+        )
+        if not users:
+            self.stderr.write('No synthetic users, run generate_social_graph first.')
+            return
+        samples = options['samples']
+
+        # tweets of popular users dominate the fanout cost, sample by followers
+        authors = rand.choices(
+            users,
+            weights=[user.follower_count + 1 for user in users],
+            k=samples,
+        )
+        readers = [rand.choice(users) for _ in range(samples)]
+
+        result = {
+            'commit': self.get_commit(),
+            'users': len(users),
+            'samples': samples,
+            'fanout': summarize([self.benchmark_fanout(author) for author in authors]),
+            'cache_rebuild': summarize([
+                self.benchmark_cache_rebuild(reader) for reader in readers
+            ]),
+            # caches are loaded by the rebuild benchmark, so reads are cache hits
+            'feed_read': summarize([self.benchmark_feed_read(reader) for reader in readers]),
+        }
+
+        output = json.dumps(result, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def get_commit(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL,
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def benchmark_fanout(self, author):
+        tweet = Tweet.objects.create(user=author, content='benchmark tweet')
+        return measure(NewsFeedService.fanout_to_followers_sync, tweet.id)
+
+    def benchmark_cache_rebuild(self, reader):
+        key = NEWSFEEDS_PATTERNN.format(user_id=reader.id)
+        RedisClient.get_connection(key).delete(key)
+        return measure(NewsFeedService.get_cached_newsfeeds, reader.id)
+
+    def benchmark_feed_read(self, reader):
+        view = NewsFeedViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get(NEWSFEEDS_URL)
+        force_authenticate(request, user=reader)
+
+        def read():
+            response = view(request)
+            # render the response as a real request does
+            response.render()
+
+        return measure(read)
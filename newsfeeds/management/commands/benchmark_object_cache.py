@@ -0,0 +1,78 @@
+from accounts.models import UserProfile
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from friendships.models import Friendship
+from tweets.models import Tweet
+from utils.cache.memcached_serializers import IdSetSerializer, ObjectSerializer
+
+import pickle
+import timeit
+
+
+class Command(BaseCommand):
+    help = 'Compare the bytes per key and the decode time of the objects cached ' \
+           'in Memcached as pickled instances and as compact payloads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--objects',
+            type=int,
+            default=100,
+            help='Number of objects of each model read from DB.',
+        )
+        parser.add_argument('--number', type=int, default=100, help='Number of decodes.')
+
+    def handle(self, *args, **options):
+        limit = options['objects']
+        self.stdout.write('{:<14}{:<10}{:>12}{:>14}'.format(
+            'model', 'format', 'us/item', 'bytes/item',
+        ))
+        for model_class in (User, UserProfile, Tweet):
+            objects = list(model_class.objects.order_by('-id')[:limit])
+            if not objects:
+                self.stdout.write('{:<14}no objects in DB'.format(model_class.__name__))
+                continue
+            self.report(model_class.__name__, options['number'], (
+                (
+                    'pickle',
+                    [pickle.dumps(obj, pickle.HIGHEST_PROTOCOL) for obj in objects],
+                    pickle.loads,
+                ),
+                (
+                    'compact',
+                    [ObjectSerializer.serialize(obj) for obj in objects],
+                    lambda data: ObjectSerializer.deserialize(model_class, data),
+                ),
+            ))
+
+        # the followings of the users following the most users
+        id_sets = {}
+        for from_user_id, to_user_id in Friendship.objects.values_list('from_user_id', 'to_user_id'):
+            id_sets.setdefault(from_user_id, set()).add(to_user_id)
+        id_sets = sorted(id_sets.values(), key=len, reverse=True)[:limit]
+        if id_sets:
+            self.report('followings', options['number'], (
+                (
+                    'pickle',
+                    [pickle.dumps(ids, pickle.HIGHEST_PROTOCOL) for ids in id_sets],
+                    pickle.loads,
+                ),
+                (
+                    'compact',
+                    [IdSetSerializer.serialize(ids) for ids in id_sets],
+                    IdSetSerializer.deserialize,
+                ),
+            ))
+
+    def report(self, name, number, formats):
+        for format_name, payloads, decode in formats:
+            seconds = timeit.timeit(
+                lambda: [decode(data) for data in payloads],
+                number=number,
+            )
+            self.stdout.write('{:<14}{:<10}{:>12.2f}{:>14.0f}'.format(
+                name,
+                format_name,
+                seconds / number / len(payloads) * 1e6,
+                sum(len(data) for data in payloads) / len(payloads),
+            ))
@@ -0,0 +1,141 @@
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from friendships.models import Friendship
+from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
+from twitter.cache import PULL_MODE_USERS_KEY
+from utils.cache.redis_client import RedisClient
+
+import itertools
+import random
+
+SYNTHETIC_USERNAME_PREFIX = 'synthetic_'
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic users, friendships, tweets and newsfeeds for benchmark. ' \
+           'Followers of users follow a power-law distribution.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument(
+            '--followings',
+            type=int,
+            default=20,
+            help='Average number of users followed by a user.',
+        )
+        parser.add_argument('--tweets', type=int, default=10, help='Tweets per user.')
+        parser.add_argument(
+            '--alpha',
+            type=float,
+            default=1.0,
+            help='Exponent of the power-law, a larger one makes popular users more popular.',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--clear',
+            action='store_true',
+            help='Delete the data generated before.',
+        )
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            self.clear()
+
+        rand = random.Random(options['seed'])
+        user_ids = self.create_users(options['users'])
+        follower_ids = self.create_friendships(
+            user_ids,
+            options['followings'],
+            options['alpha'],
+            rand,
+        )
+        self.create_tweets_and_newsfeeds(user_ids, follower_ids, options['tweets'])
+        # pull mode users are changed, load them from DB again
+        RedisClient.get_connection().delete(PULL_MODE_USERS_KEY)
+
+        follower_counts = sorted((len(ids) for ids in follower_ids.values()), reverse=True)
+        self.stdout.write(
+            '{} users, {} friendships, {} tweets, {} newsfeeds are created. '
+            'Max followers: {}, median followers: {}.'.format(
+                len(user_ids),
+                sum(follower_counts),
+                len(user_ids) * options['tweets'],
+                NewsFeed.objects.filter(user_id__in=user_ids).count(),
+                follower_counts[0] if follower_counts else 0,
+                follower_counts[len(follower_counts) // 2] if follower_counts else 0,
+            )
+        )
+
+    def clear(self):
+        users = User.objects.filter(username__startswith=SYNTHETIC_USERNAME_PREFIX)
+        NewsFeed.objects.filter(user__in=users).delete()
+        Tweet.objects.filter(user__in=users).delete()
+        Friendship.objects.filter(from_user__in=users).delete()
+        users.delete()
+
+    def create_users(self, count):
+        start = User.objects.filter(
+            username__startswith=SYNTHETIC_USERNAME_PREFIX,
+        ).count()
+        # hashing is slow, all the users share the same password
+        password = make_password('password')
+        User.objects.bulk_create([
+            User(
+                username='{}{}'.format(SYNTHETIC_USERNAME_PREFIX, index),
+                email='{}{}@twitter.com'.format(SYNTHETIC_USERNAME_PREFIX, index),
+                password=password,
+            )
+            for index in range(start, start + count)
+        ], batch_size=BATCH_SIZE)
+        return list(
+            User.objects.filter(username__startswith=SYNTHETIC_USERNAME_PREFIX)
+            .order_by('id')
+            .values_list('id', flat=True)[start:start + count]
+        )
+
+    def create_friendships(self, user_ids, followings, alpha, rand):
+        """
+        The user ranked k is followed with probability proportional to 1 / k^alpha.
+        Return a dict of user id to follower ids.
+        """
+        ranked_user_ids = list(user_ids)
+        rand.shuffle(ranked_user_ids)
+        cum_weights = list(itertools.accumulate(
+            1 / (rank ** alpha)
+            for rank in range(1, len(ranked_user_ids) + 1)
+        ))
+
+        follower_ids = {user_id: [] for user_id in user_ids}
+        friendships = []
+        for user_id in user_ids:
+            count = rand.randint(0, 2 * followings)
+            to_user_ids = set(rand.choices(ranked_user_ids, cum_weights=cum_weights, k=count))
+            to_user_ids.discard(user_id)
+            for to_user_id in to_user_ids:
+                follower_ids[to_user_id].append(user_id)
+                friendships.append(Friendship(from_user_id=user_id, to_user_id=to_user_id))
+        Friendship.objects.bulk_create(friendships, batch_size=BATCH_SIZE)
+        return follower_ids
+
+    def create_tweets_and_newsfeeds(self, user_ids, follower_ids, tweets_per_user):
+        for user_id in user_ids:
+            tweets = [
+                Tweet(user_id=user_id, content='synthetic tweet {}'.format(index))
+                for index in range(tweets_per_user)
+            ]
+            Tweet.objects.bulk_create(tweets)
+            tweets = Tweet.objects.filter(user_id=user_id).order_by('-id')[:tweets_per_user]
+
+            # same as fanout, tweets of pull mode users are not fanned out
+            receiver_ids = [user_id]
+            if len(follower_ids[user_id]) <= settings.NEWSFEED_FANOUT_FOLLOWER_LIMIT:
+                receiver_ids += follower_ids[user_id]
+            NewsFeed.objects.bulk_create([
+                NewsFeed(user_id=receiver_id, tweet=tweet)
+                for tweet in tweets
+                for receiver_id in receiver_ids
+            ], batch_size=BATCH_SIZE)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.services import NewsFeedEntrySerializer
+from tweets.services import TweetEntrySerializer
+from twitter.cache import NEWSFEEDS_PATTERNN, USER_TWEETS_PATTERN
+from utils.cache.redis_client import RedisClient
+from utils.cache.redis_helper import RedisHelper
+
+SERIALIZERS = {
+    USER_TWEETS_PATTERN: TweetEntrySerializer,
+    NEWSFEEDS_PATTERNN: NewsFeedEntrySerializer,
+}
+
+
+class Command(BaseCommand):
+    help = 'Convert the cached timelines to the backends in ' \
+           'REDIS_TIMELINE_BACKENDS, so they need not be loaded from DB again.'
+
+    def handle(self, *args, **options):
+        for pattern, serializer in SERIALIZERS.items():
+            scanned, converted = 0, 0
+            match = '{}*'.format(pattern.split('{')[0])
+            for conn in RedisClient.get_all_connections():
+                for key in conn.scan_iter(match=match, count=1000):
+                    scanned += 1
+                    if RedisHelper.convert_backend(key.decode(), serializer):
+                        converted += 1
+            self.stdout.write('{}: {} keys scanned, {} keys converted.'.format(
+                pattern, scanned, converted,
+            ))
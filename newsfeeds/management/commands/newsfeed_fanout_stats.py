@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.services import NewsFeedService
+
+import json
+
+
+class Command(BaseCommand):
+    help = 'Show the counters of newsfeeds fanout to Redis.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Reset the counters after showing them.',
+        )
+
+    def handle(self, *args, **options):
+        stats = NewsFeedService.get_fanout_stats()
+        self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
+        if options['reset']:
+            NewsFeedService.reset_fanout_stats()
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import autodiscover_modules
+from utils.job_queue import JobQueue
+
+
+class Command(BaseCommand):
+    help = 'Run a worker to execute the jobs in Redis job queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', default='default')
+        parser.add_argument(
+            '--timeout',
+            type=int,
+            default=5,
+            help='Seconds to block when waiting for a job.',
+        )
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            help='Exit when the queue is empty.',
+        )
+        parser.add_argument(
+            '--requeue',
+            action='store_true',
+            help='Put the jobs left by crashed workers back to the queue before start.',
+        )
+
+    def handle(self, *args, **options):
+        # import `tasks.py` of every app to register the tasks
+        autodiscover_modules('tasks')
+
+        queue = options['queue']
+        if options['requeue']:
+            count = JobQueue.requeue_unfinished_jobs(queue)
+            self.stdout.write('{} unfinished jobs are requeued.'.format(count))
+
+        self.stdout.write('Worker is running on queue "{}".'.format(queue))
+        processed = 0
+        while True:
+            has_job = JobQueue.run_next_job(queue, timeout=options['timeout'])
+            if has_job:
+                processed += 1
+            elif options['burst']:
+                break
+        self.stdout.write('{} jobs processed.'.format(processed))
@@ -0,0 +1,103 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from utils.cache.metrics import CacheMetrics
+from utils.cache.redis_client import RedisClient
+
+import json
+
+# lengths of timelines, to tune REDIS_LIST_LENGTH_LIMIT
+LENGTH_COMMANDS = {
+    b'list': 'llen',
+    b'zset': 'zcard',
+}
+
+
+class Command(BaseCommand):
+    help = 'Estimate the Redis memory usage by key pattern with MEMORY USAGE ' \
+           'of random keys. Print the result as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--samples',
+            type=int,
+            default=1000,
+            help='Number of random keys sampled on each node.',
+        )
+
+    def handle(self, *args, **options):
+        patterns = {}
+        for conn in RedisClient.get_all_connections():
+            self.sample_node(conn, options['samples'], patterns)
+
+        result = {}
+        for pattern, stats in patterns.items():
+            sampled = stats['sampled']
+            lengths = stats['lengths']
+            result[pattern] = {
+                'sampled_keys': sampled,
+                'estimated_keys': round(stats['estimated_keys']),
+                'avg_bytes': stats['bytes'] / sampled,
+                'estimated_bytes': round(stats['estimated_keys'] * stats['bytes'] / sampled),
+                # TTL of keys without expire time is -1, they are excluded
+                'avg_ttl': stats['ttl'] / stats['expiring'] if stats['expiring'] else None,
+                'avg_length': sum(lengths) / len(lengths) if lengths else None,
+                # timelines reaching REDIS_LIST_LENGTH_LIMIT may have more data in DB
+                'at_length_limit': sum(
+                    length >= settings.REDIS_LIST_LENGTH_LIMIT for length in lengths
+                ) / len(lengths) if lengths else None,
+            }
+        self.stdout.write(json.dumps(result, indent=2, sort_keys=True))
+
+    def sample_node(self, conn, samples, patterns):
+        key_count = conn.dbsize()
+        if not key_count:
+            return
+        pipeline = conn.pipeline(transaction=False)
+        for _ in range(min(samples, key_count)):
+            pipeline.randomkey()
+        # keys may be sampled more than once, the average is still unbiased
+        keys = [key for key in pipeline.execute() if key is not None]
+
+        pipeline = conn.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+            pipeline.type(key)
+            pipeline.ttl(key)
+        results = pipeline.execute()
+        sizes, types, ttls = results[0::3], results[1::3], results[2::3]
+
+        timeline_keys = [
+            (key, key_type)
+            for key, key_type in zip(keys, types)
+            if key_type in LENGTH_COMMANDS
+        ]
+        pipeline = conn.pipeline(transaction=False)
+        for key, key_type in timeline_keys:
+            getattr(pipeline, LENGTH_COMMANDS[key_type])(key)
+        # paired with the keys up front, the keys expired after sampled are skipped below
+        lengths = {
+            key: length
+            for (key, _), length in zip(timeline_keys, pipeline.execute())
+        }
+
+        for key, size, key_type, ttl in zip(keys, sizes, types, ttls):
+            # the key expired after sampled
+            if size is None:
+                continue
+            pattern = CacheMetrics.get_pattern(key.decode())
+            stats = patterns.setdefault(pattern, {
+                'sampled': 0,
+                'estimated_keys': 0,
+                'bytes': 0,
+                'ttl': 0,
+                'expiring': 0,
+                'lengths': [],
+            })
+            stats['sampled'] += 1
+            stats['estimated_keys'] += key_count / len(keys)
+            stats['bytes'] += size
+            if ttl >= 0:
+                stats['ttl'] += ttl
+                stats['expiring'] += 1
+            if key_type in LENGTH_COMMANDS:
+                stats['lengths'].append(lengths[key])
@@ -0,0 +1,114 @@
+from accounts.services import UserService
+from django.core.management.base import BaseCommand
+from django.db import connection
+from newsfeeds.services import NewsFeedService
+from utils.cache.metrics import CacheMetrics
+
+import queue
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Let at most `rate` calls of wait() pass per second, shared by threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start_at = max(self.next_at, now)
+            self.next_at = start_at + self.interval
+        time.sleep(max(0, start_at - now))
+
+
+class Command(BaseCommand):
+    help = 'Load the cached newsfeeds and tweets of the most recently active users ' \
+           'from DB, e.g. after Redis is restarted. Cached timelines are skipped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Number of users.')
+        parser.add_argument('--workers', type=int, default=4, help='Number of threads.')
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=100,
+            help='Max users warmed up per second to protect the DB, 0 for no limit.',
+        )
+        parser.add_argument(
+            '--progress',
+            type=int,
+            default=1000,
+            help='Report the progress every N users.',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = UserService.get_recently_active_user_ids(options['users'])
+        jobs = queue.Queue()
+        for user_id in user_ids:
+            jobs.put(user_id)
+
+        self.total = len(user_ids)
+        self.done = 0
+        self.loaded = 0
+        self.failed = 0
+        self.progress = options['progress']
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        limiter = RateLimiter(options['rate'])
+
+        workers = [
+            threading.Thread(target=self.work, args=(jobs, limiter))
+            for _ in range(max(1, options['workers']))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        CacheMetrics.flush()
+        self.report()
+
+    def work(self, jobs, limiter):
+        try:
+            while True:
+                try:
+                    user_id = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                limiter.wait()
+                loaded, failed = 0, 0
+                try:
+                    loaded = NewsFeedService.warm_up_cache(user_id)
+                except Exception as error:
+                    failed = 1
+                    self.stderr.write('Failed to warm up user {}: {}'.format(user_id, error))
+                with self.lock:
+                    self.done += 1
+                    self.loaded += loaded
+                    self.failed += failed
+                    if self.done % self.progress == 0:
+                        self.report()
+        finally:
+            # every thread has its own DB connection
+            connection.close()
+
+    def report(self):
+        duration = time.monotonic() - self.start
+        self.stdout.write(
+            '{}/{} users warmed up, {} timelines loaded from DB, {} failed, '
+            '{:.1f} users/s.'.format(
+                self.done,
+                self.total,
+                self.loaded,
+                self.failed,
+                self.done / duration if duration else 0,
+            )
+        )
@@ -23,7 +23,7 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
-        return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
+        return MemcachedHelper.get_related_object_through_cache(self, 'tweet')
 
 # for Redis
 post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
\ No newline at end of file
@@ -1,33 +1,541 @@
+from accounts.models import UserProfile
+from accounts.services import UserService
+from django.conf import settings
+from django.db.models import Case, Value, When
+from django.utils.dateparse import parse_datetime
 from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
-from twitter.cache import NEWSFEEDS_PATTERNN
+from newsfeeds.tasks import (
+    backfill_newsfeeds_task,
+    fanout_newsfeeds_task,
+    prefetch_newsfeeds_task,
+    purge_newsfeeds_task,
+    sweep_deleted_tweet_task,
+)
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import (
+    FANOUT_CHECKPOINT_PATTERN,
+    FANOUT_STATS_KEY,
+    NEWSFEEDS_PATTERNN,
+    PULL_MODE_USERS_KEY,
+)
+from utils.cache.memcached_helper import MemcachedHelper
+from utils.cache.redis_client import RedisClient
 from utils.cache.redis_helper import RedisHelper
+from utils.cache.redis_serializers import ModelEntrySerializer
+from utils.job_queue import JobQueue
+from utils.pagination import EndlessPagination
+
+import heapq
+
+
+class NewsFeedEntrySerializer(ModelEntrySerializer):
+    # tweets are filled from Memcached after loading
+    model_class = NewsFeed
+    field_names = ('id', 'user_id', 'tweet_id', 'created_at')
 
 
 class NewsFeedService:
 
     @classmethod
     def fanout_to_followers(cls, tweet):
-        newsfeeds = [
-            NewsFeed(user=follower, tweet=tweet)
-            for follower in FriendshipService.get_followers(tweet.user)
+        # Read your own write:
+        # user's own newsfeed is created synchronously (post_save pushes it to cache),
+        # so the user can see the tweet right after posting it.
+        NewsFeed.objects.create(user=tweet.user, tweet=tweet)
+        # delivering to followers may be slow, leave it to the job worker
+        JobQueue.enqueue(fanout_newsfeeds_task, tweet_id=tweet.id)
+
+    @classmethod
+    def fanout_to_followers_sync(cls, tweet_id):
+        tweet = Tweet.objects.filter(id=tweet_id).first()
+        # the tweet may be deleted before the job runs
+        if tweet is None or tweet.is_deleted:
+            return
+        # followers of a pull mode user read the tweets from user's timeline
+        if cls.is_pull_mode_user(tweet.user_id):
+            return
+        # Followers are delivered batch by batch in a fixed order, the checkpoint
+        # records the last delivered batch, so a retried job only does the rest.
+        for follower_ids, cursor in FriendshipService.get_follower_batches(
+            tweet.user_id,
+            settings.NEWSFEED_FANOUT_BATCH_SIZE,
+            cursor=cls.get_fanout_checkpoint(tweet_id),
+        ):
+            cls.fanout_batch(tweet, follower_ids)
+            cls.save_fanout_checkpoint(tweet_id, cursor)
+        cls.clear_fanout_checkpoint(tweet_id)
+        UserService.clear_expired_last_seen()
+
+    @classmethod
+    def fanout_batch(cls, tweet, follower_ids):
+        """
+        Deliver the tweet to a batch of followers, it is safe to run again.
+        """
+        existing_user_ids = set(
+            NewsFeed.objects.filter(tweet=tweet, user_id__in=follower_ids)
+            .values_list('user_id', flat=True)
+        )
+        new_user_ids = [
+            follower_id
+            for follower_id in follower_ids
+            if follower_id not in existing_user_ids
         ]
-        # add user's tweets to newsfeed
-        newsfeeds.append(NewsFeed(user=tweet.user, tweet=tweet))
-        NewsFeed.objects.bulk_create(newsfeeds)
+        # rows inserted concurrently (e.g. by backfill) are ignored
+        NewsFeed.objects.bulk_create(
+            [NewsFeed(user_id=user_id, tweet=tweet) for user_id in new_user_ids],
+            ignore_conflicts=True,
+        )
         # since `bulk_create()` method will not trigger post_save signal,
         # the newsfeeds need to be push to cache manually
-        for newsfeed in newsfeeds:
-            cls.push_newsfeed_to_cache(newsfeed)
+        cls.push_newsfeeds_to_active_users(list(
+            NewsFeed.objects.filter(tweet=tweet, user_id__in=new_user_ids)
+        ))
+        if not existing_user_ids:
+            return
+        # The existing rows were left by a failed run, which may or may not
+        # have pushed them to cache. Drop the cached lists instead of pushing
+        # twice, they will be loaded from DB on the next read.
+        invalidated = RedisHelper.delete_keys([
+            NEWSFEEDS_PATTERNN.format(user_id=user_id)
+            for user_id in existing_user_ids
+        ])
+        cls.incr_fanout_stats(invalidated=invalidated)
+
+    @classmethod
+    def get_fanout_checkpoint(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        checkpoint = conn.hgetall(FANOUT_CHECKPOINT_PATTERN.format(tweet_id=tweet_id))
+        if not checkpoint:
+            return None
+        return (
+            parse_datetime(checkpoint[b'created_at'].decode()),
+            int(checkpoint[b'id']),
+        )
+
+    @classmethod
+    def save_fanout_checkpoint(cls, tweet_id, cursor):
+        created_at, friendship_id = cursor
+        key = FANOUT_CHECKPOINT_PATTERN.format(tweet_id=tweet_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.hset(key, mapping={
+            'created_at': created_at.isoformat(),
+            'id': friendship_id,
+        })
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
+
+    @classmethod
+    def clear_fanout_checkpoint(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        conn.delete(FANOUT_CHECKPOINT_PATTERN.format(tweet_id=tweet_id))
+
+    @classmethod
+    def on_login(cls, user_id):
+        # the first newsfeed request after login is likely to hit the cache
+        JobQueue.enqueue(prefetch_newsfeeds_task, user_id=user_id)
+
+    @classmethod
+    def on_follow(cls, user_id, followed_user_id):
+        JobQueue.enqueue(
+            backfill_newsfeeds_task,
+            user_id=user_id,
+            followed_user_id=followed_user_id,
+        )
+
+    @classmethod
+    def on_unfollow(cls, user_id, unfollowed_user_id):
+        JobQueue.enqueue(
+            purge_newsfeeds_task,
+            user_id=user_id,
+            unfollowed_user_id=unfollowed_user_id,
+        )
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_id, followed_user_id):
+        """
+        Add the recent tweets of the followed user to user's newsfeeds.
+        """
+        # the user may unfollow before the job runs
+        if not FriendshipService.has_followed(user_id, followed_user_id):
+            return
+        # tweets of pull mode users are pulled when reading
+        if cls.is_pull_mode_user(followed_user_id):
+            return
+        tweets = list(
+            TweetService.get_visible_tweets(followed_user_id)
+            .order_by('-created_at')[:settings.NEWSFEED_BACKFILL_LIMIT]
+        )
+        if not tweets:
+            return
+
+        # tweets already in newsfeeds are ignored by unique_together (user, tweet)
+        NewsFeed.objects.bulk_create(
+            [NewsFeed(user_id=user_id, tweet=tweet) for tweet in tweets],
+            ignore_conflicts=True,
+        )
+        # `created_at` is set to now by auto_now_add,
+        # use the time of the tweets to place them in timeline
+        newsfeeds = NewsFeed.objects.filter(user_id=user_id, tweet__in=tweets)
+        newsfeeds.update(created_at=Case(*[
+            When(tweet_id=tweet.id, then=Value(tweet.created_at))
+            for tweet in tweets
+        ]))
+        RedisHelper.merge_objects(
+            NEWSFEEDS_PATTERNN.format(user_id=user_id),
+            list(newsfeeds),
+            unique_key=lambda newsfeed: newsfeed.tweet_id,
+            serializer=NewsFeedEntrySerializer,
+        )
+
+    @classmethod
+    def purge_newsfeeds(cls, user_id, unfollowed_user_id):
+        """
+        Remove the tweets of the unfollowed user from user's newsfeeds.
+        """
+        # the user may follow again before the job runs
+        if FriendshipService.has_followed(user_id, unfollowed_user_id):
+            return
+        # delete in batches to avoid locking many rows in one statement
+        queryset = NewsFeed.objects.filter(
+            user_id=user_id,
+            tweet__user_id=unfollowed_user_id,
+        )
+        while True:
+            newsfeed_ids = list(
+                queryset.values_list('id', flat=True)[:settings.NEWSFEED_FANOUT_BATCH_SIZE]
+            )
+            if not newsfeed_ids:
+                break
+            NewsFeed.objects.filter(id__in=newsfeed_ids).delete()
+
+        def select_unfollowed(newsfeeds):
+            unfollowed_tweet_ids = set(Tweet.objects.filter(
+                id__in=[newsfeed.tweet_id for newsfeed in newsfeeds],
+                user_id=unfollowed_user_id,
+            ).values_list('id', flat=True))
+            return [
+                newsfeed
+                for newsfeed in newsfeeds
+                if newsfeed.tweet_id in unfollowed_tweet_ids
+            ]
+
+        RedisHelper.remove_objects(
+            NEWSFEEDS_PATTERNN.format(user_id=user_id),
+            select_unfollowed,
+            NewsFeedEntrySerializer,
+        )
+
+    @classmethod
+    def on_tweet_deleted(cls, tweet):
+        TweetService.delete_tweet(tweet)
+        JobQueue.enqueue(sweep_deleted_tweet_task, tweet_id=tweet.id)
+
+    @classmethod
+    def sweep_deleted_tweet(cls, tweet_id):
+        """
+        Remove the deleted tweet from cached lists and newsfeeds.
+        Newsfeeds tell which users may have the tweet in cache.
+        """
+        tweet = Tweet.objects.filter(id=tweet_id).first()
+        if tweet is None or not tweet.is_deleted:
+            return
+        TweetService.remove_tweet_from_cache(tweet)
+
+        queryset = NewsFeed.objects.filter(tweet_id=tweet_id).order_by('id')
+        while True:
+            newsfeeds = list(
+                queryset.only('id', 'user_id', 'tweet_id', 'created_at')
+                [:settings.NEWSFEED_FANOUT_BATCH_SIZE]
+            )
+            if not newsfeeds:
+                break
+            # the entries are found by value, no need to read the cached lists
+            RedisHelper.remove_entries([
+                (NEWSFEEDS_PATTERNN.format(user_id=newsfeed.user_id), newsfeed)
+                for newsfeed in newsfeeds
+            ], NewsFeedEntrySerializer)
+            NewsFeed.objects.filter(id__in=[newsfeed.id for newsfeed in newsfeeds]).delete()
+        TweetService.clear_expired_tombstones()
+
+    @classmethod
+    def _load_pull_mode_users(cls, conn):
+        """
+        The pull mode users are kept by UserProfile.is_pull_mode in DB,
+        the set in Redis is a cache of them.
+        """
+        if conn.exists(PULL_MODE_USERS_KEY):
+            return
+        # users having more followers than the limit since the set was cached
+        cls._set_pull_mode(FriendshipService.get_user_ids_with_followers_more_than(
+            settings.NEWSFEED_FANOUT_FOLLOWER_LIMIT,
+        ))
+        user_ids = UserProfile.objects.filter(
+            is_pull_mode=True,
+        ).values_list('user_id', flat=True)
+        # 0 is a placeholder to keep the set in cache when there is no such user
+        conn.sadd(PULL_MODE_USERS_KEY, 0, *user_ids)
+
+    @classmethod
+    def _set_pull_mode(cls, user_ids):
+        user_ids = set(user_ids) - set(
+            UserProfile.objects.filter(
+                user_id__in=user_ids,
+                is_pull_mode=True,
+            ).values_list('user_id', flat=True)
+        )
+        for user_id in user_ids:
+            # saved one by one, so that the cached profiles are updated
+            UserProfile.objects.update_or_create(
+                user_id=user_id,
+                defaults={'is_pull_mode': True},
+            )
+
+    @classmethod
+    def is_pull_mode_user(cls, user_id):
+        """
+        A user switches to pull mode when having more followers than the limit.
+        Users stay in pull mode even if followers decrease later,
+        otherwise the tweets posted in pull mode would be missing in newsfeeds.
+        """
+        conn = RedisClient.get_connection()
+        cls._load_pull_mode_users(conn)
+        if conn.sismember(PULL_MODE_USERS_KEY, user_id):
+            return True
+        follower_count = FriendshipService.get_follower_count(user_id)
+        if follower_count <= settings.NEWSFEED_FANOUT_FOLLOWER_LIMIT:
+            return False
+        # kept in DB first, the cached set may be lost at any time
+        cls._set_pull_mode([user_id])
+        conn.sadd(PULL_MODE_USERS_KEY, user_id)
+        return True
+
+    @classmethod
+    def get_pull_mode_following_ids(cls, user_id):
+        conn = RedisClient.get_connection()
+        cls._load_pull_mode_users(conn)
+        pull_mode_user_ids = {
+            int(pull_mode_user_id)
+            for pull_mode_user_id in conn.smembers(PULL_MODE_USERS_KEY)
+        }
+        following_user_ids = FriendshipService.get_following_user_id_set(user_id)
+        return sorted(pull_mode_user_ids & following_user_ids)
+
+    @classmethod
+    def tweets_to_newsfeeds(cls, user_id, objects):
+        """
+        Wrap the pulled tweets as unsaved newsfeeds, so that they can be
+        rendered like the pushed newsfeeds. Their id is the negated tweet id,
+        it is stable across pages and never collides with a saved newsfeed.
+        """
+        return [
+            NewsFeed(id=-obj.id, user_id=user_id, tweet=obj, created_at=obj.created_at)
+            if isinstance(obj, Tweet) else obj
+            for obj in objects
+        ]
+
+    @classmethod
+    def get_visible_newsfeeds(cls, user_id):
+        return NewsFeed.objects.filter(user_id=user_id, tweet__is_deleted=False)
 
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
-        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        queryset = cls.get_visible_newsfeeds(user_id).order_by('-created_at')
         key = NEWSFEEDS_PATTERNN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        newsfeeds = RedisHelper.load_objects(key, queryset, NewsFeedEntrySerializer)
+        return cls.fill_tweets(newsfeeds)
+
+    @classmethod
+    def get_cached_newsfeed_window(cls, user_id, **window):
+        """
+        Only read the window of the cached newsfeeds wanted by a page,
+        see `RedisHelper.load_objects_in_window()` for the window arguments.
+        Return the newsfeeds and whether there is no more newsfeed after them.
+        """
+        queryset = cls.get_visible_newsfeeds(user_id).order_by('-created_at')
+        key = NEWSFEEDS_PATTERNN.format(user_id=user_id)
+        newsfeeds, is_complete = RedisHelper.load_objects_in_window(
+            key,
+            queryset,
+            NewsFeedEntrySerializer,
+            **window,
+        )
+        return cls.fill_tweets(newsfeeds), is_complete
+
+    @classmethod
+    def warm_up_cache(cls, user_id):
+        """
+        Load the cached newsfeeds and tweets of the user from DB if they are
+        not cached. Return the number of timelines loaded from DB.
+        """
+        queryset = cls.get_visible_newsfeeds(user_id).order_by('-created_at')
+        key = NEWSFEEDS_PATTERNN.format(user_id=user_id)
+        loaded = RedisHelper.warm_up(key, queryset, NewsFeedEntrySerializer)
+        return int(loaded) + int(TweetService.warm_up_cache(user_id))
+
+    @classmethod
+    def prefetch_newsfeeds(cls, user_id):
+        """
+        Read the first page of newsfeeds as the newsfeed list API does,
+        so that the timelines and the tweets in Memcached are cached.
+        """
+        pull_user_ids = cls.get_pull_mode_following_ids(user_id)
+        cls.get_cached_newsfeeds_with_pulled_tweets(
+            user_id,
+            pull_user_ids,
+            count=EndlessPagination.page_size + 1,
+        )
+
+    @classmethod
+    def fill_tweets(cls, newsfeeds):
+        """
+        Set the tweets of newsfeeds from Memcached in one round trip
+        instead of querying the tweet of each newsfeed from DB.
+        Newsfeeds whose tweets are no longer in DB are dropped.
+        """
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        filled_newsfeeds = []
+        for newsfeed in newsfeeds:
+            if newsfeed.tweet_id not in tweets:
+                continue
+            newsfeed.tweet = tweets[newsfeed.tweet_id]
+            filled_newsfeeds.append(newsfeed)
+        return filled_newsfeeds
+
+    @classmethod
+    def get_cached_newsfeeds_with_pulled_tweets(cls, user_id, pull_user_ids, **window):
+        """
+        Merge the window of cached newsfeeds with the windows of cached tweets
+        of pull mode users, and filter out the deleted tweets.
+        Return the merged list and whether there is no more data after it.
+        """
+        windows = [cls.get_cached_newsfeed_window(user_id, **window)]
+        for pull_user_id in pull_user_ids:
+            tweets, is_complete = TweetService.get_cached_tweet_window(pull_user_id, **window)
+            windows.append((cls.tweets_to_newsfeeds(user_id, tweets), is_complete))
+        cached_lists = [cached_list for cached_list, _ in windows]
+
+        truncated_at = None
+        if window.get('created_at__gt') is not None:
+            # a refresh window holds all the newer data or is not usable,
+            # the caller falls back to DB for the latter
+            is_complete = all(is_complete for _, is_complete in windows)
+        else:
+            # A window with more data after it only holds the data newer than
+            # its last object, so the merged list is reliable only down to the
+            # newest of these objects.
+            truncated_ats = [
+                cached_list[-1].created_at if cached_list else None
+                for cached_list, is_complete in windows
+                if not is_complete
+            ]
+            # nothing is reliable if such a window is empty
+            if None in truncated_ats:
+                return [], False
+            truncated_at = max(truncated_ats, default=None)
+            is_complete = truncated_at is None
+
+        merged_list = []
+        # a tweet is both pushed and pulled if it was posted before pull mode
+        seen_tweet_ids = set()
+        for newsfeed in heapq.merge(
+            *cached_lists,
+            key=lambda obj: obj.created_at,
+            reverse=True,
+        ):
+            if truncated_at is not None and newsfeed.created_at < truncated_at:
+                break
+            if newsfeed.tweet_id in seen_tweet_ids:
+                continue
+            seen_tweet_ids.add(newsfeed.tweet_id)
+            merged_list.append(newsfeed)
+
+        # filter after merging, so that the truncation is decided by the cached lists
+        deleted_tweet_ids = TweetService.get_deleted_tweet_ids(list(seen_tweet_ids))
+        merged_list = [
+            newsfeed
+            for newsfeed in merged_list
+            if newsfeed.tweet_id not in deleted_tweet_ids
+        ]
+        return merged_list, is_complete
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
+        queryset = cls.get_visible_newsfeeds(newsfeed.user_id).order_by('-created_at')
         key = NEWSFEEDS_PATTERNN.format(user_id=newsfeed.user_id)
-        return RedisHelper.push_object(key, newsfeed, queryset)
\ No newline at end of file
+        return RedisHelper.push_object(key, newsfeed, queryset, NewsFeedEntrySerializer)
+
+    @classmethod
+    def push_newsfeeds_to_active_users(cls, newsfeeds):
+        """
+        Only push newsfeeds to the users seen recently.
+        The cached newsfeeds of inactive users are deleted rather than updated,
+        they will be loaded from DB when the users come back.
+        """
+        active_user_ids = UserService.get_active_user_ids(
+            [newsfeed.user_id for newsfeed in newsfeeds],
+            settings.NEWSFEED_FANOUT_ACTIVE_WINDOW,
+        )
+        active_newsfeeds, inactive_newsfeeds = [], []
+        for newsfeed in newsfeeds:
+            if newsfeed.user_id in active_user_ids:
+                active_newsfeeds.append(newsfeed)
+            else:
+                inactive_newsfeeds.append(newsfeed)
+
+        pushed = cls.push_newsfeeds_to_cache(active_newsfeeds)
+        invalidated = RedisHelper.delete_keys([
+            NEWSFEEDS_PATTERNN.format(user_id=newsfeed.user_id)
+            for newsfeed in inactive_newsfeeds
+        ])
+        skipped_bytes = 0
+        if inactive_newsfeeds:
+            # newsfeeds of a tweet are serialized to the same size
+            serialized_size = len(NewsFeedEntrySerializer.serialize(inactive_newsfeeds[0]))
+            skipped_bytes = serialized_size * len(inactive_newsfeeds)
+        cls.incr_fanout_stats(
+            pushed=pushed,
+            skipped=len(inactive_newsfeeds),
+            skipped_bytes=skipped_bytes,
+            invalidated=invalidated,
+        )
+
+    @classmethod
+    def incr_fanout_stats(cls, **counters):
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for name, value in counters.items():
+            pipeline.hincrby(FANOUT_STATS_KEY, name, value)
+        pipeline.execute()
+
+    @classmethod
+    def get_fanout_stats(cls):
+        """
+        - pushed: newsfeeds pushed to cached lists
+        - skipped / skipped_bytes: newsfeeds not written to Redis for inactive users
+        - invalidated: cached lists of inactive users deleted,
+          their memory is estimated offline by sample_cache_memory
+        """
+        conn = RedisClient.get_connection()
+        return {
+            name.decode(): int(value)
+            for name, value in conn.hgetall(FANOUT_STATS_KEY).items()
+        }
+
+    @classmethod
+    def reset_fanout_stats(cls):
+        conn = RedisClient.get_connection()
+        conn.delete(FANOUT_STATS_KEY)
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        # push in batch, the lists not in cache will be loaded when reading
+        return RedisHelper.push_objects([
+            (NEWSFEEDS_PATTERNN.format(user_id=newsfeed.user_id), newsfeed)
+            for newsfeed in newsfeeds
+        ], NewsFeedEntrySerializer)
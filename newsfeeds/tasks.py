@@ -0,0 +1,35 @@
+"""
+Asynchronous tasks of newsfeeds, executed by `python manage.py run_job_worker`.
+"""
+from utils.job_queue import JobQueue
+
+
+@JobQueue.register
+def fanout_newsfeeds_task(tweet_id):
+    # import written inside the function to prevent reference loops
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.fanout_to_followers_sync(tweet_id)
+
+
+@JobQueue.register
+def backfill_newsfeeds_task(user_id, followed_user_id):
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.backfill_newsfeeds(user_id, followed_user_id)
+
+
+@JobQueue.register
+def purge_newsfeeds_task(user_id, unfollowed_user_id):
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.purge_newsfeeds(user_id, unfollowed_user_id)
+
+
+@JobQueue.register
+def sweep_deleted_tweet_task(tweet_id):
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.sweep_deleted_tweet(tweet_id)
+
+
+@JobQueue.register
+def prefetch_newsfeeds_task(user_id):
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.prefetch_newsfeeds(user_id)
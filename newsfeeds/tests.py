@@ -1,7 +1,17 @@
-from newsfeeds.services import NewsFeedService
+from django.test import override_settings
+from friendships.models import Friendship
+from newsfeeds.api.serializers import NewsFeedSerializer
+from newsfeeds.models import NewsFeed
+from rest_framework.test import APIRequestFactory
+from accounts.services import UserService
+from newsfeeds.services import NewsFeedEntrySerializer, NewsFeedService
+from utils.job_queue import JobQueue
 from utils.testcases import TestCase
-from twitter.cache import NEWSFEEDS_PATTERNN
+from twitter.cache import NEWSFEEDS_PATTERNN, USER_LAST_SEEN_KEY
 from utils.cache.redis_client import RedisClient
+from utils.cache.redis_serializers import CachedEntry
+
+import time
 
 
 class NewsFeedServiceTests(TestCase):
@@ -46,4 +56,210 @@ class NewsFeedServiceTests(TestCase):
         self.assertEqual(conn.exists(key), True)
 
         feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
-        self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
\ No newline at end of file
+        self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
+
+    def test_newsfeed_entry_codecs(self):
+        conn = RedisClient.get_connection()
+        key = NEWSFEEDS_PATTERNN.format(user_id=self.user1.id)
+        newsfeeds = [
+            self.create_newsfeed(self.user1, self.create_tweet(self.user2))
+            for _ in range(2)
+        ]
+        for codec in ['json', 'struct']:
+            with override_settings(REDIS_ENTRY_CODEC=codec):
+                newsfeed = NewsFeedEntrySerializer.deserialize(
+                    NewsFeedEntrySerializer.serialize(newsfeeds[0]),
+                )
+                self.assertEqual(newsfeed.id, newsfeeds[0].id)
+                self.assertEqual(newsfeed.tweet_id, newsfeeds[0].tweet_id)
+                self.assertEqual(newsfeed.created_at, newsfeeds[0].created_at)
+                # null values are kept
+                newsfeed = NewsFeedEntrySerializer.deserialize(
+                    NewsFeedEntrySerializer.serialize(NewsFeed(
+                        id=newsfeeds[0].id,
+                        user_id=self.user1.id,
+                        created_at=newsfeeds[0].created_at,
+                    )),
+                )
+                self.assertEqual(newsfeed.tweet_id, None)
+
+        # a list written by both codecs is readable
+        conn.delete(key)
+        with override_settings(REDIS_ENTRY_CODEC='json'):
+            conn.rpush(key, NewsFeedEntrySerializer.serialize(newsfeeds[1]))
+        conn.rpush(key, NewsFeedEntrySerializer.serialize(newsfeeds[0]))
+        feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
+        self.assertEqual([f.id for f in feeds], [newsfeeds[1].id, newsfeeds[0].id])
+
+        # a list written by another schema version is loaded again
+        NewsFeedEntrySerializer.schema_version += 1
+        try:
+            feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
+            self.assertEqual([f.id for f in feeds], [newsfeeds[1].id, newsfeeds[0].id])
+            self.assertEqual(
+                NewsFeedEntrySerializer.deserialize(conn.lindex(key, 0)).id,
+                newsfeeds[1].id,
+            )
+        finally:
+            NewsFeedEntrySerializer.schema_version -= 1
+
+    def test_cached_entries(self):
+        tweet = self.create_tweet(self.user2)
+        newsfeed = self.create_newsfeed(self.user1, tweet)
+        entry = NewsFeedEntrySerializer.deserialize(NewsFeedEntrySerializer.serialize(newsfeed))
+        self.assertEqual(isinstance(entry, CachedEntry), True)
+        self.assertEqual(
+            (entry.pk, entry.user_id, entry.tweet_id, entry.created_at),
+            (newsfeed.id, self.user1.id, tweet.id, newsfeed.created_at),
+        )
+        # fields are read-only, related objects can be filled
+        with self.assertRaises(AttributeError):
+            entry.tweet_id = None
+        with self.assertRaises(AttributeError):
+            entry.tweet
+        entry.tweet = tweet
+        self.assertEqual(entry.to_model().created_at, newsfeed.created_at)
+
+        request = APIRequestFactory().get('/api/newsfeeds/')
+        request.user = self.user1
+        data = NewsFeedSerializer(entry, context={'request': request}).data
+        self.assertEqual(data['id'], newsfeed.id)
+        self.assertEqual(data['user'], self.user1.id)
+        self.assertEqual(data['tweet']['id'], tweet.id)
+
+    @override_settings(JOB_QUEUE_ALWAYS_EAGER=False)
+    def test_fanout_to_followers_async(self):
+        self.create_friendship(self.user2, self.user1)
+        tweet = self.create_tweet(self.user1)
+        NewsFeedService.fanout_to_followers(tweet)
+
+        # user's own newsfeed is written synchronously
+        self.assertEqual(NewsFeed.objects.filter(user=self.user1).count(), 1)
+        feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+        # followers get the newsfeed after the job is done
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 0)
+        self.assertEqual(JobQueue.run_next_job(timeout=1), True)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 1)
+        feeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+
+    def test_resume_fanout_from_checkpoint(self):
+        conn = RedisClient.get_connection()
+        followers = [self.create_user('follower{}'.format(i)) for i in range(5)]
+        for follower in followers:
+            self.create_friendship(follower, self.user1)
+            UserService.touch_last_seen(follower.id)
+            NewsFeedService.get_cached_newsfeeds(follower.id)
+        tweet = self.create_tweet(self.user1)
+
+        # a worker delivered the first batch (batch size is 2 in testing),
+        # then crashed after inserting the first newsfeed of the second batch
+        for follower in followers[:3]:
+            self.create_newsfeed(follower, tweet)
+        friendship = Friendship.objects.get(from_user=followers[1], to_user=self.user1)
+        NewsFeedService.save_fanout_checkpoint(
+            tweet.id,
+            (friendship.created_at, friendship.id),
+        )
+        checkpoint = NewsFeedService.get_fanout_checkpoint(tweet.id)
+        self.assertEqual(checkpoint, (friendship.created_at, friendship.id))
+
+        # the retry neither fails on the unique constraint nor redoes the first batch
+        NewsFeedService.fanout_to_followers_sync(tweet.id)
+        for follower in followers:
+            self.assertEqual(NewsFeed.objects.filter(user=follower, tweet=tweet).count(), 1)
+        self.assertEqual(NewsFeedService.get_fanout_checkpoint(tweet.id), None)
+
+        def cached_tweet_ids(user):
+            key = NEWSFEEDS_PATTERNN.format(user_id=user.id)
+            return conn.lrange(key, 0, -1) if conn.exists(key) else None
+
+        # first batch was pushed by the crashed worker, it is not pushed again
+        self.assertEqual(len(cached_tweet_ids(followers[0])), 1)
+        # the partially delivered newsfeed is loaded from DB on next read
+        self.assertEqual(cached_tweet_ids(followers[2]), None)
+        feeds = NewsFeedService.get_cached_newsfeeds(followers[2].id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+        for follower in followers[3:]:
+            feeds = NewsFeedService.get_cached_newsfeeds(follower.id)
+            self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+            self.assertEqual(feeds[0].id is not None, True)
+
+    def test_skip_inactive_followers(self):
+        conn = RedisClient.get_connection()
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user2, self.user1)
+        self.create_friendship(user3, self.user1)
+        # both followers have newsfeeds in cache
+        for user in [self.user2, user3]:
+            self.create_newsfeed(user, self.create_tweet(self.user2))
+            NewsFeedService.get_cached_newsfeeds(user.id)
+        user2_key = NEWSFEEDS_PATTERNN.format(user_id=self.user2.id)
+        user3_key = NEWSFEEDS_PATTERNN.format(user_id=user3.id)
+        self.assertEqual(conn.exists(user3_key), True)
+
+        # only user2 is active
+        UserService.touch_last_seen(self.user2.id)
+        tweet = self.create_tweet(self.user1)
+        NewsFeedService.fanout_to_followers(tweet)
+
+        self.assertEqual(conn.llen(user2_key), 2)
+        self.assertEqual(conn.exists(user3_key), False)
+        stats = NewsFeedService.get_fanout_stats()
+        self.assertEqual(stats['pushed'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['invalidated'], 1)
+        self.assertEqual(stats['skipped_bytes'] > 0, True)
+
+        # newsfeeds of the inactive follower are loaded from DB
+        feeds = NewsFeedService.get_cached_newsfeeds(user3.id)
+        self.assertEqual(feeds[0].tweet_id, tweet.id)
+        self.assertEqual(len(feeds), 2)
+
+        NewsFeedService.reset_fanout_stats()
+        self.assertEqual(NewsFeedService.get_fanout_stats(), {})
+
+    @override_settings(USER_LAST_SEEN_RETENTION=60)
+    def test_clear_expired_last_seen(self):
+        conn = RedisClient.get_connection()
+        UserService.touch_last_seen(self.user1.id)
+        # user2 was seen before the retention
+        conn.zadd(USER_LAST_SEEN_KEY, {self.user2.id: time.time() - 61})
+
+        # swept after a fanout
+        NewsFeedService.fanout_to_followers(self.create_tweet(self.user1))
+        self.assertEqual(conn.zcard(USER_LAST_SEEN_KEY), 1)
+        self.assertEqual(conn.zscore(USER_LAST_SEEN_KEY, self.user1.id) is not None, True)
+        self.assertEqual(UserService.get_active_user_ids([self.user1.id, self.user2.id], 60), {self.user1.id})
+
+    def test_warm_up_cache(self):
+        conn = RedisClient.get_connection()
+        self.create_friendship(self.user1, self.user2)
+        tweet = self.create_tweet(self.user2)
+        for user in [self.user1, self.user2]:
+            self.create_newsfeed(user, tweet)
+        RedisClient.clear()
+
+        # newsfeeds and tweets of user2 are loaded
+        self.assertEqual(NewsFeedService.warm_up_cache(self.user2.id), 2)
+        self.assertEqual(NewsFeedService.warm_up_cache(self.user2.id), 0)
+        # empty timelines are not cached
+        self.assertEqual(NewsFeedService.warm_up_cache(self.user1.id), 2)
+        self.assertEqual(NewsFeedService.warm_up_cache(self.user1.id), 1)
+        self.assertEqual(conn.exists(NEWSFEEDS_PATTERNN.format(user_id=self.user1.id)), True)
+
+        # the first page is prefetched, including the tweets in Memcached
+        RedisClient.clear()
+        self.clear_cache()
+        NewsFeedService.prefetch_newsfeeds(self.user1.id)
+        self.assertEqual(conn.exists(NEWSFEEDS_PATTERNN.format(user_id=self.user1.id)), True)
+        with self.assertNumQueries(0):
+            NewsFeedService.get_cached_newsfeed_window(self.user1.id, count=1)
+
+        self.assertEqual(
+            UserService.get_recently_active_user_ids(10),
+            [],
+        )
+        UserService.touch_last_seen(self.user1.id)
+        self.assertEqual(UserService.get_recently_active_user_ids(10), [self.user1.id])
@@ -7,6 +7,8 @@ from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
 from tweets.constants import TWEET_PHOTS_UPLOAD_LIMIT
 from tweets.services import TweetService
+from utils.counters import CounterService
+from utils.serializers import PrefetchThroughCacheListSerializer
 
 
 class TweetSerializer(serializers.ModelSerializer):
@@ -29,12 +31,15 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchThroughCacheListSerializer
+        prefetch_through_cache = ('user',)
+        prefetch_counts = ('likes_count', 'comments_count')
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        return CounterService.get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return obj.comment_set.count()
+        return CounterService.get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj):
         return LikeService.has_liked(self.context['request'].user, obj)
@@ -126,5 +131,6 @@ class TweetSerializerForUpdate(serializers.ModelSerializer):
 
     def update(self, instance, validated_data):
         instance.content = validated_data['content']
-        instance.save()
+        # the counters are changed by F() expressions, do not write them back
+        instance.save(update_fields=['content', 'updated_at'])
         return instance
\ No newline at end of file
@@ -117,6 +117,19 @@ class TweetApiTests(TestCase):
         self.assertEqual(tweet.is_deleted, True)
         self.assertEqual(Tweet.objects.count(), count)
 
+        # deleted tweet is not listed
+        response = self.anonymous_client.get(TWEET_LIST_URL, {'user_id': self.user2.id})
+        self.assertEqual(
+            [result['id'] for result in response.data['results']],
+            [self.tweets2[1].id],
+        )
+        self.clear_cache()
+        response = self.anonymous_client.get(TWEET_LIST_URL, {'user_id': self.user2.id})
+        self.assertEqual(
+            [result['id'] for result in response.data['results']],
+            [self.tweets2[1].id],
+        )
+
     def test_retrieve_tweet(self):
         tweet = self.tweets1[0]
         # test retrieve a non-exist tweet
@@ -57,10 +57,14 @@ class TweetViewSet(mixins.CreateModelMixin,
     @required_params(params=['user_id'])
     def list(self, request):
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        # only the cached tweets of the page are read
+        cached_tweets, is_complete = TweetService.get_cached_tweets_without_deleted(
+            user_id,
+            **self.paginator.get_cache_window(request),
+        )
+        page = self.paginator.paginate_cached_list(cached_tweets, request, is_complete)
         if page is None:
-            queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+            queryset = TweetService.get_visible_tweets(user_id).order_by('-created_at')
             page = self.paginate_queryset(queryset)
         serializer = TweetSerializer(
             page,
@@ -106,6 +110,7 @@ class TweetViewSet(mixins.CreateModelMixin,
 
     def destroy(self, request, *args, **kwargs):
         tweet = self.get_object()
-        tweet.is_deleted = True
-        tweet.save()
+        # the tweet is filtered out when reading,
+        # and removed from cached lists and newsfeeds asynchronously
+        NewsFeedService.on_tweet_deleted(tweet)
         return Response({'success': True}, status=status.HTTP_200_OK)
\ No newline at end of file
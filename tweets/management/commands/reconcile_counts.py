@@ -0,0 +1,98 @@
+from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from likes.models import Like
+from tweets.models import Tweet
+from utils.counters import CounterService
+
+
+def count_likes(model_class):
+    return Like.objects.filter(
+        content_type=ContentType.objects.get_for_model(model_class),
+        object_id=OuterRef('id'),
+    ).order_by().values('object_id').annotate(count=Count('id')).values('count')
+
+
+def count_comments(model_class):
+    return Comment.objects.filter(
+        tweet_id=OuterRef('id'),
+    ).order_by().values('tweet_id').annotate(count=Count('id')).values('count')
+
+
+# model, counter, the subquery counting the rows of the counter
+COUNTERS = (
+    (Tweet, 'likes_count', count_likes),
+    (Tweet, 'comments_count', count_comments),
+    (Comment, 'likes_count', count_likes),
+)
+
+
+class Command(BaseCommand):
+    help = 'Recount the denormalized likes_count and comments_count, fix the ' \
+           'counters drifted from the rows and drop their mirrors in Redis. ' \
+           'Run it periodically, e.g. hourly by cron, and once after migrating.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of objects recounted per query.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report the drifted counters without fixing them.',
+        )
+
+    def handle(self, *args, **options):
+        for model_class, attr, count_rows in COUNTERS:
+            checked, drifted = self.reconcile(
+                model_class,
+                attr,
+                count_rows(model_class),
+                options['batch_size'],
+                options['dry_run'],
+            )
+            self.stdout.write('{}.{}: {} checked, {} drifted{}'.format(
+                model_class.__name__,
+                attr,
+                checked,
+                drifted,
+                ' (dry run)' if options['dry_run'] else '',
+            ))
+
+    def reconcile(self, model_class, attr, count_query, batch_size, dry_run):
+        # count the rows and read the counter in the same query
+        actual_count = Coalesce(Subquery(count_query, output_field=IntegerField()), 0)
+        checked = drifted = 0
+        last_id = 0
+        while True:
+            # paginate by id instead of offset, so each batch is an index range scan
+            batch = list(
+                model_class.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .annotate(actual_count=actual_count)
+                .values_list('id', attr, 'actual_count')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            checked += len(batch)
+            fixed_ids = []
+            for object_id, count, actual in batch:
+                if count == actual:
+                    continue
+                drifted += 1
+                if dry_run:
+                    continue
+                # by delta, so an update committed since the read is kept
+                model_class.objects.filter(id=object_id).update(
+                    **{attr: Coalesce(F(attr), 0) + (actual - (count or 0))},
+                )
+                fixed_ids.append(object_id)
+            if fixed_ids:
+                CounterService.invalidate_counts(model_class, fixed_ids)
+        return checked, drifted
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2022-01-20 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweets', '0004_tweetphoto'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweet',
+            name='comments_count',
+            field=models.IntegerField(default=0, null=True),
+        ),
+        migrations.AddField(
+            model_name='tweet',
+            name='likes_count',
+            field=models.IntegerField(default=0, null=True),
+        ),
+    ]
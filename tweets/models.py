@@ -6,7 +6,7 @@ from likes.models import Like
 from tweets.constants import TWEET_PHOTO_STATUS_CHOICES, TweetPhotoStatus
 from tweets.listeners import push_tweet_to_cache
 from utils.cache.memcached_helper import MemcachedHelper
-from utils.listeners import invalidate_object_cache
+from utils.listeners import invalidate_object_cache, update_object_cache
 from django.db.models.signals import post_save, pre_delete
 
 import pytz
@@ -19,6 +19,9 @@ class Tweet(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_deleted = models.BooleanField(default=False)
+    # denormalized counters, see utils/counters.py
+    likes_count = models.IntegerField(default=0, null=True)
+    comments_count = models.IntegerField(default=0, null=True)
 
     class Meta:
         # use Composite Index for faster search
@@ -52,7 +55,7 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.user_id)
+        return MemcachedHelper.get_related_object_through_cache(self, 'user')
 
 
 class TweetPhoto(models.Model):
@@ -87,7 +90,7 @@ class TweetPhoto(models.Model):
         return f'{self.tweet.id}: {self.file}'
 
 # For memcached
-post_save.connect(invalidate_object_cache, sender=Tweet)
+post_save.connect(update_object_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
 # For redis
 post_save.connect(push_tweet_to_cache, sender=Tweet)
\ No newline at end of file
@@ -1,6 +1,18 @@
+from django.conf import settings
 from tweets.models import Tweet, TweetPhoto
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import USER_TWEETS_PATTERN, DELETED_TWEETS_KEY
+from utils.cache.memcached_helper import MemcachedHelper
+from utils.cache.redis_client import RedisClient
 from utils.cache.redis_helper import RedisHelper
+from utils.cache.redis_serializers import CachedEntry, ModelEntrySerializer
+
+import time
+
+
+class TweetEntrySerializer(ModelEntrySerializer):
+    # tweet bodies are cached in Memcached, shared by all the timelines
+    model_class = Tweet
+    field_names = ('id', 'created_at')
 
 
 class TweetService:
@@ -21,16 +33,119 @@ class TweetService:
     @classmethod
     def get_cached_tweets(cls, user_id):
         """
-        To be continued:
-        Cache tweet_id in Redis and tweet data (content, ts...) to Memcached.
-        This will be useful for supporting `Edit Tweet` function
+        Redis only caches tweet ids and created_at,
+        tweet data (content, ts...) is cached in Memcached,
+        so an edited tweet is up-to-date in every timeline.
         """
-        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        queryset = cls.get_visible_tweets(user_id).order_by('-created_at')
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        tweets = RedisHelper.load_objects(key, queryset, TweetEntrySerializer)
+        return cls.fill_tweets(tweets)
+
+    @classmethod
+    def get_cached_tweet_window(cls, user_id, **window):
+        """
+        Only read the window of the cached tweets wanted by a page,
+        see `RedisHelper.load_objects_in_window()` for the window arguments.
+        Return the tweets and whether there is no more tweet after them.
+        """
+        queryset = cls.get_visible_tweets(user_id).order_by('-created_at')
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        tweets, is_complete = RedisHelper.load_objects_in_window(
+            key,
+            queryset,
+            TweetEntrySerializer,
+            **window,
+        )
+        return cls.fill_tweets(tweets), is_complete
+
+    @classmethod
+    def warm_up_cache(cls, user_id):
+        queryset = cls.get_visible_tweets(user_id).order_by('-created_at')
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return RedisHelper.warm_up(key, queryset, TweetEntrySerializer)
+
+    @classmethod
+    def fill_tweets(cls, tweets):
+        """
+        Replace the cached entries (loaded from Redis) by the full tweets
+        in Memcached, fetched in one round trip.
+        Tweets no longer in DB are dropped.
+        """
+        tweet_ids = [tweet.id for tweet in tweets if isinstance(tweet, CachedEntry)]
+        if not tweet_ids:
+            return tweets
+        full_tweets = MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+        filled_tweets = []
+        for tweet in tweets:
+            if isinstance(tweet, CachedEntry):
+                tweet = full_tweets.get(tweet.id)
+            if tweet is not None:
+                filled_tweets.append(tweet)
+        return filled_tweets
+
+    @classmethod
+    def get_cached_tweets_without_deleted(cls, user_id, **window):
+        """
+        Return the cached tweets in the window except the deleted ones,
+        and whether there is no more tweet after the window.
+        """
+        # deleted tweets still take places in the list, so the completeness
+        # is decided before filtering
+        tweets, is_complete = cls.get_cached_tweet_window(user_id, **window)
+        deleted_tweet_ids = cls.get_deleted_tweet_ids([tweet.id for tweet in tweets])
+        return [tweet for tweet in tweets if tweet.id not in deleted_tweet_ids], is_complete
+
+    @classmethod
+    def get_visible_tweets(cls, user_id):
+        return Tweet.objects.filter(user_id=user_id, is_deleted=False)
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
-        queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
+        queryset = cls.get_visible_tweets(tweet.user_id).order_by('-created_at')
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, queryset)
\ No newline at end of file
+        RedisHelper.push_object(key, tweet, queryset, TweetEntrySerializer)
+
+    @classmethod
+    def delete_tweet(cls, tweet):
+        """
+        Soft delete the tweet and leave a tombstone in Redis.
+        Cached lists may still hold the tweet until they are swept,
+        readers check the tombstones to filter it out.
+        """
+        tweet.is_deleted = True
+        # the counters are changed by F() expressions, do not write them back
+        tweet.save(update_fields=['is_deleted', 'updated_at'])
+        conn = RedisClient.get_connection()
+        conn.zadd(DELETED_TWEETS_KEY, {tweet.id: time.time()})
+
+    @classmethod
+    def get_deleted_tweet_ids(cls, tweet_ids):
+        if not tweet_ids:
+            return set()
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for tweet_id in tweet_ids:
+            pipeline.zscore(DELETED_TWEETS_KEY, tweet_id)
+        return {
+            tweet_id
+            for tweet_id, deleted_at in zip(tweet_ids, pipeline.execute())
+            if deleted_at is not None
+        }
+
+    @classmethod
+    def remove_tweet_from_cache(cls, tweet):
+        RedisHelper.remove_entries(
+            [(USER_TWEETS_PATTERN.format(user_id=tweet.user_id), tweet)],
+            TweetEntrySerializer,
+        )
+
+    @classmethod
+    def clear_expired_tombstones(cls):
+        """
+        Cached lists expire in REDIS_KEY_EXPIRE_TIME,
+        tombstones older than that are no longer needed.
+        """
+        conn = RedisClient.get_connection()
+        expired_at = time.time() - settings.REDIS_KEY_EXPIRE_TIME
+        conn.zremrangebyscore(DELETED_TWEETS_KEY, '-inf', expired_at)
\ No newline at end of file
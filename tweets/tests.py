@@ -1,10 +1,11 @@
 from utils.testcases import TestCase
 from datetime import datetime, timedelta
-from tweets.models import TweetPhoto
+from tweets.api.serializers import TweetSerializerForUpdate
+from tweets.models import Tweet, TweetPhoto
 from tweets.constants import TweetPhotoStatus
 from utils.cache.redis_client import RedisClient
 from utils.cache.redis_serializers import DjangoModelSerializer
-from tweets.services import TweetService
+from tweets.services import TweetEntrySerializer, TweetService
 from twitter.cache import USER_TWEETS_PATTERN
 
 import pytz
@@ -33,6 +34,20 @@ class TweetModelTests(TestCase):
         self.create_like(self.user1, self.tweet)
         self.assertEqual(self.tweet.like_set.count(), 2)
 
+    def test_edit_and_delete_keep_counters(self):
+        # the tweet is read before it is liked and commented
+        tweet = Tweet.objects.get(id=self.tweet.id)
+        self.create_like(self.user2, self.tweet)
+        self.create_comment(self.user2, self.tweet)
+
+        serializer = TweetSerializerForUpdate(instance=tweet, data={'content': 'edited tweet'})
+        self.assertEqual(serializer.is_valid(), True)
+        serializer.save()
+        TweetService.delete_tweet(tweet)
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.content, tweet.is_deleted), ('edited tweet', True))
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (1, 1))
+
     def test_create_photo(self):
         photo = TweetPhoto.objects.create(
             tweet=self.tweet,
@@ -76,4 +91,28 @@ class TweetModelTests(TestCase):
         new_tweet = self.create_tweet(self.user1, 'new tweet')
         tweets = TweetService.get_cached_tweets(self.user1.id)
         tweet_ids.insert(0, new_tweet.id)
-        self.assertEqual([t.id for t in tweets][:4], tweet_ids)
\ No newline at end of file
+        self.assertEqual([t.id for t in tweets][:4], tweet_ids)
+
+    def test_cache_tweet_ids_only(self):
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        TweetService.get_cached_tweets(self.user1.id)
+        key = USER_TWEETS_PATTERN.format(user_id=self.user1.id)
+        # Redis keeps the id and created_at, not the content
+        entry = conn.lrange(key, 0, -1)[0]
+        self.assertEqual(b'test tweet model' in entry, False)
+        tweet = TweetEntrySerializer.deserialize(entry)
+        self.assertEqual(tweet.id, self.tweet.id)
+        self.assertEqual(tweet.created_at, self.tweet.created_at)
+
+        # the edited content is seen from the cached list
+        self.tweet.content = 'edited tweet'
+        self.tweet.save()
+        tweets = TweetService.get_cached_tweets(self.user1.id)
+        self.assertEqual(tweets[0].content, 'edited tweet')
+
+        # entries written in the old format are still readable
+        conn.delete(key)
+        conn.rpush(key, DjangoModelSerializer.serialize(self.tweet))
+        tweets = TweetService.get_cached_tweets(self.user1.id)
+        self.assertEqual([t.id for t in tweets], [self.tweet.id])
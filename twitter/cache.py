@@ -2,7 +2,45 @@
 FOLLOWINGS_PATTERN = 'followings_{user_id}'
 USER_PATTERN = 'user_{user_id}'
 USER_PROFILE_PATTERN = 'userprofile_{user_id}'
+# objects cached by MemcachedHelper
+OBJECT_PATTERN = '{model_name}:{object_id}'
 
 # for Redis
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-NEWSFEEDS_PATTERNN = 'newsfeeds:{user_id}'
\ No newline at end of file
+NEWSFEEDS_PATTERNN = 'newsfeeds:{user_id}'
+# sorted set of deleted tweet id, scored by the timestamp of deletion
+DELETED_TWEETS_KEY = 'deleted_tweets'
+# sorted set of user id, scored by the timestamp of the user's last request
+USER_LAST_SEEN_KEY = 'user_last_seen'
+# hash of counters about fanout to Redis
+FANOUT_STATS_KEY = 'fanout_stats'
+# hash of the (created_at, id) of the last friendship delivered by a fanout job
+FANOUT_CHECKPOINT_PATTERN = 'fanout_checkpoint:{tweet_id}'
+# lock of rebuilding a cached timeline, only the holder loads it from DB
+REBUILD_LOCK_PATTERN = 'rebuild_lock:{{{key}}}'
+# the timeline is rebuilt under a temporary key, then renamed to the key,
+# the key is in braces (hash tag) to keep them on the node of the key
+REBUILD_TEMP_PATTERN = 'rebuilding:{{{key}}}:{token}'
+# set when an object is not pushed to a timeline being rebuilt, the rebuild
+# may miss the object, so it is loaded again instead of being renamed
+REBUILD_DIRTY_PATTERN = 'rebuild_dirty:{{{key}}}'
+# hash of cache counters by key pattern, see utils/cache/metrics.py
+CACHE_METRICS_KEY = 'cache_metrics'
+# hash of the counters of an object (likes_count, etc.) mirrored from DB,
+# see utils/counters.py
+OBJECT_COUNTS_PATTERN = 'counts:{model_name}:{object_id}'
+# users whose tweets are not fanned out, followers pull their tweets when reading
+PULL_MODE_USERS_KEY = 'pull_mode_users'
+# number of followers of a user, to decide pull mode without COUNT(*) on fanout
+FOLLOWER_COUNT_PATTERN = 'follower_count:{user_id}'
+# version counter of an object written through to Memcached, see MemcachedHelper
+OBJECT_VERSION_PATTERN = 'object_version:{key}'
+# pub/sub channel of keys dropped from the in-process caches of all processes
+LOCAL_CACHE_CHANNEL = 'local_cache_invalidation'
+# pattern of in-process caches in cache metrics, by model name
+LOCAL_CACHE_PATTERN = 'local:{name}'
+
+# for job queue in Redis
+JOB_QUEUE_PATTERN = 'job_queue:{queue}'
+JOB_PROCESSING_PATTERN = 'job_queue:{queue}:processing'
+JOB_DEAD_LETTER_PATTERN = 'job_queue:{queue}:dead_letter'
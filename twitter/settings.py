@@ -67,10 +67,12 @@ REST_FRAMEWORK = {
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'utils.middleware.IdentityMapMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'accounts.middleware.LastSeenMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -177,8 +179,94 @@ CACHES = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# Timeline keys are spread over the nodes by consistent hashing,
+# the other keys are on the first node (see utils/cache/redis_client.py),
+# e.g. add {'host': '127.0.0.1', 'port': 6380, 'db': REDIS_DB} for one more node.
+REDIS_NODES = [
+    {'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB},
+]
+# points of each node on the hash ring
+REDIS_VIRTUAL_NODES = 160
+# connections per node in each process, waiting at most REDIS_POOL_TIMEOUT
+# seconds for a free one
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 5
+# in seconds
+REDIS_SOCKET_TIMEOUT = 2
+REDIS_SOCKET_CONNECT_TIMEOUT = 1
+# retry a command once on timeout
+REDIS_RETRY_ON_TIMEOUT = True
+# connections idle longer than that (in seconds) are checked with PING before use
+REDIS_HEALTH_CHECK_INTERVAL = 30
 REDIS_KEY_EXPIRE_TIME = 7 * 86400
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
+# number of commands sent in one pipeline
+REDIS_PIPELINE_CHUNK_SIZE = 1000 if not TESTING else 2
+# A cached timeline is rebuilt by one process at a time (in milliseconds,
+# the lock expires if the process dies). Other processes wait for the rebuild
+# (in seconds), then read the cache or load from DB without caching.
+REDIS_REBUILD_LOCK_TIMEOUT = 5000
+REDIS_REBUILD_WAIT_TIME = 0.2
+# codec of timeline entries, 'struct' (compact binary) or 'json'
+REDIS_ENTRY_CODEC = 'struct'
+# storage of timelines by key pattern (see utils/cache/redis_backends.py),
+# 'list' or 'zset' (sorted set scored by created_at).
+# Keys written by the other backend are loaded again when reading,
+# or converted by `python manage.py migrate_timeline_backend`.
+REDIS_TIMELINE_BACKENDS = {
+    'user_tweets:{user_id}': 'list',
+    'newsfeeds:{user_id}': 'list',
+}
+
+# Hits, misses, rebuild durations and sizes of caches by key pattern
+# (see utils/cache/metrics.py). Counters are flushed to Redis
+# every CACHE_METRICS_FLUSH_INTERVAL seconds.
+CACHE_METRICS_ENABLED = True
+CACHE_METRICS_FLUSH_INTERVAL = 10 if not TESTING else 0
+# seconds to cache that an object is not found in DB, short since the object
+# may be created by a transaction not committed yet when it was looked up
+CACHE_NOT_FOUND_TIMEOUT = 60
+# Models whose cached objects are written through when saved (by model name),
+# instead of deleted so that all readers miss together. Versions of the objects
+# are compared so that an older one never overwrites a newer one.
+CACHE_WRITE_THROUGH_MODELS = ('User', 'UserProfile', 'Tweet') if not TESTING else ()
+# attempts of compare and set when racing with other writers
+CACHE_CAS_RETRIES = 3
+# payloads of cached objects longer than that (in bytes) are compressed by zlib
+CACHE_COMPRESS_MIN_LENGTH = 1024
+
+# In-process LRU caches of hot objects in front of Memcached by model name,
+# with the max number of objects and the TTL in seconds
+# (see utils/cache/local_cache.py). Changed objects are dropped from the caches
+# of all processes through Redis pub/sub, by a listener thread in each process.
+LOCAL_CACHE_MODELS = {
+    'User': {'max_size': 10000, 'ttl': 60},
+    'UserProfile': {'max_size': 10000, 'ttl': 60},
+} if not TESTING else {}
+LOCAL_CACHE_LISTENER_ENABLED = True
+
+# Tweets of users having more followers than the limit are not fanned out,
+# their followers pull the tweets when reading newsfeeds
+NEWSFEED_FANOUT_FOLLOWER_LIMIT = 10000
+# Followers not seen in the window (in seconds) are skipped when pushing
+# newsfeeds to Redis, their newsfeeds are loaded from DB on next read.
+# Set it to None to push newsfeeds to all the followers.
+NEWSFEED_FANOUT_ACTIVE_WINDOW = 30 * 86400
+# the last seen time of a user is written at most once per interval
+# (in seconds) by each process, instead of on every request
+USER_LAST_SEEN_INTERVAL = 60 if not TESTING else 0
+# last seen times older than it (in seconds) are dropped, it should not be
+# shorter than NEWSFEED_FANOUT_ACTIVE_WINDOW
+USER_LAST_SEEN_RETENTION = 30 * 86400
+# number of followers handled in one batch when fanning out
+NEWSFEED_FANOUT_BATCH_SIZE = 1000 if not TESTING else 2
+# number of recent tweets added to newsfeeds when following a user
+NEWSFEED_BACKFILL_LIMIT = 20
+
+# Job queue (see utils/job_queue.py)
+# run jobs in place when testing, no worker is needed
+JOB_QUEUE_ALWAYS_EAGER = TESTING
+JOB_QUEUE_MAX_RETRIES = 3
 
 try:
     from .local_settings import *
@@ -23,6 +23,7 @@ from newsfeeds.api.views import NewsFeedViewSet
 from comments.api.views import CommentViewSet
 from likes.api.views import LikeViewSet
 from inbox.api.views import NotificationViewSet
+from utils.api.views import CacheMetricsViewSet
 
 import debug_toolbar
 
@@ -36,6 +37,7 @@ router.register(r'api/comments', CommentViewSet, basename='comments')
 router.register(r'api/likes', LikeViewSet, basename='likes')
 router.register(r'api/notifications', NotificationViewSet, basename='notifications')
 router.register(r'api/profiles', UserProfileViewSet, basename='profiles')
+router.register(r'api/cache-metrics', CacheMetricsViewSet, basename='cache-metrics')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -0,0 +1,20 @@
+from rest_framework import viewsets
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from utils.cache.local_cache import LocalCache
+from utils.cache.metrics import CacheMetrics
+
+
+class CacheMetricsViewSet(viewsets.ViewSet):
+    permission_classes = [IsAdminUser]
+
+    def list(self, request):
+        """
+        Cache counters of all processes by key pattern, e.g.
+        {'newsfeeds:{user_id}': {'hits': 10, 'misses': 1, 'hit_ratio': 0.91, ...}},
+        and the in-process caches of the process serving the request.
+        """
+        return Response({
+            'patterns': CacheMetrics.get_metrics(),
+            'local_caches': LocalCache.get_stats(),
+        })
@@ -0,0 +1,97 @@
+"""
+Helpers for the benchmark commands.
+"""
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from redis.connection import Connection
+
+import math
+import time
+
+
+class RedisCounter:
+    """
+    Count the commands and round trips sent to Redis server.
+    A single command is sent by `send_command()`, the commands of a pipeline
+    are packed by `pack_commands()`, and both are sent in one round trip
+    by `send_packed_command()`.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self._send_command = Connection.send_command
+        self._pack_commands = Connection.pack_commands
+        self._send_packed_command = Connection.send_packed_command
+
+    def __enter__(self):
+        counter = self
+        send_command = self._send_command
+        pack_commands = self._pack_commands
+        send_packed_command = self._send_packed_command
+
+        def counted_send_command(connection, *args, **kwargs):
+            counter.commands += 1
+            return send_command(connection, *args, **kwargs)
+
+        def counted_pack_commands(connection, commands):
+            commands = list(commands)
+            counter.commands += len(commands)
+            return pack_commands(connection, commands)
+
+        def counted_send_packed_command(connection, *args, **kwargs):
+            counter.round_trips += 1
+            return send_packed_command(connection, *args, **kwargs)
+
+        Connection.send_command = counted_send_command
+        Connection.pack_commands = counted_pack_commands
+        Connection.send_packed_command = counted_send_packed_command
+        return self
+
+    def __exit__(self, *args):
+        Connection.send_command = self._send_command
+        Connection.pack_commands = self._pack_commands
+        Connection.send_packed_command = self._send_packed_command
+
+
+def measure(func, *args, **kwargs):
+    """
+    Call the function, return the duration in milliseconds,
+    the number of DB queries and Redis commands.
+    """
+    with CaptureQueriesContext(connection) as queries, RedisCounter() as redis_counter:
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        duration = (time.perf_counter() - start) * 1000
+    return {
+        'ms': duration,
+        'db_queries': len(queries),
+        'redis_commands': redis_counter.commands,
+    }
+
+
+def percentile(values, percent):
+    # nearest-rank method
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def summarize(measurements):
+    durations = [m['ms'] for m in measurements]
+    count = len(measurements)
+    db_queries = sum(m['db_queries'] for m in measurements)
+    redis_commands = sum(m['redis_commands'] for m in measurements)
+    return {
+        'count': count,
+        'p50_ms': percentile(durations, 50),
+        'p95_ms': percentile(durations, 95),
+        'p99_ms': percentile(durations, 99),
+        'max_ms': max(durations, default=None),
+        'db_queries': db_queries,
+        'db_queries_per_call': db_queries / count if count else None,
+        'redis_commands': redis_commands,
+        'redis_commands_per_call': redis_commands / count if count else None,
+    }
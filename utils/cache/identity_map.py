@@ -0,0 +1,65 @@
+"""
+Objects read through cache in the current request, by model name and key,
+so that an object read for many rows of a page, e.g. the author of most
+tweets of a newsfeed, is read from cache once per request. The same instance
+is returned to every reader within the request.
+
+The map is active in IdentityMap.scope(), which IdentityMapMiddleware opens
+for each request. Outside of a scope, e.g. in jobs and commands, every
+method is a no-op.
+"""
+import contextlib
+import contextvars
+
+_objects = contextvars.ContextVar('identity_map', default=None)
+
+
+class IdentityMap:
+
+    @classmethod
+    @contextlib.contextmanager
+    def scope(cls):
+        token = _objects.set({})
+        try:
+            yield
+        finally:
+            _objects.reset(token)
+
+    @classmethod
+    def get(cls, name, key):
+        objects = _objects.get()
+        if objects is None:
+            return None
+        return objects.get((name, key))
+
+    @classmethod
+    def get_many(cls, name, keys):
+        """
+        Return a dict of key to object of the keys read in the request.
+        """
+        objects = _objects.get()
+        if not objects:
+            return {}
+        return {
+            key: objects[(name, key)]
+            for key in keys
+            if (name, key) in objects
+        }
+
+    @classmethod
+    def set(cls, name, key, obj):
+        objects = _objects.get()
+        if objects is not None and obj is not None:
+            objects[(name, key)] = obj
+
+    @classmethod
+    def set_many(cls, name, objects):
+        for key, obj in objects.items():
+            cls.set(name, key, obj)
+
+    @classmethod
+    def discard(cls, name, key):
+        # the object is changed in the request, read it again
+        objects = _objects.get()
+        if objects is not None:
+            objects.pop((name, key), None)
@@ -0,0 +1,272 @@
+"""
+In-process LRU cache in front of Memcached for hot objects, e.g. the users
+and profiles of celebrities read by every feed page. It is configured per
+model by settings.LOCAL_CACHE_MODELS, entries expire after the TTL.
+
+When an object changes, its entry is dropped in the process and the key is
+published to the LOCAL_CACHE_CHANNEL of Redis, the listener thread of every
+other process drops it too. Messages missed while the listener reconnects
+are covered by clearing the caches, and the TTL bounds the staleness if the
+listener is down.
+"""
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models.base import ModelState
+from twitter.cache import LOCAL_CACHE_CHANNEL, LOCAL_CACHE_PATTERN
+from utils.cache.metrics import CacheMetrics
+from utils.cache.redis_client import RedisClient
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+# seconds to wait for a message, then check if the listener should stop
+LISTEN_TIMEOUT = 1
+RECONNECT_INTERVAL = 1
+
+
+def copy_instance(instance):
+    """
+    Copy the field values of a model instance to a new instance. The objects
+    cached on an instance by its readers (related objects, profiles, etc.)
+    are not copied, so the cached instance is never changed by them.
+    """
+    clone = instance.__class__.__new__(instance.__class__)
+    clone.__dict__.update({
+        field.attname: instance.__dict__[field.attname]
+        for field in instance._meta.concrete_fields
+        if field.attname in instance.__dict__
+    })
+    clone._state = ModelState()
+    clone._state.adding = False
+    clone._state.db = instance._state.db
+    return clone
+
+
+class LRUCache:
+    """
+    Bounded dict of key to (expire time, value), the least recently used
+    key is evicted when it is full. Shared by the threads of a process.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[0] < time.monotonic():
+                del self.data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else None,
+        }
+
+
+class LocalCache:
+    """
+    LRU caches by name, the name is the model name in LOCAL_CACHE_MODELS.
+    Objects are read as copies, see copy_instance().
+
+    A read missing the local cache takes get_generation() before reading
+    Memcached, set() skips the object if any invalidation came in between,
+    so that an object read before its change is not cached after it.
+    The generation is bumped and checked under write_lock along with the
+    writes of the entries, since the listener thread and request threads
+    invalidate concurrently.
+    """
+    caches = {}
+    pid = None
+    generation = 0
+    lock = threading.Lock()
+    write_lock = threading.Lock()
+    listener = None
+
+    @classmethod
+    def get_cache(cls, name):
+        """
+        Return the LRU cache of the name, or None if it is not configured.
+        """
+        config = settings.LOCAL_CACHE_MODELS.get(name)
+        if not config:
+            return None
+        pid = os.getpid()
+        if cls.pid != pid or name not in cls.caches:
+            with cls.lock:
+                # a forked process has its own caches and listener
+                if cls.pid != pid:
+                    cls.caches = {}
+                    cls.pid = pid
+                    cls.listener = None
+                if name not in cls.caches:
+                    cls.caches[name] = LRUCache(config['max_size'], config['ttl'])
+                cls._start_listener()
+        return cls.caches.get(name)
+
+    @classmethod
+    def get(cls, name, key):
+        lru_cache = cls.get_cache(name)
+        if lru_cache is None:
+            return None
+        obj = lru_cache.get(key)
+        pattern = LOCAL_CACHE_PATTERN.format(name=name)
+        if obj is None:
+            CacheMetrics.record_misses(pattern)
+            return None
+        CacheMetrics.record_hits(pattern)
+        return copy_instance(obj)
+
+    @classmethod
+    def get_many(cls, name, keys):
+        """
+        Return a dict of key to object of the keys in the local cache.
+        """
+        lru_cache = cls.get_cache(name)
+        if lru_cache is None:
+            return {}
+        objects = {}
+        for key in keys:
+            obj = lru_cache.get(key)
+            if obj is not None:
+                objects[key] = copy_instance(obj)
+        pattern = LOCAL_CACHE_PATTERN.format(name=name)
+        CacheMetrics.record_hits(pattern, len(objects))
+        CacheMetrics.record_misses(pattern, len(keys) - len(objects))
+        return objects
+
+    @classmethod
+    def get_generation(cls):
+        return cls.generation
+
+    @classmethod
+    def set(cls, name, key, obj, generation):
+        lru_cache = cls.get_cache(name)
+        if lru_cache is None or obj is None:
+            return
+        obj = copy_instance(obj)
+        with cls.write_lock:
+            if generation == cls.generation:
+                lru_cache.set(key, obj)
+
+    @classmethod
+    def set_many(cls, name, objects, generation):
+        for key, obj in objects.items():
+            cls.set(name, key, obj, generation)
+
+    @classmethod
+    def invalidate(cls, name, key):
+        """
+        Drop the key in this process and publish it to the other processes.
+        """
+        if not settings.LOCAL_CACHE_MODELS.get(name):
+            return
+        cls._drop(name, key)
+        message = '{}|{}'.format(name, key)
+        RedisClient.get_connection().publish(LOCAL_CACHE_CHANNEL, message)
+
+    @classmethod
+    def _drop(cls, name, key):
+        with cls.write_lock:
+            cls.generation += 1
+            lru_cache = cls.caches.get(name)
+            if lru_cache is not None:
+                lru_cache.delete(key)
+
+    @classmethod
+    def handle_message(cls, message):
+        if message['type'] != 'message':
+            return
+        name, key = message['data'].decode().split('|', 1)
+        cls._drop(name, key)
+
+    @classmethod
+    def _start_listener(cls):
+        if cls.listener is not None or not settings.LOCAL_CACHE_LISTENER_ENABLED:
+            return
+        cls.listener = threading.Thread(target=cls._listen, args=(cls.pid,), daemon=True)
+        cls.listener.start()
+
+    @classmethod
+    def _listen(cls, pid):
+        while cls.pid == pid:
+            pubsub = None
+            try:
+                pubsub = RedisClient.get_connection().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(LOCAL_CACHE_CHANNEL)
+                # invalidations may be missed while not subscribed
+                cls.clear_entries()
+                while cls.pid == pid:
+                    message = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+                    if message is not None:
+                        cls.handle_message(message)
+            except Exception:
+                logger.exception('Local cache listener is disconnected')
+                cls.clear_entries()
+                time.sleep(RECONNECT_INTERVAL)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    @classmethod
+    def clear_entries(cls):
+        with cls.write_lock:
+            cls.generation += 1
+            for lru_cache in list(cls.caches.values()):
+                lru_cache.clear()
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Return the size and hit ratio of the local caches of this process.
+        """
+        return {name: lru_cache.get_stats() for name, lru_cache in cls.caches.items()}
+
+    @classmethod
+    def clear(cls):
+        """
+        Drop all local caches, e.g. after settings are changed in tests.
+        The listener, if any, stops on its next message timeout.
+        """
+        with cls.lock:
+            cls.clear_entries()
+            cls.caches = {}
+            cls.pid = None
+            cls.listener = None
@@ -1,29 +1,379 @@
 from django.conf import settings
 from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.memcached import BaseMemcachedCache, MemcachedCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from twitter.cache import OBJECT_PATTERN, OBJECT_VERSION_PATTERN
+from utils.cache.identity_map import IdentityMap
+from utils.cache.local_cache import LocalCache
+from utils.cache.memcached_serializers import CACHE_VERSION_ATTR, ObjectSerializer
+from utils.cache.metrics import CacheMetrics
+from utils.cache.redis_client import RedisClient
 
-cache = caches['testing'] if settings.TESTING else caches['default']
+import memcache
+import pickle
+import re
+import threading
+import time
+
+CACHE_ALIAS = 'testing' if settings.TESTING else 'default'
+cache = caches[CACHE_ALIAS]
+# attribute of an instance holding its related objects prefetched from cache
+PREFETCHED_OBJECTS_ATTR = '_prefetched_through_cache'
+# Cached for a lookup not found in DB for CACHE_NOT_FOUND_TIMEOUT seconds,
+# so that looking it up again costs no query.
+NOT_FOUND = '__not_found__'
+# default of cache.get(), to tell a miss from any cached value
+MISSING = object()
+# python-memcached clients remembering the CAS ids of gets(), one per thread
+cas_clients = threading.local()
+
+
+def get_cache_version(obj):
+    # objects written through have a version, objects loaded by readers have 0
+    return getattr(obj, CACHE_VERSION_ATTR, 0)
+
+
+def check_write_through_backend():
+    """
+    Objects are written through by the CAS of python-memcached. The clients
+    of the other Memcached libraries store values in other formats, so they
+    can not share the cache with it.
+    """
+    if not settings.CACHE_WRITE_THROUGH_MODELS:
+        return
+    if isinstance(cache, BaseMemcachedCache) and not isinstance(cache, MemcachedCache):
+        raise ImproperlyConfigured(
+            'CACHE_WRITE_THROUGH_MODELS requires the {} cache to use '
+            'django.core.cache.backends.memcached.MemcachedCache, got {}.'.format(
+                CACHE_ALIAS,
+                settings.CACHES[CACHE_ALIAS]['BACKEND'],
+            )
+        )
+
+
+def get_cas_client():
+    """
+    Return a python-memcached client supporting gets() and cas(),
+    or None if the cache is not Memcached, e.g. in tests.
+    The client is set up from the LOCATION and OPTIONS of the cache
+    as MemcachedCache does, so that they read each other's values.
+    """
+    if not isinstance(cache, MemcachedCache):
+        return None
+    client = getattr(cas_clients, 'client', None)
+    if client is None:
+        params = settings.CACHES[CACHE_ALIAS]
+        servers = params['LOCATION']
+        if isinstance(servers, str):
+            servers = re.split('[;,]', servers)
+        options = {'pickleProtocol': pickle.HIGHEST_PROTOCOL}
+        options.update(params.get('OPTIONS') or {})
+        client = memcache.Client(servers, cache_cas=True, **options)
+        cas_clients.client = client
+    return client
+
+
+# fail at startup rather than on the first write
+check_write_through_backend()
 
 
 class MemcachedHelper:
 
     @classmethod
     def get_key(cls, model_class, object_id):
-        return '{}:{}'.format(model_class.__name__, object_id)
+        return OBJECT_PATTERN.format(model_name=model_class.__name__, object_id=object_id)
+
+    @classmethod
+    def get_pattern(cls, model_class):
+        # pattern of the model in cache metrics, e.g. 'Tweet:{object_id}'
+        return cls.get_key(model_class, '{object_id}')
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
+        # read once per request
+        obj = IdentityMap.get(model_class.__name__, key)
+        if obj is None:
+            obj = cls._get_object(model_class, object_id, key)
+            IdentityMap.set(model_class.__name__, key, obj)
+        return obj
+
+    @classmethod
+    def _get_object(cls, model_class, object_id, key):
+        name = model_class.__name__
+        # in-process cache hit
+        obj = LocalCache.get(name, key)
+        if obj is not None:
+            return obj
+
+        generation = LocalCache.get_generation()
+        pattern = cls.get_pattern(model_class)
         # cache hit
-        obj = cache.get(key)
-        if obj:
+        obj = cls.get_cached_objects(model_class, [key]).get(key, MISSING)
+        if obj is not MISSING:
+            CacheMetrics.record_hits(pattern)
+            if obj == NOT_FOUND:
+                raise model_class.DoesNotExist(
+                    '{} matching id {} does not exist.'.format(name, object_id),
+                )
+            LocalCache.set(name, key, obj, generation)
             return obj
         # cache miss
-        obj = model_class.objects.get(id=object_id)
+        CacheMetrics.record_misses(pattern)
+        start = time.perf_counter()
+        try:
+            obj = model_class.objects.get(id=object_id)
+        except model_class.DoesNotExist:
+            cls.set_loaded_objects(
+                model_class,
+                {key: NOT_FOUND},
+                settings.CACHE_NOT_FOUND_TIMEOUT,
+            )
+            raise
         #using default expire time
-        cache.set(key, obj)
+        size = cls.set_loaded_objects(model_class, {key: obj})
+        CacheMetrics.record_rebuild(pattern, time.perf_counter() - start, size=size)
+        LocalCache.set(name, key, obj, generation)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        Return a dict of id to object with one Memcached round trip,
+        objects not in cache are loaded from DB in one query.
+        Ids not found in DB are not in the dict, and are cached as NOT_FOUND.
+        """
+        keys = {
+            object_id: cls.get_key(model_class, object_id)
+            for object_id in set(object_ids)
+        }
+        name = model_class.__name__
+        # read once per request
+        request_objects = IdentityMap.get_many(name, keys.values())
+        objects = cls._get_objects(model_class, {
+            object_id: key
+            for object_id, key in keys.items()
+            if key not in request_objects
+        })
+        IdentityMap.set_many(name, {keys[object_id]: obj for object_id, obj in objects.items()})
+        objects.update({
+            object_id: request_objects[key]
+            for object_id, key in keys.items()
+            if key in request_objects
+        })
+        return objects
+
+    @classmethod
+    def _get_objects(cls, model_class, keys):
+        if not keys:
+            return {}
+        name = model_class.__name__
+        local_objects = LocalCache.get_many(name, list(keys.values()))
+        objects = {
+            object_id: local_objects[key]
+            for object_id, key in keys.items()
+            if key in local_objects
+        }
+        keys = {
+            object_id: key
+            for object_id, key in keys.items()
+            if key not in local_objects
+        }
+        if not keys:
+            return objects
+
+        generation = LocalCache.get_generation()
+        cached_objects = cls.get_cached_objects(model_class, keys.values())
+        missed_ids = []
+        for object_id, key in keys.items():
+            if key not in cached_objects:
+                missed_ids.append(object_id)
+            elif cached_objects[key] != NOT_FOUND:
+                objects[object_id] = cached_objects[key]
+                LocalCache.set(name, key, cached_objects[key], generation)
+        pattern = cls.get_pattern(model_class)
+        CacheMetrics.record_hits(pattern, len(cached_objects))
+        if missed_ids:
+            CacheMetrics.record_misses(pattern, len(missed_ids))
+            start = time.perf_counter()
+            loaded_objects = list(model_class.objects.filter(id__in=missed_ids))
+            size = cls.set_loaded_objects(model_class, {
+                cls.get_key(model_class, obj.id): obj
+                for obj in loaded_objects
+            })
+            objects.update({obj.id: obj for obj in loaded_objects})
+            cls.set_loaded_objects(model_class, {
+                cls.get_key(model_class, object_id): NOT_FOUND
+                for object_id in missed_ids
+                if object_id not in objects
+            }, settings.CACHE_NOT_FOUND_TIMEOUT)
+            LocalCache.set_many(name, {
+                cls.get_key(model_class, obj.id): obj
+                for obj in loaded_objects
+            }, generation)
+            # the objects are loaded together, share the duration and size
+            duration = time.perf_counter() - start
+            for obj in loaded_objects:
+                CacheMetrics.record_rebuild(
+                    pattern,
+                    duration / len(loaded_objects),
+                    size=size // len(loaded_objects),
+                )
+        return objects
+
+    @classmethod
+    def prefetch_related_objects(cls, instances, field_name):
+        """
+        Load the related objects of the foreign key `field_name` of the
+        instances by get_objects_through_cache(), so that reading them by
+        get_related_object_through_cache() needs no more round trip.
+        Return the related objects.
+        """
+        instances = [instance for instance in instances if instance is not None]
+        if not instances:
+            return []
+        field = instances[0]._meta.get_field(field_name)
+        objects = cls.get_objects_through_cache(field.related_model, [
+            getattr(instance, field.attname)
+            for instance in instances
+            if getattr(instance, field.attname) is not None
+        ])
+        for instance in instances:
+            obj = objects.get(getattr(instance, field.attname))
+            if obj is not None:
+                instance.__dict__.setdefault(PREFETCHED_OBJECTS_ATTR, {})[field_name] = obj
+        return list(objects.values())
+
+    @classmethod
+    def get_related_object_through_cache(cls, instance, field_name):
+        prefetched_objects = instance.__dict__.get(PREFETCHED_OBJECTS_ATTR, {})
+        if field_name in prefetched_objects:
+            return prefetched_objects[field_name]
+        field = instance._meta.get_field(field_name)
+        object_id = getattr(instance, field.attname)
+        # e.g. the user of a tweet is set to NULL
+        if object_id is None:
+            return None
+        return cls.get_object_through_cache(field.related_model, object_id)
+
+    @classmethod
+    def serialize(cls, obj):
+        if obj == NOT_FOUND:
+            return obj
+        return ObjectSerializer.serialize(obj, get_cache_version(obj))
+
+    @classmethod
+    def get_cached_objects(cls, model_class, keys):
+        """
+        Return a dict of key to object or NOT_FOUND of the keys in cache.
+        Payloads of an older schema, e.g. written before a deploy changing
+        the model, are deleted and left out as misses.
+        """
+        objects = {}
+        stale_keys = []
+        for key, data in cache.get_many(list(keys)).items():
+            obj = data if data == NOT_FOUND else ObjectSerializer.deserialize(model_class, data)
+            if obj is None:
+                stale_keys.append(key)
+            else:
+                objects[key] = obj
+        if stale_keys:
+            cache.delete_many(stale_keys)
+        return objects
+
+    @classmethod
+    def set_loaded_objects(cls, model_class, objects, timeout=DEFAULT_TIMEOUT):
+        """
+        Cache a dict of key to object loaded from DB by a reader, return
+        the bytes written. For the models written through, an object read
+        before a change must not overwrite the object written after it,
+        so the keys in cache are kept.
+        """
+        payloads = {key: cls.serialize(obj) for key, obj in objects.items()}
+        if model_class.__name__ not in settings.CACHE_WRITE_THROUGH_MODELS:
+            cache.set_many(payloads, timeout)
+        else:
+            for key, data in payloads.items():
+                cache.add(key, data, timeout)
+        return sum(len(data) for data in payloads.values())
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+        LocalCache.invalidate(model_class.__name__, key)
+        IdentityMap.discard(model_class.__name__, key)
+
+    @classmethod
+    def update_cached_object(cls, model_class, instance):
+        """
+        Write a saved object through to cache for the models in
+        CACHE_WRITE_THROUGH_MODELS, or drop it from cache for the others.
+        """
+        if model_class.__name__ not in settings.CACHE_WRITE_THROUGH_MODELS:
+            cls.invalidate_cached_object(model_class, instance.id)
+            return
+        cls.write_through(model_class.__name__, cls.get_key(model_class, instance.id), instance)
+
+    @classmethod
+    def write_through(cls, name, key, instance):
+        """
+        Stamp a copy of the instance with a new version when it is saved, and
+        write it to cache when the transaction is committed, unless a newer
+        version is cached. Saves of a row are serialized by its row lock,
+        so the versions follow the order of the commits.
+        """
+        data = ObjectSerializer.serialize(instance, cls.get_next_version(key))
+        IdentityMap.discard(name, key)
+
+        def write():
+            cls.compare_and_set(key, data)
+            LocalCache.invalidate(name, key)
+
+        # run at once if not in a transaction
+        transaction.on_commit(write)
+
+    @classmethod
+    def get_next_version(cls, key):
+        # the counter lives longer than the cached object
+        version_key = OBJECT_VERSION_PATTERN.format(key=key)
+        pipeline = RedisClient.get_connection().pipeline(transaction=False)
+        pipeline.incr(version_key)
+        pipeline.expire(version_key, cache.default_timeout * 2)
+        return pipeline.execute()[0]
+
+    @classmethod
+    def compare_and_set(cls, key, data, timeout=DEFAULT_TIMEOUT):
+        """
+        Cache the payload of an object unless the cached one has the same
+        or a newer version. Return whether it is written. It is atomic by CAS
+        with python-memcached, and a plain get and set with the other backends.
+        """
+        version = ObjectSerializer.get_version(data)
+        client = get_cas_client()
+        if client is None:
+            if ObjectSerializer.get_version(cache.get(key)) >= version:
+                return False
+            cache.set(key, data, timeout)
+            return True
+
+        raw_key = cache.make_key(key)
+        backend_timeout = cache.get_backend_timeout(timeout)
+        try:
+            for _ in range(settings.CACHE_CAS_RETRIES):
+                current = client.gets(raw_key)
+                if current is not None and ObjectSerializer.get_version(current) >= version:
+                    return False
+                # cas() of a key not read by gets() is a plain set
+                if current is None:
+                    written = client.add(raw_key, data, backend_timeout)
+                else:
+                    written = client.cas(raw_key, data, backend_timeout)
+                if written:
+                    return True
+            # the key kept changing, e.g. by the writers of newer versions
+            return False
+        finally:
+            client.reset_cas()
@@ -0,0 +1,166 @@
+"""
+Compact payloads of the objects cached in Memcached, instead of pickled
+model instances carrying _state and the objects cached on them.
+
+An object is stored as a header and the pickled tuple of its field values,
+datetimes as microseconds since epoch. The body is compressed by zlib when
+it is longer than CACHE_COMPRESS_MIN_LENGTH bytes.
+Header: format, flags, schema id, cache version (see MemcachedHelper).
+
+The schema id is a checksum of the model's fields, so a payload written
+before a deploy changing the model is not decodable and is read as a miss.
+Bump FORMAT_VERSION when the layout changes.
+"""
+from django.conf import settings
+from django.db.models.base import ModelState
+from django.db.models.fields.files import FieldFile
+from utils.cache.redis_serializers import EPOCH, ONE_MICROSECOND, to_datetime
+
+import datetime
+import pickle
+import struct
+import zlib
+
+# first byte of the payloads, pickled data written before starts with 0x80
+FORMAT_VERSION = 1
+ID_SET_FORMAT_VERSION = 2
+COMPRESSED = 1
+HEADER = struct.Struct('<BBIQ')
+ID_SET_HEADER = struct.Struct('<BBB')
+# struct formats of ids, the narrowest one holding the max id is used
+ID_FORMATS = ('H', 'I', 'Q')
+# attribute of a deserialized object holding its cache version if it has one
+CACHE_VERSION_ATTR = '_cache_version'
+
+
+def compress(body):
+    if len(body) < settings.CACHE_COMPRESS_MIN_LENGTH:
+        return 0, body
+    compressed_body = zlib.compress(body)
+    if len(compressed_body) >= len(body):
+        return 0, body
+    return COMPRESSED, compressed_body
+
+
+def decompress(flags, body):
+    if flags & COMPRESSED:
+        return zlib.decompress(body)
+    return body
+
+
+class ObjectSerializer:
+    _schemas = {}
+
+    @classmethod
+    def get_schema(cls, model_class):
+        """
+        Return the schema id, the attnames of the concrete fields
+        and the indexes of the datetime fields.
+        """
+        if model_class not in cls._schemas:
+            fields = model_class._meta.concrete_fields
+            description = '{}:{}'.format(model_class._meta.label, ','.join(
+                '{}:{}'.format(field.attname, field.get_internal_type())
+                for field in fields
+            ))
+            cls._schemas[model_class] = (
+                zlib.crc32(description.encode()),
+                [field.attname for field in fields],
+                [
+                    index
+                    for index, field in enumerate(fields)
+                    if field.get_internal_type() == 'DateTimeField'
+                ],
+            )
+        return cls._schemas[model_class]
+
+    @classmethod
+    def serialize(cls, instance, version=0):
+        schema_id, attnames, _ = cls.get_schema(instance.__class__)
+        values = []
+        for attname in attnames:
+            value = instance.__dict__.get(attname)
+            if isinstance(value, datetime.datetime):
+                value = (value - EPOCH) // ONE_MICROSECOND
+            # e.g. the avatar of a profile, stored as its name
+            elif isinstance(value, FieldFile):
+                value = value.name
+            values.append(value)
+        flags, body = compress(pickle.dumps(tuple(values), pickle.HIGHEST_PROTOCOL))
+        return HEADER.pack(FORMAT_VERSION, flags, schema_id, version) + body
+
+    @classmethod
+    def deserialize(cls, model_class, data):
+        """
+        Return the instance, or None if the payload is not written
+        by the current schema of the model.
+        """
+        schema_id, attnames, datetime_indexes = cls.get_schema(model_class)
+        if not cls.is_payload(data):
+            return None
+        _, flags, data_schema_id, version = HEADER.unpack_from(data)
+        if data_schema_id != schema_id:
+            return None
+        values = pickle.loads(decompress(flags, data[HEADER.size:]))
+        instance = model_class.__new__(model_class)
+        instance.__dict__.update(zip(attnames, values))
+        for index in datetime_indexes:
+            attname = attnames[index]
+            instance.__dict__[attname] = to_datetime(instance.__dict__[attname])
+        instance._state = ModelState()
+        instance._state.adding = False
+        instance._state.db = 'default'
+        if version:
+            setattr(instance, CACHE_VERSION_ATTR, version)
+        return instance
+
+    @classmethod
+    def is_payload(cls, data):
+        return (
+            isinstance(data, bytes) and
+            len(data) >= HEADER.size and
+            data[0] == FORMAT_VERSION
+        )
+
+    @classmethod
+    def get_version(cls, data):
+        # the cache version of a payload, 0 if it has none
+        if not cls.is_payload(data):
+            return 0
+        return HEADER.unpack_from(data)[3]
+
+
+class IdSetSerializer:
+    """
+    A set of ids packed as sorted unsigned integers of 2, 4 or 8 bytes,
+    e.g. the ids of the users followed by a user.
+    Sorted ids compress well as their high bytes repeat.
+    """
+
+    @classmethod
+    def serialize(cls, ids):
+        ids = sorted(ids)
+        max_id = ids[-1] if ids else 0
+        id_format = next(
+            index
+            for index, format_char in enumerate(ID_FORMATS)
+            if max_id < 1 << (8 * struct.calcsize(format_char))
+        )
+        flags, body = compress(
+            struct.pack('<{}{}'.format(len(ids), ID_FORMATS[id_format]), *ids),
+        )
+        return ID_SET_HEADER.pack(ID_SET_FORMAT_VERSION, flags, id_format) + body
+
+    @classmethod
+    def deserialize(cls, data):
+        if (
+            not isinstance(data, bytes) or
+            len(data) < ID_SET_HEADER.size or
+            data[0] != ID_SET_FORMAT_VERSION
+        ):
+            return None
+        _, flags, id_format = ID_SET_HEADER.unpack_from(data)
+        body = decompress(flags, data[ID_SET_HEADER.size:])
+        format_char = ID_FORMATS[id_format]
+        count = len(body) // struct.calcsize(format_char)
+        return set(struct.unpack('<{}{}'.format(count, format_char), body))
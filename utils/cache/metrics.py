@@ -0,0 +1,137 @@
+"""
+Hits, misses, rebuild durations and sizes of caches by key pattern.
+Counters are buffered in the process and added to the `cache_metrics`
+hash in Redis every CACHE_METRICS_FLUSH_INTERVAL seconds, so that
+recording does not cost a round trip and all processes are aggregated.
+Counters not flushed yet are lost if the process exits.
+"""
+from django.conf import settings
+from twitter import cache as cache_keys
+from twitter.cache import CACHE_METRICS_KEY
+from utils.cache.redis_client import RedisClient
+
+import pickle
+import threading
+import time
+
+# counters added by HINCRBYFLOAT, the others are integers
+FLOAT_COUNTERS = ('rebuild_ms',)
+OTHER_PATTERN = 'other'
+
+
+def get_key_patterns():
+    return [
+        value
+        for name, value in vars(cache_keys).items()
+        if name.isupper() and isinstance(value, str)
+    ]
+
+
+class CacheMetrics:
+    buffer = {}
+    flushed_at = time.monotonic()
+    lock = threading.Lock()
+    patterns = None
+
+    @classmethod
+    def get_pattern(cls, key):
+        """
+        Return the pattern in twitter/cache.py matching the key,
+        e.g. 'newsfeeds:{user_id}' for 'newsfeeds:1'.
+        """
+        if cls.patterns is None:
+            # longer prefixes first, e.g. 'job_queue:{queue}:processing'
+            cls.patterns = sorted(
+                get_key_patterns(),
+                key=lambda pattern: len(pattern.split('{')[0]),
+                reverse=True,
+            )
+        for pattern in cls.patterns:
+            prefix = pattern.split('{')[0]
+            if key == pattern or (prefix and '{' in pattern and key.startswith(prefix)):
+                return pattern
+        return OTHER_PATTERN
+
+    @classmethod
+    def record_hits(cls, pattern, count=1):
+        cls._add(pattern, hits=count)
+
+    @classmethod
+    def record_misses(cls, pattern, count=1):
+        cls._add(pattern, misses=count)
+
+    @classmethod
+    def record_rebuild(cls, pattern, duration, size=None, value=None):
+        """
+        Record a cache rebuild taking `duration` seconds and writing
+        `size` bytes. The size of a value cached in Memcached is measured
+        by pickling it, as the Memcached backend does.
+        """
+        if not settings.CACHE_METRICS_ENABLED:
+            return
+        if size is None:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        cls._add(pattern, rebuilds=1, rebuild_ms=duration * 1000, bytes_written=size)
+
+    @classmethod
+    def _add(cls, pattern, **counters):
+        if not settings.CACHE_METRICS_ENABLED:
+            return
+        with cls.lock:
+            for name, value in counters.items():
+                field = '{}|{}'.format(pattern, name)
+                cls.buffer[field] = cls.buffer.get(field, 0) + value
+            if time.monotonic() - cls.flushed_at < settings.CACHE_METRICS_FLUSH_INTERVAL:
+                return
+            buffer, cls.buffer = cls.buffer, {}
+            cls.flushed_at = time.monotonic()
+        cls._flush(buffer)
+
+    @classmethod
+    def _flush(cls, buffer):
+        if not buffer:
+            return
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for field, value in buffer.items():
+            if field.rsplit('|', 1)[1] in FLOAT_COUNTERS:
+                pipeline.hincrbyfloat(CACHE_METRICS_KEY, field, value)
+            else:
+                pipeline.hincrby(CACHE_METRICS_KEY, field, value)
+        pipeline.execute()
+
+    @classmethod
+    def flush(cls):
+        with cls.lock:
+            buffer, cls.buffer = cls.buffer, {}
+            cls.flushed_at = time.monotonic()
+        cls._flush(buffer)
+
+    @classmethod
+    def get_metrics(cls):
+        """
+        Return a dict of pattern to its counters and the derived ratios.
+        """
+        cls.flush()
+        conn = RedisClient.get_connection()
+        metrics = {}
+        for field, value in conn.hgetall(CACHE_METRICS_KEY).items():
+            pattern, name = field.decode().rsplit('|', 1)
+            value = float(value) if name in FLOAT_COUNTERS else int(value)
+            metrics.setdefault(pattern, {})[name] = value
+
+        for counters in metrics.values():
+            for name in ('hits', 'misses', 'rebuilds', 'rebuild_ms', 'bytes_written'):
+                counters.setdefault(name, 0)
+            lookups = counters['hits'] + counters['misses']
+            rebuilds = counters['rebuilds']
+            counters['hit_ratio'] = counters['hits'] / lookups if lookups else None
+            counters['avg_rebuild_ms'] = counters['rebuild_ms'] / rebuilds if rebuilds else None
+            counters['avg_bytes'] = counters['bytes_written'] / rebuilds if rebuilds else None
+        return metrics
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.buffer = {}
+        RedisClient.get_connection().delete(CACHE_METRICS_KEY)
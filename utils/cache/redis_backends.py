@@ -0,0 +1,260 @@
+"""
+Storages of cached timelines, i.e. objects ordered by created_at desc.
+The backend of a key is chosen by settings.REDIS_TIMELINE_BACKENDS.
+"""
+from contextlib import contextmanager
+from redis.exceptions import ResponseError
+from utils.cache.redis_serializers import EPOCH, ONE_MICROSECOND
+
+# Push to the timeline only if it is cached, and limit its length.
+# Check, push and trim are done in one server-side call.
+# A key written by another backend is deleted, it will be loaded on next read.
+# A key not cached but being rebuilt is marked dirty, so that the rebuild,
+# which may have read DB before the object was saved, loads it again.
+# KEYS[1]: key, KEYS[2]: rebuild lock, KEYS[3]: dirty marker
+# ARGV[1]: serialized object, ARGV[2]: length limit, ARGV[3]: score,
+# ARGV[4]: expire time of the marker in milliseconds
+LIST_PUSH_SCRIPT = """
+local key_type = redis.call('TYPE', KEYS[1]).ok
+if key_type == 'list' then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+    return 1
+end
+if key_type ~= 'none' then
+    redis.call('DEL', KEYS[1])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('SET', KEYS[3], 1, 'PX', ARGV[4])
+end
+return 0
+"""
+
+SORTED_SET_PUSH_SCRIPT = """
+local key_type = redis.call('TYPE', KEYS[1]).ok
+if key_type == 'zset' then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+    return 1
+end
+if key_type ~= 'none' then
+    redis.call('DEL', KEYS[1])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('SET', KEYS[3], 1, 'PX', ARGV[4])
+end
+return 0
+"""
+
+# Remove an object from the timeline. A timeline reaching the limit is
+# treated as having more data in DB, it can not be refilled here, so it is
+# deleted and loaded again on next read. Otherwise the shorter timeline
+# would be treated as holding all the data.
+# KEYS[1]: key, ARGV[1]: serialized object, ARGV[2]: length limit
+# (the other keys and arguments of the push scripts are not used)
+LIST_REMOVE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then
+    return 0
+end
+local removed = redis.call('LREM', KEYS[1], 0, ARGV[1])
+if removed > 0 and redis.call('LLEN', KEYS[1]) + removed >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[1])
+end
+return removed
+"""
+
+SORTED_SET_REMOVE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'zset' then
+    return 0
+end
+local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+if removed > 0 and redis.call('ZCARD', KEYS[1]) + removed >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[1])
+end
+return removed
+"""
+
+
+class StaleListError(Exception):
+    """
+    The cached timeline can not be read, e.g. it is written by an old schema,
+    by another backend or changed while reading. It should be loaded again.
+    """
+    pass
+
+
+@contextmanager
+def raise_stale_on_wrong_type(key):
+    try:
+        yield
+    except ResponseError as error:
+        # errors in pipelines are prefixed with the command
+        if 'WRONGTYPE' not in str(error):
+            raise
+        raise StaleListError(key)
+
+
+def deserialize_all(key, serializer, serialized_list):
+    objects = [serializer.deserialize(serialized_data) for serialized_data in serialized_list]
+    # entries which can not be deserialized are None
+    if any(obj is None for obj in objects):
+        raise StaleListError(key)
+    return objects
+
+
+def get_window(length, get_object, created_at__gt, created_at__lt, count):
+    """
+    Return the [start, end) indexes of the window in a timeline.
+    """
+    if created_at__gt is not None:
+        # the newer objects are at the head
+        end = bisect(length, get_object, lambda obj: obj.created_at <= created_at__gt)
+        return 0, end
+    start = 0
+    if created_at__lt is not None:
+        start = bisect(length, get_object, lambda obj: obj.created_at < created_at__lt)
+    end = length if count is None else min(start + count, length)
+    return start, end
+
+
+def bisect(length, get_object, predicate):
+    """
+    Return the index of the first object matching the predicate,
+    which must be False for the objects before it and True for the rest.
+    """
+    low, high = 0, length
+    while low < high:
+        middle = (low + high) // 2
+        if predicate(get_object(middle)):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def get_score(created_at):
+    # microseconds since epoch, exact in the double of a sorted set score
+    return (created_at - EPOCH) // ONE_MICROSECOND
+
+
+class ListBackend:
+    """
+    Objects are kept in a list by created_at desc, new objects are pushed
+    to the head. Finding a created_at in the list is a binary search,
+    done in process on the list read in one round trip.
+    """
+    key_type = 'list'
+    push_script = LIST_PUSH_SCRIPT
+    remove_script = LIST_REMOVE_SCRIPT
+
+    @classmethod
+    def get_length(cls, client, key):
+        with raise_stale_on_wrong_type(key):
+            return client.llen(key)
+
+    @classmethod
+    def write(cls, client, key, serialized_list, objects):
+        client.rpush(key, *serialized_list)
+
+    @classmethod
+    def read_all(cls, client, key):
+        with raise_stale_on_wrong_type(key):
+            return client.lrange(key, 0, -1)
+
+    @classmethod
+    def read_window(cls, conn, key, serializer, created_at__gt, created_at__lt, count):
+        """
+        Return the objects in the window, whether the window reaches
+        the end of the list, and the length of the list.
+        """
+        if created_at__gt is None and created_at__lt is None and count is not None:
+            # the first page is the head of the list
+            pipeline = conn.pipeline()
+            pipeline.llen(key)
+            pipeline.lrange(key, 0, count - 1)
+            with raise_stale_on_wrong_type(key):
+                length, serialized_list = pipeline.execute()
+            objects = deserialize_all(key, serializer, serialized_list)
+            return objects, count >= length, length
+
+        # The list is trimmed to REDIS_LIST_LENGTH_LIMIT, reading all of it
+        # is one round trip, rather than one LINDEX per step of the search.
+        serialized_list = cls.read_all(conn, key)
+        length = len(serialized_list)
+        if not length:
+            return [], True, 0
+
+        def get_object(index):
+            return deserialize_all(key, serializer, [serialized_list[index]])[0]
+
+        start, end = get_window(length, get_object, created_at__gt, created_at__lt, count)
+        objects = deserialize_all(key, serializer, serialized_list[start:end])
+        return objects, end >= length, length
+
+
+class SortedSetBackend:
+    """
+    Objects are kept in a sorted set scored by created_at, so pushing the
+    same object twice is idempotent, a window is read by ZREVRANGEBYSCORE
+    and an object is removed in O(log n).
+    """
+    key_type = 'zset'
+    push_script = SORTED_SET_PUSH_SCRIPT
+    remove_script = SORTED_SET_REMOVE_SCRIPT
+
+    @classmethod
+    def get_length(cls, client, key):
+        with raise_stale_on_wrong_type(key):
+            return client.zcard(key)
+
+    @classmethod
+    def write(cls, client, key, serialized_list, objects):
+        client.zadd(key, {
+            serialized_data: get_score(obj.created_at)
+            for serialized_data, obj in zip(serialized_list, objects)
+        })
+
+    @classmethod
+    def read_all(cls, client, key):
+        with raise_stale_on_wrong_type(key):
+            return client.zrevrange(key, 0, -1)
+
+    @classmethod
+    def read_window(cls, conn, key, serializer, created_at__gt, created_at__lt, count):
+        """
+        Return the objects in the window, whether the window reaches
+        the end of the sorted set, and the size of the sorted set.
+        """
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.zcard(key)
+        if created_at__gt is not None:
+            min_score = '({}'.format(get_score(created_at__gt))
+            pipeline.zrevrangebyscore(key, '+inf', min_score)
+            # the window reaches the end if nothing is older than it
+            pipeline.zcount(key, '-inf', get_score(created_at__gt))
+        else:
+            max_score = '+inf'
+            if created_at__lt is not None:
+                max_score = '({}'.format(get_score(created_at__lt))
+            if count is None:
+                pipeline.zrevrangebyscore(key, max_score, '-inf')
+            else:
+                # one more object to check if the window reaches the end
+                pipeline.zrevrangebyscore(key, max_score, '-inf', start=0, num=count + 1)
+        with raise_stale_on_wrong_type(key):
+            length, serialized_list, *older_count = pipeline.execute()
+        if not length:
+            return [], True, 0
+
+        objects = deserialize_all(key, serializer, serialized_list)
+        if created_at__gt is not None:
+            return objects, older_count[0] == 0, length
+        if count is None:
+            return objects, True, length
+        return objects[:count], len(objects) <= count, length
+
+
+BACKENDS = {
+    ListBackend.key_type: ListBackend,
+    SortedSetBackend.key_type: SortedSetBackend,
+}
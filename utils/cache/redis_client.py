@@ -1,21 +1,138 @@
 from django.conf import settings
+import bisect
+import hashlib
+import os
 import redis
 
 
+class HashRing:
+    """
+    Consistent hashing of keys to nodes. Every node is placed at many points
+    (virtual nodes) of the ring, a key belongs to the first point after
+    its hash, so adding or removing a node only moves about 1/n of the keys.
+    """
+
+    def __init__(self, nodes, replicas):
+        self.points = []
+        self.nodes = []
+        for node in nodes:
+            for replica in range(replicas):
+                self.points.append(self.hash('{}#{}'.format(node, replica)))
+                self.nodes.append(node)
+        order = sorted(range(len(self.points)), key=self.points.__getitem__)
+        self.points = [self.points[index] for index in order]
+        self.nodes = [self.nodes[index] for index in order]
+
+    @classmethod
+    def hash(cls, value):
+        return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+    @classmethod
+    def get_hash_tag(cls, key):
+        """
+        Only the part in the first {...} of a key is hashed if it is not empty,
+        same as Redis Cluster, so e.g. 'rebuilding:{newsfeeds:1}:token' is on
+        the node of 'newsfeeds:1'.
+        """
+        start = key.find('{')
+        if start != -1:
+            end = key.find('}', start + 1)
+            if end > start + 1:
+                return key[start + 1:end]
+        return key
+
+    def get_node(self, key):
+        index = bisect.bisect(self.points, self.hash(self.get_hash_tag(key)))
+        return self.nodes[index % len(self.nodes)]
+
+
 class RedisClient:
-    conn = None
+    """
+    Clients of the nodes in settings.REDIS_NODES, each one has a connection pool.
+    Timeline keys are spread over the nodes by consistent hashing,
+    get their connection by get_connection(key). The other keys (job queues,
+    tombstones, stats, etc.) are on the first node, see get_connection().
+    Pools are created per process, a forked process (e.g. a worker forked
+    from a preloaded master) creates its own pools on first use.
+    """
+    pid = None
+    clients = None
+    ring = None
+    blocking_client = None
 
     @classmethod
-    def get_connection(cls):
-        # there is only one connection
-        if cls.conn:
-            return cls.conn
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB
+    def _create_client(cls, node, socket_timeout):
+        pool = redis.BlockingConnectionPool(
+            host=node['host'],
+            port=node['port'],
+            db=node.get('db', 0),
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            retry_on_timeout=settings.REDIS_RETRY_ON_TIMEOUT,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
         )
-        return cls.conn
+        return redis.Redis(connection_pool=pool)
+
+    @classmethod
+    def _get_clients(cls):
+        pid = os.getpid()
+        if cls.clients is None or cls.pid != pid:
+            # Connections inherited from the parent process are dropped rather
+            # than disconnected, closing them would break the parent's sockets.
+            names = [
+                '{}:{}/{}'.format(node['host'], node['port'], node.get('db', 0))
+                for node in settings.REDIS_NODES
+            ]
+            cls.clients = {
+                name: cls._create_client(node, settings.REDIS_SOCKET_TIMEOUT)
+                for name, node in zip(names, settings.REDIS_NODES)
+            }
+            cls.ring = HashRing(names, settings.REDIS_VIRTUAL_NODES)
+            cls.blocking_client = None
+            cls.pid = pid
+        return cls.clients
+
+    @classmethod
+    def get_connection(cls, key=None):
+        """
+        Return the client of the node holding the key,
+        or the first node if the key is not given.
+        """
+        clients = cls._get_clients()
+        if key is None or len(clients) == 1:
+            return next(iter(clients.values()))
+        return clients[cls.ring.get_node(key)]
+
+    @classmethod
+    def get_blocking_connection(cls):
+        """
+        Return a client of the first node without socket timeout, for the
+        commands blocking longer than REDIS_SOCKET_TIMEOUT, e.g. BRPOPLPUSH
+        of the job queue. They would time out on the shared pool.
+        """
+        cls._get_clients()
+        if cls.blocking_client is None:
+            cls.blocking_client = cls._create_client(settings.REDIS_NODES[0], socket_timeout=None)
+        return cls.blocking_client
+
+    @classmethod
+    def get_all_connections(cls):
+        return list(cls._get_clients().values())
+
+    @classmethod
+    def group_by_connection(cls, items, get_key=lambda item: item):
+        """
+        Group the items by the node of their keys, so that the commands
+        of each node can be sent in a pipeline.
+        Return a list of (client, items) in the order of the nodes first seen.
+        """
+        groups = {}
+        for item in items:
+            conn = cls.get_connection(get_key(item))
+            groups.setdefault(id(conn), (conn, []))[1].append(item)
+        return list(groups.values())
 
     @classmethod
     def clear(cls):
@@ -24,5 +141,5 @@ class RedisClient:
         """
         if not settings.TESTING:
             return Exception("You can not flush Redis in production environment")
-        conn = cls.get_connection()
-        conn.flushdb()
\ No newline at end of file
+        for conn in cls.get_all_connections():
+            conn.flushdb()
@@ -1,51 +1,457 @@
+from utils.cache.redis_backends import (
+    BACKENDS,
+    ListBackend,
+    StaleListError,
+    deserialize_all,
+    get_score,
+    get_window,
+)
+from utils.cache.metrics import CacheMetrics
 from utils.cache.redis_client import RedisClient
 from utils.cache.redis_serializers import DjangoModelSerializer
 from django.conf import settings
+from redis.exceptions import WatchError
+from twitter.cache import REBUILD_DIRTY_PATTERN, REBUILD_LOCK_PATTERN, REBUILD_TEMP_PATTERN
+
+import heapq
+import time
+import uuid
+
+# Delete the lock only if it is still held by the token,
+# a lock expired and taken by another process is not released.
+# KEYS[1]: lock key, ARGV[1]: token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# Rename the rebuilt timeline to the key, unless an object was pushed to the
+# key meanwhile, then the rebuilt timeline may miss it and is dropped.
+# KEYS[1]: temporary key, KEYS[2]: key, KEYS[3]: dirty marker
+RENAME_UNLESS_DIRTY_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('DEL', KEYS[1], KEYS[3])
+    return 0
+end
+redis.call('RENAME', KEYS[1], KEYS[2])
+return 1
+"""
+# interval of checking whether a rebuild by another process is done
+REBUILD_POLL_INTERVAL = 0.01
+# times to load a timeline made dirty while rebuilding, then leave it uncached
+REBUILD_ATTEMPTS = 2
+
 
 class RedisHelper:
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
-        conn = RedisClient.get_connection()
+    def get_backend(cls, key):
+        """
+        Return the backend configured for the pattern of the key,
+        e.g. 'newsfeeds:{user_id}' for 'newsfeeds:1'. Lists by default.
+        """
+        for pattern, key_type in settings.REDIS_TIMELINE_BACKENDS.items():
+            if key.startswith(pattern.split('{')[0]):
+                return BACKENDS[key_type]
+        return ListBackend
+
+    @classmethod
+    def _load_objects_to_cache(cls, key, objects, serializer=DjangoModelSerializer):
+        """
+        Write the objects under a temporary key and rename it to the key,
+        so readers never see a partially written timeline, and a timeline
+        cached meanwhile is replaced rather than appended with duplicates.
+        Return the number of bytes written, or None if the timeline is
+        marked dirty meanwhile and is not written, see push_object().
+        """
+        conn = RedisClient.get_connection(key)
 
-        serialized_list = []
         # Limit the Redis cache size to avoid large memory usage
         # If data beyond the limit, retrieve from DB
-        for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
-            serialized_list.append(serialized_data)
+        objects = list(objects[:settings.REDIS_LIST_LENGTH_LIMIT])
+        serialized_list = [serializer.serialize(obj) for obj in objects]
+        if not serialized_list:
+            return 0
 
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        temp_key = REBUILD_TEMP_PATTERN.format(key=key, token=uuid.uuid4().hex)
+        pipeline = conn.pipeline(transaction=False)
+        cls.get_backend(key).write(pipeline, temp_key, serialized_list, objects)
+        pipeline.expire(temp_key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.eval(
+            RENAME_UNLESS_DIRTY_SCRIPT,
+            3,
+            temp_key,
+            key,
+            REBUILD_DIRTY_PATTERN.format(key=key),
+        )
+        if not pipeline.execute()[-1]:
+            return None
+        return sum(len(serialized_data) for serialized_data in serialized_list)
 
     @classmethod
-    def load_objects(cls, key, queryset):
-        conn = RedisClient.get_connection()
-        # cache hit
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
+    def _rebuild(cls, key, load_from_db, serializer, wait=True):
+        """
+        Rebuild the key on cache miss in single flight: only the process
+        holding the lock of the key calls `load_from_db()` and caches the
+        objects, instead of every concurrent request querying the DB.
+        The others wait for the rebuild if `wait` is set, and return None
+        if the key is cached meanwhile, it should be read from cache.
+        Otherwise they return `load_from_db()` without caching it.
+        """
+        conn = RedisClient.get_connection(key)
+        lock_key = REBUILD_LOCK_PATTERN.format(key=key)
+        token = uuid.uuid4().hex
+        # the lock expires in case the process dies while rebuilding
+        if conn.set(lock_key, token, nx=True, px=settings.REDIS_REBUILD_LOCK_TIMEOUT):
+            try:
+                # a marker left by an earlier rebuild
+                conn.delete(REBUILD_DIRTY_PATTERN.format(key=key))
+                for _ in range(REBUILD_ATTEMPTS):
+                    start = time.perf_counter()
+                    objects = load_from_db()
+                    size = cls._load_objects_to_cache(key, objects, serializer)
+                    if size is not None:
+                        CacheMetrics.record_rebuild(
+                            CacheMetrics.get_pattern(key),
+                            time.perf_counter() - start,
+                            size,
+                        )
+                        break
+            finally:
+                conn.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+            return objects
+
+        if not wait:
+            return None
+        deadline = time.monotonic() + settings.REDIS_REBUILD_WAIT_TIME
+        while time.monotonic() < deadline:
+            pipeline = conn.pipeline(transaction=False)
+            pipeline.exists(key)
+            pipeline.exists(lock_key)
+            key_exists, is_locked = pipeline.execute()
+            if key_exists:
+                return None
+            # nothing is cached, e.g. the timeline is empty
+            if not is_locked:
+                break
+            time.sleep(REBUILD_POLL_INTERVAL)
+        return load_from_db()
+
+    @classmethod
+    def load_objects(cls, key, queryset, serializer=DjangoModelSerializer):
+        conn = RedisClient.get_connection(key)
+        backend = cls.get_backend(key)
+
+        def load_from_cache():
+            try:
+                # cache hit
+                if backend.get_length(conn, key):
+                    return deserialize_all(key, serializer, backend.read_all(conn, key))
+            except StaleListError:
+                # written by an old schema or another backend, load it again
+                conn.delete(key)
+            return None
+
+        objects = load_from_cache()
+        if objects is not None:
+            CacheMetrics.record_hits(CacheMetrics.get_pattern(key))
             return objects
         # cache miss
-        cls._load_objects_to_cache(key, queryset)
-        return list(queryset)
+        CacheMetrics.record_misses(CacheMetrics.get_pattern(key))
+        objects = cls._rebuild(key, lambda: list(queryset), serializer)
+        if objects is None:
+            # rebuilt by another process, the key may be gone again in rare cases
+            objects = load_from_cache()
+        if objects is None:
+            objects = list(queryset)
+        return objects
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
-        conn = RedisClient.get_connection()
+    def warm_up(cls, key, queryset, serializer=DjangoModelSerializer):
+        """
+        Load the timeline from DB if it is not cached. Skipped if another
+        process is rebuilding it. Return whether it is loaded from DB.
+        """
+        conn = RedisClient.get_connection(key)
+        if conn.exists(key):
+            return False
+        objects = cls._rebuild(
+            key,
+            lambda: list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT]),
+            serializer,
+            wait=False,
+        )
+        return objects is not None
+
+    @classmethod
+    def load_objects_in_window(
+        cls,
+        key,
+        queryset,
+        serializer=DjangoModelSerializer,
+        created_at__gt=None,
+        created_at__lt=None,
+        count=None,
+    ):
+        """
+        Load a window of the timeline ordered by created_at desc:
+        the objects newer than `created_at__gt`, or at most `count` objects
+        older than `created_at__lt` (from the newest one if it is not given).
+        Only the window and the entries probed to find it are deserialized.
+        Return the objects and whether the window holds all the wanted data:
+        no more data after it, or all the data newer than `created_at__gt`.
+        """
+        conn = RedisClient.get_connection(key)
+
+        def load_from_cache():
+            try:
+                objects, reaches_end, length = cls.get_backend(key).read_window(
+                    conn, key, serializer,
+                    created_at__gt, created_at__lt, count,
+                )
+                # an empty timeline is not cached, so length 0 means cache miss
+                if length:
+                    return objects, cls._is_complete(reaches_end, length, created_at__gt)
+            except StaleListError:
+                conn.delete(key)
+            return None
+
+        result = load_from_cache()
+        if result is not None:
+            CacheMetrics.record_hits(CacheMetrics.get_pattern(key))
+            return result
         # cache miss
-        if not conn.exists(key):
-            cls._load_objects_to_cache(key, queryset)
-            return
-        # cache hit
-        serialized_data = DjangoModelSerializer.serialize(obj)
+        CacheMetrics.record_misses(CacheMetrics.get_pattern(key))
+
+        def load_from_db():
+            return list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+
+        objects = cls._rebuild(key, load_from_db, serializer)
+        if objects is None:
+            # rebuilt by another process
+            result = load_from_cache()
+            if result is not None:
+                return result
+            objects = load_from_db()
+        start, end = get_window(
+            len(objects), objects.__getitem__,
+            created_at__gt, created_at__lt, count,
+        )
+        return objects[start:end], cls._is_complete(
+            end >= len(objects),
+            len(objects),
+            created_at__gt,
+        )
+
+    @classmethod
+    def _is_complete(cls, reaches_end, length, created_at__gt=None):
+        # a timeline reaching the limit may have more data in DB
+        is_full = length >= settings.REDIS_LIST_LENGTH_LIMIT
+        if created_at__gt is not None:
+            # newer objects may be missing only if all cached objects are newer
+            return not (reaches_end and is_full)
+        return reaches_end and not is_full
+
+    @classmethod
+    def push_object(cls, key, obj, queryset, serializer=DjangoModelSerializer):
         """
-        A list is needed to maintain tweets by timeline.
+        A timeline is needed to maintain tweets by created_at.
         This is the reason for using Redis to cache tweets.
         """
-        conn.lpush(key, serialized_data)
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
\ No newline at end of file
+        # cache hit
+        if cls.push_objects([(key, obj)], serializer):
+            return
+        # cache miss, skipped if another process is rebuilding the key,
+        # the push above marked it dirty so that the rebuild loads it again
+        cls._rebuild(
+            key,
+            lambda: list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT]),
+            serializer,
+            wait=False,
+        )
+
+    @classmethod
+    def _run_script(cls, script_name, key_object_pairs, serializer):
+        """
+        Run the script of the backend of each key in pipelines, e.g. push
+        a newsfeed to every follower's timeline. Keys are grouped by node
+        and sent in chunks, each chunk costs one network round trip.
+        Return the sum of the results.
+        """
+        chunk_size = settings.REDIS_PIPELINE_CHUNK_SIZE
+        total = 0
+        for conn, pairs in RedisClient.group_by_connection(
+            key_object_pairs,
+            get_key=lambda pair: pair[0],
+        ):
+            script_shas = {}
+            for start in range(0, len(pairs), chunk_size):
+                pipeline = conn.pipeline(transaction=False)
+                for key, obj in pairs[start: start + chunk_size]:
+                    backend = cls.get_backend(key)
+                    if backend not in script_shas:
+                        # loading an existing script is a no-op, it just returns the sha
+                        script_shas[backend] = conn.script_load(getattr(backend, script_name))
+                    pipeline.evalsha(
+                        script_shas[backend],
+                        3,
+                        key,
+                        REBUILD_LOCK_PATTERN.format(key=key),
+                        REBUILD_DIRTY_PATTERN.format(key=key),
+                        serializer.serialize(obj),
+                        settings.REDIS_LIST_LENGTH_LIMIT,
+                        get_score(obj.created_at) if obj.created_at else 0,
+                        settings.REDIS_REBUILD_LOCK_TIMEOUT,
+                    )
+                total += sum(pipeline.execute())
+        return total
+
+    @classmethod
+    def push_objects(cls, key_object_pairs, serializer=DjangoModelSerializer):
+        """
+        Push one object to each key, e.g. a newsfeed to every follower's timeline.
+        Check, push and trim of a key are done in one server-side call,
+        instead of 3 round trips (EXISTS, LPUSH, LTRIM) per key.
+        Unlike push_object(), keys not in cache are skipped rather than loaded
+        from DB, they will be loaded on the next read. A key being rebuilt is
+        marked dirty instead, the rebuild may have read DB before the object.
+        Return the number of keys pushed.
+        """
+        return cls._run_script('push_script', key_object_pairs, serializer)
+
+    @classmethod
+    def remove_entries(cls, key_object_pairs, serializer=DjangoModelSerializer):
+        """
+        Remove each object from its key by the serialized entry,
+        which is O(log n) for sorted sets and O(n) for lists.
+        A timeline reaching the limit is deleted instead, see remove_objects().
+        Return the number of entries removed.
+        """
+        return cls._run_script('remove_script', key_object_pairs, serializer)
+
+    @classmethod
+    def _rewrite_objects(cls, key, rewrite, serializer=DjangoModelSerializer):
+        """
+        Read the cached timeline, call `rewrite(objects)` and save the returned list.
+        Nothing is changed if the timeline is not cached or `rewrite` returns None.
+        The key is watched, if it is changed by others (e.g. a new object is pushed)
+        during the rewrite, the rewrite is retried to avoid losing the change.
+        """
+        conn = RedisClient.get_connection(key)
+        backend = cls.get_backend(key)
+        with conn.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(key)
+                    try:
+                        if not backend.get_length(pipeline, key):
+                            return
+                        objects = rewrite(
+                            deserialize_all(key, serializer, backend.read_all(pipeline, key)),
+                        )
+                    except StaleListError:
+                        # written by an old schema or another backend, drop it
+                        objects = []
+                    if objects is None:
+                        return
+                    pipeline.multi()
+                    pipeline.delete(key)
+                    if objects:
+                        backend.write(
+                            pipeline,
+                            key,
+                            [serializer.serialize(obj) for obj in objects],
+                            objects,
+                        )
+                        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                    pipeline.execute()
+                    return
+                except WatchError:
+                    continue
+
+    @classmethod
+    def merge_objects(cls, key, objects, unique_key, serializer=DjangoModelSerializer):
+        """
+        Merge objects into the cached timeline by created_at.
+        Objects having the same `unique_key(obj)` as a cached one are ignored.
+        """
+        def merge(cached_objects):
+            cached_keys = set(unique_key(obj) for obj in cached_objects)
+            new_objects = [obj for obj in objects if unique_key(obj) not in cached_keys]
+            if not new_objects:
+                return None
+            new_objects.sort(key=lambda obj: obj.created_at, reverse=True)
+            merged_objects = heapq.merge(
+                cached_objects,
+                new_objects,
+                key=lambda obj: obj.created_at,
+                reverse=True,
+            )
+            return list(merged_objects)[:settings.REDIS_LIST_LENGTH_LIMIT]
+
+        cls._rewrite_objects(key, merge, serializer)
+
+    @classmethod
+    def remove_objects(cls, key, select_removed, serializer=DjangoModelSerializer):
+        """
+        Remove the objects returned by `select_removed(cached_objects)` from the timeline.
+        """
+        def remove(cached_objects):
+            removed_objects = select_removed(cached_objects)
+            if not removed_objects:
+                return None
+            # A list reaching the limit is treated as having more data in DB.
+            # It can not be refilled here, drop it and load again on next read,
+            # otherwise the shorter list would be treated as holding all the data.
+            if len(cached_objects) >= settings.REDIS_LIST_LENGTH_LIMIT:
+                return []
+            removed_ids = set(id(obj) for obj in removed_objects)
+            return [obj for obj in cached_objects if id(obj) not in removed_ids]
+
+        cls._rewrite_objects(key, remove, serializer)
+
+    @classmethod
+    def convert_backend(cls, key, serializer=DjangoModelSerializer):
+        """
+        Convert a timeline written by another backend to the backend
+        configured for the key, the entries and the TTL are kept.
+        Return whether the key is converted.
+        """
+        conn = RedisClient.get_connection(key)
+        backend = cls.get_backend(key)
+        with conn.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(key)
+                    key_type = pipeline.type(key).decode()
+                    if key_type == backend.key_type or key_type not in BACKENDS:
+                        return False
+                    serialized_list = BACKENDS[key_type].read_all(pipeline, key)
+                    try:
+                        objects = deserialize_all(key, serializer, serialized_list)
+                    except StaleListError:
+                        # written by an old schema, drop it
+                        objects = []
+                    ttl = pipeline.pttl(key)
+                    pipeline.multi()
+                    pipeline.delete(key)
+                    if objects:
+                        backend.write(pipeline, key, serialized_list, objects)
+                        if ttl > 0:
+                            pipeline.pexpire(key, ttl)
+                    pipeline.execute()
+                    return True
+                except WatchError:
+                    continue
+
+    @classmethod
+    def delete_keys(cls, keys):
+        """
+        Delete the keys in one round trip per node.
+        Return the number of keys deleted.
+        """
+        deleted = 0
+        for conn, node_keys in RedisClient.group_by_connection(keys):
+            deleted += conn.delete(*node_keys)
+        return deleted
@@ -1,6 +1,15 @@
+from django.conf import settings
 from django.core import serializers
+from django.utils import timezone
 from utils.cache.json_encoder import JSONEncoder
 
+import datetime
+import json
+import struct
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
 
 class DjangoModelSerializer:
 
@@ -14,4 +23,260 @@ class DjangoModelSerializer:
     @classmethod
     def deserialize(cls, serialized_data):
         # `.object` is used to get
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+class JSONCodec:
+    """
+    Encode the field values as a JSON array, datetimes in ISO 8601.
+    """
+
+    @classmethod
+    def encode(cls, entry_serializer, values):
+        return json.dumps(values, cls=JSONEncoder, separators=(',', ':'))
+
+    @classmethod
+    def decode(cls, entry_serializer, data):
+        """
+        Return the raw values, each one is converted by convert() when it is read.
+        """
+        values = json.loads(data)
+        if len(values) != len(entry_serializer.field_names):
+            return None
+        return values
+
+    @classmethod
+    def get_converters(cls, entry_serializer):
+        """
+        Return the function converting the raw value of each field,
+        or None if the raw value is used as it is.
+        """
+        return [field.to_python for field in entry_serializer.get_fields()]
+
+
+class StructCodec:
+    """
+    Pack the field values as little-endian 8-byte integers,
+    datetimes are stored as microseconds since epoch.
+    Layout: magic byte, schema version, null bitmap, values.
+    Only integer and datetime fields are supported, 8 fields at most.
+    """
+    MAGIC = 0
+    _structs = {}
+
+    @classmethod
+    def get_struct(cls, entry_serializer):
+        if entry_serializer not in cls._structs:
+            cls._structs[entry_serializer] = struct.Struct(
+                '<BBB' + 'q' * len(entry_serializer.field_names),
+            )
+        return cls._structs[entry_serializer]
+
+    @classmethod
+    def encode(cls, entry_serializer, values):
+        null_bitmap = 0
+        packed_values = []
+        for index, value in enumerate(values):
+            if value is None:
+                null_bitmap |= 1 << index
+                value = 0
+            elif isinstance(value, datetime.datetime):
+                value = (value - EPOCH) // ONE_MICROSECOND
+            packed_values.append(value)
+        return cls.get_struct(entry_serializer).pack(
+            cls.MAGIC,
+            entry_serializer.schema_version,
+            null_bitmap,
+            *packed_values,
+        )
+
+    @classmethod
+    def decode(cls, entry_serializer, data):
+        entry_struct = cls.get_struct(entry_serializer)
+        # written by another schema version
+        if len(data) != entry_struct.size or data[1] != entry_serializer.schema_version:
+            return None
+        _, _, null_bitmap, *values = entry_struct.unpack(data)
+        if null_bitmap:
+            for index in range(len(values)):
+                if null_bitmap & (1 << index):
+                    values[index] = None
+        return values
+
+    @classmethod
+    def get_converters(cls, entry_serializer):
+        return [
+            to_datetime if field.get_internal_type() == 'DateTimeField' else None
+            for field in entry_serializer.get_fields()
+        ]
+
+
+def to_datetime(microseconds):
+    if microseconds is None:
+        return None
+    return EPOCH + microseconds * ONE_MICROSECOND
+
+
+CODECS = {
+    'json': JSONCodec,
+    'struct': StructCodec,
+}
+
+
+class CachedEntry:
+    """
+    Read-only view of an entry of a cached timeline, it is deserialized
+    instead of a model instance to skip model __init__(), init signals and
+    the conversion of fields which are not read. A field is converted
+    on its first access. The subclass of each serializer is created by
+    ModelEntrySerializer.get_entry_class().
+
+    Only `field_names` are readable. The related objects of foreign keys
+    in `field_names` can be set, e.g. `newsfeed.tweet` filled from Memcached.
+    """
+    __slots__ = ('_converters', '_values', '_converted')
+    entry_serializer = None
+
+    def __init__(self, converters, values):
+        self._converters = converters
+        self._values = values
+        self._converted = 0
+
+    def _get_value(self, index):
+        convert = self._converters[index]
+        if convert is None or self._converted & (1 << index):
+            return self._values[index]
+        value = self._values[index] = convert(self._values[index])
+        self._converted |= 1 << index
+        return value
+
+    @property
+    def pk(self):
+        return self.id
+
+    def serializable_value(self, field_name):
+        # used by rest framework to read the id of a related object
+        field = self.entry_serializer.model_class._meta.get_field(field_name)
+        return getattr(self, field.attname)
+
+    def to_model(self):
+        """
+        Return the model instance of the entry, other fields are deferred.
+        """
+        attnames, indexes = self.entry_serializer.get_load_order()
+        return self.entry_serializer.model_class.from_db(
+            None,
+            attnames,
+            [self._get_value(index) for index in indexes],
+        )
+
+    def __repr__(self):
+        return '<{}: {}>'.format(self.__class__.__name__, self.pk)
+
+
+def make_field_property(index):
+    def get_value(entry):
+        # same as _get_value(), inlined as it is called for every field read
+        convert = entry._converters[index]
+        if convert is None or entry._converted & (1 << index):
+            return entry._values[index]
+        value = entry._values[index] = convert(entry._values[index])
+        entry._converted |= 1 << index
+        return value
+    return property(get_value)
+
+
+class ModelEntrySerializer:
+    """
+    Serialize only `field_names` of an instance,
+    e.g. the id and created_at of a tweet in a timeline.
+    They are deserialized as read-only CachedEntry objects,
+    the caller fills the other data from Memcached.
+
+    Entries are written by the codec of settings.REDIS_ENTRY_CODEC.
+    Reading detects the format of each entry, so lists written by
+    another codec or by DjangoModelSerializer are still readable.
+    Bump `schema_version` when `field_names` changes, the entries of
+    other versions are deserialized as None.
+    """
+    model_class = None
+    field_names = ()
+    schema_version = 1
+
+    @classmethod
+    def get_fields(cls):
+        # looked up once per serializer class
+        if '_fields' not in cls.__dict__:
+            cls._fields = [cls.model_class._meta.get_field(name) for name in cls.field_names]
+        return cls._fields
+
+    @classmethod
+    def get_load_order(cls):
+        """
+        `from_db()` takes the values in the order of model fields,
+        return the attnames in that order and their indexes in `field_names`.
+        """
+        if '_load_order' not in cls.__dict__:
+            attnames = [
+                field.attname
+                for field in cls.model_class._meta.concrete_fields
+                if field.attname in cls.field_names
+            ]
+            cls._load_order = (
+                attnames,
+                [cls.field_names.index(attname) for attname in attnames],
+            )
+        return cls._load_order
+
+    @classmethod
+    def get_converters(cls, codec):
+        if '_converters' not in cls.__dict__:
+            cls._converters = {}
+        if codec not in cls._converters:
+            cls._converters[codec] = codec.get_converters(cls)
+        return cls._converters[codec]
+
+    @classmethod
+    def get_entry_class(cls):
+        """
+        Return the CachedEntry subclass having a property of each field,
+        and a slot of the related object of each foreign key.
+        """
+        if '_entry_class' not in cls.__dict__:
+            attrs = {
+                '__slots__': tuple(
+                    field.name
+                    for field in cls.get_fields()
+                    if field.is_relation and field.attname != field.name
+                ),
+                'entry_serializer': cls,
+            }
+            for index, name in enumerate(cls.field_names):
+                attrs[name] = make_field_property(index)
+            cls._entry_class = type(
+                '{}Entry'.format(cls.model_class.__name__),
+                (CachedEntry,),
+                attrs,
+            )
+        return cls._entry_class
+
+    @classmethod
+    def serialize(cls, instance):
+        codec = CODECS[settings.REDIS_ENTRY_CODEC]
+        return codec.encode(cls, [getattr(instance, name) for name in cls.field_names])
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if isinstance(serialized_data, str):
+            serialized_data = serialized_data.encode()
+        if serialized_data[0] == StructCodec.MAGIC:
+            codec = StructCodec
+        # entries written by DjangoModelSerializer are JSON arrays of objects
+        elif serialized_data.startswith(b'[{'):
+            return DjangoModelSerializer.deserialize(serialized_data)
+        else:
+            codec = JSONCodec
+        values = codec.decode(cls, serialized_data)
+        if values is None:
+            return None
+        return cls.get_entry_class()(cls.get_converters(codec), values)
@@ -0,0 +1,119 @@
+"""
+Denormalized counters of objects, e.g. the likes_count of a tweet.
+
+A counter is a field of the model, changed by F() expressions when likes
+and comments are created or deleted, so a page needs no COUNT(*) query.
+The counters of objects being read are mirrored in the Redis hash
+OBJECT_COUNTS_PATTERN: the updates of a row are not written to its cached
+object in Memcached, the counts are read from the hash instead.
+A counter missing in the hash is loaded from DB when it is read, and only
+counters in the hash are incremented. Drift, e.g. after a failed commit,
+is fixed by `python manage.py reconcile_counts`.
+"""
+from django.conf import settings
+from django.db.models import F
+from twitter.cache import OBJECT_COUNTS_PATTERN
+from utils.cache.metrics import CacheMetrics
+from utils.cache.redis_client import RedisClient
+from utils.cache.redis_helper import RedisHelper
+
+# attribute of an instance holding its counters prefetched from Redis
+PREFETCHED_COUNTS_ATTR = '_prefetched_counts'
+
+INCR_COUNT_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+return nil
+"""
+
+
+class CounterService:
+
+    @classmethod
+    def get_key(cls, model_class, object_id):
+        return OBJECT_COUNTS_PATTERN.format(
+            model_name=model_class.__name__,
+            object_id=object_id,
+        )
+
+    @classmethod
+    def incr(cls, model_class, object_id, attr, delta=1):
+        """
+        Add delta to the counter in DB and to its mirror in Redis. The mirror
+        is changed right away, if the transaction is rolled back it is off by
+        delta until it expires or the counters are reconciled.
+        """
+        model_class.objects.filter(id=object_id).update(**{attr: F(attr) + delta})
+        key = cls.get_key(model_class, object_id)
+        RedisClient.get_connection(key).eval(INCR_COUNT_SCRIPT, 1, key, attr, delta)
+
+    @classmethod
+    def get_counts(cls, model_class, object_ids, attr):
+        """
+        Return a dict of id to the counter of the objects, read from Redis
+        in a pipeline per node, the missing counters are loaded from DB
+        in one query. Ids not found in DB are not in the dict.
+        """
+        keys = {object_id: cls.get_key(model_class, object_id) for object_id in set(object_ids)}
+        counts = {}
+        for conn, items in RedisClient.group_by_connection(keys.items(), lambda item: item[1]):
+            pipeline = conn.pipeline(transaction=False)
+            for _, key in items:
+                pipeline.hget(key, attr)
+            for (object_id, _), count in zip(items, pipeline.execute()):
+                if count is not None:
+                    counts[object_id] = int(count)
+        CacheMetrics.record_hits(OBJECT_COUNTS_PATTERN, len(counts))
+
+        missed_ids = [object_id for object_id in keys if object_id not in counts]
+        if not missed_ids:
+            return counts
+        CacheMetrics.record_misses(OBJECT_COUNTS_PATTERN, len(missed_ids))
+        loaded_counts = {
+            object_id: count or 0
+            for object_id, count in model_class.objects.filter(
+                id__in=missed_ids,
+            ).values_list('id', attr)
+        }
+        for conn, items in RedisClient.group_by_connection(
+            loaded_counts.items(),
+            lambda item: keys[item[0]],
+        ):
+            pipeline = conn.pipeline(transaction=False)
+            for object_id, count in items:
+                # keep the counter loaded by a concurrent reader
+                pipeline.hsetnx(keys[object_id], attr, count)
+                pipeline.expire(keys[object_id], settings.REDIS_KEY_EXPIRE_TIME)
+            pipeline.execute()
+        counts.update(loaded_counts)
+        return counts
+
+    @classmethod
+    def prefetch_counts(cls, instances, attr):
+        """
+        Read the counter of the instances in bulk, so that get_count()
+        needs no more round trip.
+        """
+        instances = [instance for instance in instances if instance is not None]
+        if not instances:
+            return
+        counts = cls.get_counts(
+            instances[0].__class__,
+            [instance.id for instance in instances],
+            attr,
+        )
+        for instance in instances:
+            instance.__dict__.setdefault(PREFETCHED_COUNTS_ATTR, {})[attr] = counts.get(instance.id, 0)
+
+    @classmethod
+    def get_count(cls, instance, attr):
+        prefetched_counts = instance.__dict__.get(PREFETCHED_COUNTS_ATTR, {})
+        if attr in prefetched_counts:
+            return prefetched_counts[attr]
+        return cls.get_counts(instance.__class__, [instance.id], attr).get(instance.id, 0)
+
+    @classmethod
+    def invalidate_counts(cls, model_class, object_ids):
+        # the counters are loaded from DB on next read
+        RedisHelper.delete_keys([cls.get_key(model_class, object_id) for object_id in object_ids])
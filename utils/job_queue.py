@@ -0,0 +1,114 @@
+"""
+A light weight job queue backed by Redis lists.
+It is used to run slow tasks (such as fanout) out of the HTTP request,
+without requiring a message broker.
+
+- Jobs are pushed to the left of `job_queue:{queue}`, workers pop from the right.
+- A job being processed is kept in `job_queue:{queue}:processing`,
+  so the jobs of a crashed worker can be put back to the queue.
+- A failed job is retried JOB_QUEUE_MAX_RETRIES times, then moved to
+  `job_queue:{queue}:dead_letter` for manual inspection.
+"""
+from django.conf import settings
+from twitter.cache import (
+    JOB_QUEUE_PATTERN,
+    JOB_PROCESSING_PATTERN,
+    JOB_DEAD_LETTER_PATTERN,
+)
+from utils.cache.redis_client import RedisClient
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    # task name -> function, filled by the @JobQueue.register decorator
+    tasks = {}
+
+    @classmethod
+    def get_task_name(cls, func):
+        return '{}.{}'.format(func.__module__, func.__name__)
+
+    @classmethod
+    def register(cls, func):
+        """
+        Decorator to mark a function as a task that can be enqueued.
+        Arguments of the task must be JSON serializable.
+        """
+        cls.tasks[cls.get_task_name(func)] = func
+        return func
+
+    @classmethod
+    def enqueue(cls, func, queue='default', **kwargs):
+        payload = json.dumps({
+            'task': cls.get_task_name(func),
+            'kwargs': kwargs,
+            'attempts': 0,
+        })
+        # run the task in place, it is used for testing
+        if settings.JOB_QUEUE_ALWAYS_EAGER:
+            job = json.loads(payload)
+            return cls.tasks[job['task']](**job['kwargs'])
+
+        conn = RedisClient.get_connection()
+        conn.lpush(JOB_QUEUE_PATTERN.format(queue=queue), payload)
+
+    @classmethod
+    def requeue_unfinished_jobs(cls, queue='default'):
+        """
+        Put the jobs left in processing list back to the queue.
+        Only call it when no other worker is running on this queue.
+        """
+        conn = RedisClient.get_connection()
+        queue_key = JOB_QUEUE_PATTERN.format(queue=queue)
+        processing_key = JOB_PROCESSING_PATTERN.format(queue=queue)
+        count = 0
+        while conn.rpoplpush(processing_key, queue_key) is not None:
+            count += 1
+        return count
+
+    @classmethod
+    def run_next_job(cls, queue='default', timeout=5):
+        """
+        Block at most `timeout` seconds to wait for a job and run it.
+        Return False if there is no job in the queue.
+        """
+        conn = RedisClient.get_connection()
+        queue_key = JOB_QUEUE_PATTERN.format(queue=queue)
+        processing_key = JOB_PROCESSING_PATTERN.format(queue=queue)
+
+        payload = RedisClient.get_blocking_connection().brpoplpush(
+            queue_key,
+            processing_key,
+            timeout=timeout,
+        )
+        if payload is None:
+            return False
+
+        job = json.loads(payload)
+        try:
+            cls.tasks[job['task']](**job['kwargs'])
+        except Exception:
+            logger.exception('Job %s failed', job['task'])
+            cls._retry_or_bury(queue, job)
+        # the job is finished, either succeeded or rescheduled
+        conn.lrem(processing_key, 1, payload)
+        return True
+
+    @classmethod
+    def _retry_or_bury(cls, queue, job):
+        conn = RedisClient.get_connection()
+        job['attempts'] += 1
+        if job['attempts'] > settings.JOB_QUEUE_MAX_RETRIES:
+            key = JOB_DEAD_LETTER_PATTERN.format(queue=queue)
+        else:
+            key = JOB_QUEUE_PATTERN.format(queue=queue)
+        conn.lpush(key, json.dumps(job))
+
+    @classmethod
+    def get_dead_jobs(cls, queue='default'):
+        conn = RedisClient.get_connection()
+        key = JOB_DEAD_LETTER_PATTERN.format(queue=queue)
+        return [json.loads(payload) for payload in conn.lrange(key, 0, -1)]
@@ -1,3 +1,8 @@
 def invalidate_object_cache(sender, instance, **kwargs):
     from utils.cache.memcached_helper import MemcachedHelper
-    MemcachedHelper.invalidate_cached_object(sender, instance.id)
\ No newline at end of file
+    MemcachedHelper.invalidate_cached_object(sender, instance.id)
+
+
+def update_object_cache(sender, instance, **kwargs):
+    from utils.cache.memcached_helper import MemcachedHelper
+    MemcachedHelper.update_cached_object(sender, instance)
@@ -0,0 +1,14 @@
+from utils.cache.identity_map import IdentityMap
+
+
+class IdentityMapMiddleware:
+    """
+    Read each object through cache once per request, see utils/cache/identity_map.py.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with IdentityMap.scope():
+            return self.get_response(request)
@@ -3,6 +3,8 @@ from rest_framework.response import Response
 from dateutil import parser
 from django.conf import settings
 
+import heapq
+
 
 class EndlessPagination(BasePagination):
     page_size = 20 if settings.TESTING else 10
@@ -41,24 +43,46 @@ class EndlessPagination(BasePagination):
         self.has_next_page = len(ordered_list) > self.page_size
         return ordered_list[:self.page_size]
 
-    def paginate_cached_list(self, cached_list, request):
+    def get_cache_window(self, request):
+        """
+        The window of a cached list needed by the request,
+        it is passed to `RedisHelper.load_objects_in_window()`.
+        """
+        if 'created_at__gt' in request.query_params:
+            return {
+                'created_at__gt': parser.isoparse(request.query_params['created_at__gt']),
+            }
+        # one more object to check if there is next page
+        window = {'count': self.page_size + 1}
+        if 'created_at__lt' in request.query_params:
+            window['created_at__lt'] = parser.isoparse(request.query_params['created_at__lt'])
+        return window
+
+    def paginate_cached_list(self, cached_list, request, is_complete=None):
+        """
+        `is_complete` tells whether cached_list holds all the data.
+        By default, a list shorter than the limit of Redis list is complete.
+        """
         paginated_list = self.paginate_ordered_list(cached_list, request)
         # if getting latest data,
-        # return paginated_list since it contains the up-to-date data
+        # return paginated_list since it contains the up-to-date data,
+        # unless some of the newer data is known to be out of cache
         if 'created_at__gt' in request.query_params:
-            return paginated_list
+            return None if is_complete is False else paginated_list
         # if getting previous data,
         # `has_next_page == True` means wanted data is still in cached_list
         if self.has_next_page:
             return paginated_list
         # if length of cached_list less than the limit,
         # meaning all the data is in cache
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
+        if is_complete is None:
+            is_complete = len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT
+        if is_complete:
             return paginated_list
         # cached data is ran out, need to fetch new data from DB
         return None
 
-    def paginate_queryset(self, queryset, request, view=None):
+    def _filter_queryset(self, queryset, request):
         # refresh to get latest data
         if 'created_at__gt' in request.query_params:
             created_at__gt = request.query_params['created_at__gt']
@@ -69,10 +93,32 @@ class EndlessPagination(BasePagination):
             created_at__lt = request.query_params['created_at__lt']
             queryset = queryset.filter(created_at__lt=created_at__lt)
 
-        queryset = queryset.order_by('-created_at')[:self.page_size + 1]
+        # one more object to check if there is next page
+        return queryset.order_by('-created_at')[:self.page_size + 1]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self._filter_queryset(queryset, request)
         self.has_next_page = len(queryset) > self.page_size
         return queryset[:self.page_size]
 
+    def paginate_merged_querysets(self, querysets, request):
+        """
+        Paginate the querysets as if they were one queryset ordered by created_at.
+        Querysets can be of different models, e.g. newsfeeds and tweets.
+        """
+        pages = [
+            self._filter_queryset(queryset, request)
+            for queryset in querysets
+        ]
+        # k-way merge of the ordered pages
+        merged_list = list(heapq.merge(
+            *pages,
+            key=lambda obj: obj.created_at,
+            reverse=True,
+        ))
+        self.has_next_page = len(merged_list) > self.page_size
+        return merged_list[:self.page_size]
+
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
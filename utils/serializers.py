@@ -0,0 +1,38 @@
+from accounts.services import UserService
+from django.contrib.auth.models import User
+from django.db import models
+from rest_framework import serializers
+from utils.cache.memcached_helper import MemcachedHelper
+from utils.counters import CounterService
+
+
+class PrefetchThroughCacheListSerializer(serializers.ListSerializer):
+    """
+    Before rendering, prefetch the related objects in `Meta.prefetch_through_cache`
+    of the child serializer from Memcached, e.g. ('user',) for tweets or
+    ('tweet.user',) for newsfeeds. A page costs one get_many per relation
+    instead of a round trip per row, and the users' profiles are prefetched too.
+
+    The counters in `Meta.prefetch_counts`, e.g. ('tweet.likes_count',), are
+    read from Redis in bulk the same way, see CounterService.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        instances = list(iterable)
+        for path in getattr(self.child.Meta, 'prefetch_through_cache', ()):
+            *attrs, field_name = path.split('.')
+            targets = instances
+            for attr in attrs:
+                targets = [getattr(target, attr, None) for target in targets]
+            related_objects = MemcachedHelper.prefetch_related_objects(targets, field_name)
+            # users are rendered with their profiles
+            if related_objects and isinstance(related_objects[0], User):
+                UserService.prefetch_profiles(related_objects)
+        for path in getattr(self.child.Meta, 'prefetch_counts', ()):
+            *attrs, counter_name = path.split('.')
+            targets = instances
+            for attr in attrs:
+                targets = [getattr(target, attr, None) for target in targets]
+            CounterService.prefetch_counts(targets, counter_name)
+        return super().to_representation(instances)
@@ -7,6 +7,7 @@ from tweets.models import Tweet
 from comments.models import Comment
 from likes.models import Like
 from newsfeeds.models import NewsFeed
+from utils.cache.local_cache import LocalCache
 from utils.cache.redis_client import RedisClient
 from friendships.models import Friendship
 
@@ -16,6 +17,7 @@ class TestCase(DjangoTestCase):
     def clear_cache(self):
         caches['testing'].clear()
         RedisClient.clear()
+        LocalCache.clear()
 
     @property
     def anonymous_client(self):
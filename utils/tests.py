@@ -1,5 +1,113 @@
+from accounts.models import UserProfile
+from accounts.services import UserService
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache.backends.memcached import BaseMemcachedCache, MemcachedCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from datetime import timedelta
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from tweets.api.serializers import TweetSerializer
+from tweets.models import Tweet
+from rest_framework.test import APIClient
+from tweets.services import TweetEntrySerializer
+from twitter.cache import (
+    LOCAL_CACHE_CHANNEL,
+    REBUILD_LOCK_PATTERN,
+    USER_PROFILE_PATTERN,
+    USER_TWEETS_PATTERN,
+)
+from utils.cache.identity_map import IdentityMap
+from utils.cache.local_cache import LocalCache
+from utils.cache.metrics import CacheMetrics
+from utils.benchmark import RedisCounter, measure, percentile, summarize
 from utils.testcases import TestCase
-from utils.cache.redis_client import RedisClient
+from utils.cache.memcached_helper import (
+    CACHE_ALIAS,
+    MemcachedHelper,
+    cache as memcached,
+    cas_clients,
+    check_write_through_backend,
+    get_cache_version,
+    get_cas_client,
+)
+from utils.cache.memcached_serializers import IdSetSerializer, ObjectSerializer
+from utils.cache.redis_backends import BACKENDS
+from utils.cache.redis_client import HashRing, RedisClient
+from utils.cache.redis_helper import RedisHelper
+from utils.cache.redis_serializers import DjangoModelSerializer
+from utils.counters import CounterService
+from utils.job_queue import JobQueue
+from utils.middleware import IdentityMapMiddleware
+
+import memcache
+import threading
+import time
+
+
+executed_jobs = []
+
+
+@JobQueue.register
+def record_job(value):
+    executed_jobs.append(value)
+
+
+@JobQueue.register
+def failed_job():
+    raise ValueError('job failed')
+
+
+class InMemoryMemcacheClient(memcache.Client):
+    """
+    python-memcached client keeping the values in process, shared by all the
+    clients. cas() fails if the value is changed since gets(), as the server does.
+    """
+    values = {}
+    last_cas_id = 0
+
+    def _store(self, key, value):
+        InMemoryMemcacheClient.last_cas_id += 1
+        self.values[key] = (value, self.last_cas_id)
+
+    def get(self, key):
+        return self.values.get(key, (None, None))[0]
+
+    def gets(self, key):
+        value, cas_id = self.values.get(key, (None, None))
+        if cas_id is not None:
+            self.cas_ids[key] = cas_id
+        return value
+
+    def get_multi(self, keys, key_prefix=''):
+        return {key: self.values[key][0] for key in keys if key in self.values}
+
+    def set(self, key, value, time=0, min_compress_len=0, noreply=False):
+        self._store(key, value)
+        return True
+
+    def set_multi(self, mapping, time=0, key_prefix='', min_compress_len=0, noreply=False):
+        for key, value in mapping.items():
+            self._store(key, value)
+        return []
+
+    def add(self, key, value, time=0, min_compress_len=0, noreply=False):
+        if key in self.values:
+            return False
+        return self.set(key, value)
+
+    def cas(self, key, value, time=0, min_compress_len=0, noreply=False):
+        if key not in self.cas_ids:
+            return self.set(key, value)
+        if self.values.get(key, (None, None))[1] != self.cas_ids.pop(key):
+            return False
+        return self.set(key, value)
 
 
 class UtilsTests(TestCase):
@@ -19,4 +127,836 @@ class UtilsTests(TestCase):
         # Redis has nothing after flushing DB
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
-        self.assertEqual(cached_list, [])
\ No newline at end of file
+        self.assertEqual(cached_list, [])
+
+    def test_hash_ring(self):
+        ring = HashRing(['a', 'b', 'c'], 160)
+        keys = ['newsfeeds:{}'.format(user_id) for user_id in range(3000)]
+        nodes = [ring.get_node(key) for key in keys]
+        for node in ['a', 'b', 'c']:
+            self.assertEqual(nodes.count(node) > 600, True)
+        # keys with the same hash tag are on the same node
+        self.assertEqual(
+            ring.get_node('rebuilding:{newsfeeds:1}:token'),
+            ring.get_node('newsfeeds:1'),
+        )
+        # adding a node only moves the keys to the new node
+        new_ring = HashRing(['a', 'b', 'c', 'd'], 160)
+        moved = [
+            new_ring.get_node(key)
+            for key, node in zip(keys, nodes)
+            if new_ring.get_node(key) != node
+        ]
+        self.assertEqual(set(moved), {'d'})
+        self.assertEqual(len(moved) < len(keys) / 2, True)
+
+    def test_redis_nodes(self):
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        queryset = user.tweet_set.order_by('-created_at')
+        # two databases of the test server act as two nodes,
+        # the last database is used to keep the data of other databases
+        nodes = [
+            {'host': settings.REDIS_HOST, 'port': settings.REDIS_PORT, 'db': db}
+            for db in (settings.REDIS_DB, 15)
+        ]
+        try:
+            with self.settings(REDIS_NODES=nodes):
+                RedisClient.clients = None
+                RedisClient.clear()
+                keys = ['key:{}'.format(index) for index in range(10)]
+                groups = RedisClient.group_by_connection(keys)
+                self.assertEqual(len(groups), 2)
+
+                for key in keys:
+                    RedisHelper.load_objects(key, queryset)
+                self.assertEqual(
+                    RedisHelper.push_objects([(key, tweets[0]) for key in keys]),
+                    10,
+                )
+                for conn, node_keys in groups:
+                    self.assertEqual(conn.exists(*keys), len(node_keys))
+                    self.assertEqual(conn.llen(node_keys[0]), 4)
+                self.assertEqual(RedisHelper.delete_keys(keys), 10)
+
+                # a forked process creates its own connection pools
+                conn = RedisClient.get_connection()
+                RedisClient.pid = None
+                self.assertEqual(RedisClient.get_connection() is conn, False)
+                RedisClient.clear()
+        finally:
+            RedisClient.clients = None
+
+    def test_push_objects(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        RedisClient.clear()
+
+        conn.rpush('cached_key', 'old')
+        pushed = RedisHelper.push_objects([
+            ('cached_key', tweets[0]),
+            ('not_cached_key', tweets[1]),
+        ])
+        # keys not in cache are skipped
+        self.assertEqual(pushed, 1)
+        self.assertEqual(conn.exists('not_cached_key'), False)
+        self.assertEqual(conn.llen('cached_key'), 2)
+
+        # list length is limited
+        limit = settings.REDIS_LIST_LENGTH_LIMIT
+        pushed = RedisHelper.push_objects([
+            ('cached_key', tweets[i % 3]) for i in range(limit)
+        ])
+        self.assertEqual(pushed, limit)
+        self.assertEqual(conn.llen('cached_key'), limit)
+
+    def test_merge_and_remove_objects(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(4)]
+        queryset = user.tweet_set.order_by('-created_at')
+        RedisClient.clear()
+
+        # nothing changes if the key is not cached
+        RedisHelper.merge_objects('key', tweets, unique_key=lambda t: t.id)
+        self.assertEqual(conn.exists('key'), False)
+
+        RedisHelper.load_objects('key', queryset.filter(id__in=[tweets[0].id, tweets[2].id]))
+        RedisHelper.merge_objects('key', tweets[1:], unique_key=lambda t: t.id)
+        cached_tweets = RedisHelper.load_objects('key', queryset)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[::-1]])
+
+        RedisHelper.remove_objects('key', lambda objects: objects[1:3])
+        cached_tweets = RedisHelper.load_objects('key', queryset)
+        self.assertEqual([t.id for t in cached_tweets], [tweets[3].id, tweets[0].id])
+
+        # a list reaching the limit is deleted instead
+        with self.settings(REDIS_LIST_LENGTH_LIMIT=2):
+            RedisHelper.remove_objects('key', lambda objects: objects[:1])
+        self.assertEqual(conn.exists('key'), False)
+
+    def test_single_flight_rebuild(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        queryset = user.tweet_set.order_by('-created_at')
+        RedisClient.clear()
+
+        # another process is rebuilding, load from DB without caching
+        lock_key = REBUILD_LOCK_PATTERN.format(key='key')
+        conn.set(lock_key, 'other')
+        with self.settings(REDIS_REBUILD_WAIT_TIME=0):
+            cached_tweets = RedisHelper.load_objects('key', queryset)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[::-1]])
+        self.assertEqual(conn.exists('key'), False)
+        # waiting ends once the lock is released and nothing is cached
+        conn.set(lock_key, 'other', px=50)
+        cached_tweets, _ = RedisHelper.load_objects_in_window('key', queryset, count=2)
+        self.assertEqual([t.id for t in cached_tweets], [tweets[2].id, tweets[1].id])
+        self.assertEqual(conn.exists('key'), False)
+
+        # the lock is released after rebuilding
+        RedisHelper.load_objects('key', queryset)
+        self.assertEqual(conn.exists(lock_key), False)
+        self.assertEqual(conn.llen('key'), 3)
+        # a rebuild replaces the cached timeline instead of appending to it
+        RedisHelper._load_objects_to_cache('key', queryset)
+        self.assertEqual(conn.llen('key'), 3)
+        self.assertEqual(conn.ttl('key') > 0, True)
+        self.assertEqual(conn.keys('rebuilding:*'), [])
+
+    def test_push_while_rebuilding(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user')
+        self.create_tweet(user)
+        queryset = user.tweet_set.order_by('-created_at')
+        RedisClient.clear()
+        new_tweets = []
+
+        def load_from_db():
+            objects = list(queryset.all())
+            # a tweet is saved and pushed after the rebuild read DB
+            if not new_tweets:
+                new_tweets.append(self.create_tweet(user))
+                RedisHelper.push_object('key', new_tweets[0], queryset)
+            return objects
+
+        RedisHelper._rebuild('key', load_from_db, DjangoModelSerializer)
+        cached_tweets = RedisHelper.load_objects('key', queryset)
+        self.assertEqual(len(cached_tweets), 2)
+        self.assertIn(new_tweets[0].id, [t.id for t in cached_tweets])
+        self.assertEqual(conn.keys('rebuild_dirty:*'), [])
+
+    def test_load_objects_in_window(self):
+        user = self.create_user('user')
+        now = timezone.now()
+        for i in range(6):
+            tweet = self.create_tweet(user)
+            Tweet.objects.filter(id=tweet.id).update(created_at=now - timedelta(hours=i))
+        tweets = list(user.tweet_set.order_by('-created_at'))
+        queryset = user.tweet_set.order_by('-created_at')
+        RedisClient.clear()
+
+        class CountedSerializer(DjangoModelSerializer):
+            deserialized = 0
+
+            @classmethod
+            def deserialize(cls, serialized_data):
+                cls.deserialized += 1
+                return super().deserialize(serialized_data)
+
+        def load(**window):
+            objects, is_complete = RedisHelper.load_objects_in_window(
+                'key', queryset, CountedSerializer, **window,
+            )
+            return [obj.id for obj in objects], is_complete
+
+        for key_type in BACKENDS:
+            RedisClient.clear()
+            with self.settings(REDIS_TIMELINE_BACKENDS={'key': key_type}):
+                self.assert_windows(load, tweets)
+
+        # only the window and the entries for binary search are deserialized
+        CountedSerializer.deserialized = 0
+        load(created_at__lt=tweets[1].created_at, count=2)
+        self.assertEqual(CountedSerializer.deserialized <= 3 + 3, True)
+
+        # a page of a cached timeline is read in one round trip
+        for key_type in BACKENDS:
+            RedisClient.clear()
+            with self.settings(
+                REDIS_TIMELINE_BACKENDS={'key': key_type},
+                CACHE_METRICS_ENABLED=False,
+            ):
+                load(count=3)
+                for window in [
+                    {'count': 3},
+                    {'created_at__lt': tweets[1].created_at, 'count': 2},
+                    {'created_at__gt': tweets[2].created_at},
+                ]:
+                    with RedisCounter() as counter:
+                        load(**window)
+                    self.assertEqual(counter.round_trips, 1)
+
+    def assert_windows(self, load, tweets):
+        # cache miss
+        self.assertEqual(load(count=3), ([t.id for t in tweets[:3]], False))
+        # cache hit
+        self.assertEqual(load(count=3), ([t.id for t in tweets[:3]], False))
+        self.assertEqual(
+            load(created_at__lt=tweets[1].created_at, count=2),
+            ([t.id for t in tweets[2:4]], False),
+        )
+        self.assertEqual(
+            load(created_at__lt=tweets[3].created_at, count=3),
+            ([t.id for t in tweets[4:]], True),
+        )
+        # all the newer data is cached
+        self.assertEqual(
+            load(created_at__gt=tweets[2].created_at),
+            ([t.id for t in tweets[:2]], True),
+        )
+        self.assertEqual(load(), ([t.id for t in tweets], True))
+        # a list reaching the limit may have more data in DB
+        with self.settings(REDIS_LIST_LENGTH_LIMIT=6):
+            self.assertEqual(load(), ([t.id for t in tweets], False))
+            self.assertEqual(
+                load(created_at__gt=tweets[2].created_at),
+                ([t.id for t in tweets[:2]], True),
+            )
+            self.assertEqual(
+                load(created_at__gt=tweets[5].created_at - timedelta(hours=1)),
+                ([t.id for t in tweets], False),
+            )
+
+    @override_settings(REDIS_TIMELINE_BACKENDS={'key': 'zset'})
+    def test_sorted_set_backend(self):
+        conn = RedisClient.get_connection()
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        queryset = user.tweet_set.order_by('-created_at')
+        RedisClient.clear()
+
+        # a list written by the list backend is converted, TTL is kept
+        with self.settings(REDIS_TIMELINE_BACKENDS={}):
+            RedisHelper.load_objects('key', queryset)
+        self.assertEqual(conn.type('key'), b'list')
+        self.assertEqual(RedisHelper.convert_backend('key'), True)
+        self.assertEqual(RedisHelper.convert_backend('key'), False)
+        self.assertEqual(conn.type('key'), b'zset')
+        self.assertEqual(conn.ttl('key') > 0, True)
+        cached_tweets = RedisHelper.load_objects('key', queryset)
+        self.assertEqual([t.id for t in cached_tweets], [t.id for t in tweets[::-1]])
+
+        # pushing an object twice is idempotent
+        self.assertEqual(RedisHelper.push_objects([('key', tweets[1])] * 2), 2)
+        self.assertEqual(conn.zcard('key'), 3)
+        # an object is removed by its entry
+        self.assertEqual(RedisHelper.remove_entries([('key', tweets[1])]), 1)
+        cached_tweets = RedisHelper.load_objects('key', queryset)
+        self.assertEqual([t.id for t in cached_tweets], [tweets[2].id, tweets[0].id])
+
+        # a key written by another backend is loaded again when reading
+        conn.delete('key')
+        conn.rpush('key', 'old')
+        cached_tweets, _ = RedisHelper.load_objects_in_window('key', queryset, count=2)
+        self.assertEqual([t.id for t in cached_tweets], [tweets[2].id, tweets[1].id])
+        self.assertEqual(conn.type('key'), b'zset')
+        # and is deleted by pushing
+        conn.delete('key')
+        conn.rpush('key', 'old')
+        self.assertEqual(RedisHelper.push_objects([('key', tweets[0])]), 0)
+        self.assertEqual(conn.exists('key'), False)
+
+    def test_cache_metrics(self):
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(2)]
+        queryset = user.tweet_set.order_by('-created_at')
+        self.clear_cache()
+        self.assertEqual(CacheMetrics.get_pattern('user_tweets:1'), USER_TWEETS_PATTERN)
+        self.assertEqual(CacheMetrics.get_pattern('unknown'), 'other')
+
+        key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        RedisHelper.load_objects(key, queryset, TweetEntrySerializer)
+        RedisHelper.load_objects_in_window(key, queryset, TweetEntrySerializer, count=1)
+        MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id for tweet in tweets])
+        MemcachedHelper.get_object_through_cache(Tweet, tweets[0].id)
+
+        metrics = CacheMetrics.get_metrics()
+        timeline_metrics = metrics[USER_TWEETS_PATTERN]
+        self.assertEqual(timeline_metrics['hits'], 1)
+        self.assertEqual(timeline_metrics['misses'], 1)
+        self.assertEqual(timeline_metrics['hit_ratio'], 0.5)
+        self.assertEqual(timeline_metrics['rebuilds'], 1)
+        self.assertEqual(timeline_metrics['avg_bytes'] > 0, True)
+        self.assertEqual(timeline_metrics['avg_rebuild_ms'] > 0, True)
+        object_metrics = metrics['Tweet:{object_id}']
+        self.assertEqual((object_metrics['hits'], object_metrics['misses']), (1, 2))
+        self.assertEqual(object_metrics['rebuilds'], 2)
+
+        # only admins can read the metrics
+        url = '/api/cache-metrics/'
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assertEqual(client.get(url).status_code, 403)
+        user.is_staff = True
+        user.save()
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['patterns'][USER_TWEETS_PATTERN]['hits'], 1)
+
+        CacheMetrics.reset()
+        self.assertEqual(CacheMetrics.get_metrics(), {})
+
+    def test_get_objects_through_cache(self):
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        tweet_ids = [tweet.id for tweet in tweets]
+        MemcachedHelper.invalidate_cached_object(Tweet, tweets[0].id)
+
+        # misses are loaded in one query
+        with self.assertNumQueries(1):
+            cached_tweets = MemcachedHelper.get_objects_through_cache(
+                Tweet,
+                tweet_ids + [0],
+            )
+        self.assertEqual(sorted(cached_tweets.keys()), tweet_ids)
+        # then all are cache hits
+        with self.assertNumQueries(0):
+            cached_tweets = MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+        self.assertEqual(cached_tweets[tweets[1].id].content, tweets[1].content)
+
+    def test_prefetch_through_cache(self):
+        from likes.api.serializers import LikeSerializer
+        tweet = self.create_tweet(self.create_user('author'))
+        for index in range(3):
+            user = self.create_user('user{}'.format(index))
+            # create the profile, then drop it from cache
+            user.profile
+            UserService.invalidate_profile(user.id)
+            self.create_like(user, tweet)
+        likes = list(tweet.like_set.order_by('id'))
+
+        # users in one query and their profiles in one query
+        with self.assertNumQueries(2):
+            data = LikeSerializer(likes, many=True).data
+        self.assertEqual(data[0]['user']['username'], 'user0')
+        # then all are cache hits
+        likes = list(tweet.like_set.order_by('id'))
+        with self.assertNumQueries(0):
+            data = LikeSerializer(likes, many=True).data
+        self.assertEqual([item['user']['username'] for item in data], ['user0', 'user1', 'user2'])
+
+    def test_negative_cache(self):
+        user = self.create_user('user')
+        tweet = self.create_tweet(user)
+        missing_id = tweet.id + 100
+
+        # only the first lookup of a missing id queries DB
+        with self.assertNumQueries(1):
+            with self.assertRaises(Tweet.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(Tweet, missing_id)
+        with self.assertNumQueries(0):
+            with self.assertRaises(Tweet.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(Tweet, missing_id)
+        with self.assertNumQueries(1):
+            tweets = MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id, missing_id + 1])
+        self.assertEqual(list(tweets.keys()), [tweet.id])
+        with self.assertNumQueries(0):
+            tweets = MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id, missing_id + 1])
+        self.assertEqual(list(tweets.keys()), [tweet.id])
+        with self.assertNumQueries(0):
+            with self.assertRaises(Tweet.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(Tweet, missing_id + 1)
+
+        # no lookup for a user set to NULL
+        tweet.user = None
+        with self.assertNumQueries(0):
+            self.assertEqual(tweet.cached_user, None)
+
+        # profiles of users who do not exist
+        missing_user_id = user.id + 100
+        with self.assertNumQueries(2):
+            with self.assertRaises(UserProfile.DoesNotExist):
+                UserService.get_profile_through_cache(missing_user_id)
+        with self.assertNumQueries(0):
+            with self.assertRaises(UserProfile.DoesNotExist):
+                UserService.get_profile_through_cache(missing_user_id)
+        # dropped when the user is created
+        new_user = User.objects.create(id=missing_user_id, username='new_user')
+        self.assertEqual(new_user.profile.user_id, missing_user_id)
+
+    @override_settings(CACHE_COMPRESS_MIN_LENGTH=100)
+    def test_memcached_serializers(self):
+        user = self.create_user('user')
+        tweet = self.create_tweet(user, 'short')
+        data = ObjectSerializer.serialize(tweet, version=3)
+        cached_tweet = ObjectSerializer.deserialize(Tweet, data)
+        self.assertEqual(
+            (cached_tweet.id, cached_tweet.user_id, cached_tweet.content, cached_tweet.created_at),
+            (tweet.id, tweet.user_id, tweet.content, tweet.created_at),
+        )
+        self.assertEqual(get_cache_version(cached_tweet), 3)
+        # saved as usual
+        cached_tweet.content = 'changed'
+        cached_tweet.save()
+        self.assertEqual(Tweet.objects.get(id=tweet.id).content, 'changed')
+        # compressed above the threshold
+        long_tweet = self.create_tweet(user, 'long ' * 50)
+        data = ObjectSerializer.serialize(long_tweet)
+        self.assertEqual(len(data) < len(long_tweet.content), True)
+        self.assertEqual(ObjectSerializer.deserialize(Tweet, data).content, long_tweet.content)
+        # files are stored as names
+        profile = user.profile
+        profile.avatar = 'avatar.png'
+        cached_profile = ObjectSerializer.deserialize(UserProfile, ObjectSerializer.serialize(profile))
+        self.assertEqual(cached_profile.avatar.name, 'avatar.png')
+
+        # payloads of another schema or pickled objects are misses, and deleted
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        memcached.set(key, ObjectSerializer.serialize(user))
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        memcached.set(key, tweet)
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        with self.assertNumQueries(0):
+            MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+
+        ids = set(range(1000, 1100))
+        self.assertEqual(IdSetSerializer.deserialize(IdSetSerializer.serialize(ids)), ids)
+        self.assertEqual(IdSetSerializer.deserialize(IdSetSerializer.serialize(set())), set())
+        self.assertEqual(IdSetSerializer.deserialize(None), None)
+
+    def test_identity_map(self):
+        user = self.create_user('user')
+        user_key = MemcachedHelper.get_key(User, user.id)
+        profile_key = USER_PROFILE_PATTERN.format(user_id=user.id)
+        with IdentityMap.scope():
+            cached_user = MemcachedHelper.get_object_through_cache(User, user.id)
+            profile = UserService.get_profile_through_cache(user.id)
+            # read again in the request without cache or DB
+            memcached.delete_many([user_key, profile_key])
+            with self.assertNumQueries(0):
+                self.assertIs(MemcachedHelper.get_object_through_cache(User, user.id), cached_user)
+                users = MemcachedHelper.get_objects_through_cache(User, [user.id])
+                self.assertIs(users[user.id], cached_user)
+                self.assertIs(UserService.get_profile_through_cache(user.id), profile)
+                users = [User(id=user.id)]
+                UserService.prefetch_profiles(users)
+                self.assertIs(users[0].profile, profile)
+            # read again after a change
+            user.username = 'new_name'
+            user.save()
+            cached_user = MemcachedHelper.get_object_through_cache(User, user.id)
+            self.assertEqual(cached_user.username, 'new_name')
+
+        # cleared after the request
+        memcached.delete(user_key)
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(User, user.id)
+
+        def get_response(request):
+            IdentityMap.set('User', user_key, user)
+            return IdentityMap.get('User', user_key)
+
+        self.assertIs(IdentityMapMiddleware(get_response)(None), user)
+        self.assertEqual(IdentityMap.get('User', user_key), None)
+
+    def run_on_commit_callbacks(self):
+        # TestCase never commits, run the callbacks as if it did
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
+    @override_settings(CACHE_WRITE_THROUGH_MODELS=('Tweet', 'UserProfile'))
+    def test_write_through(self):
+        user = self.create_user('user')
+        tweet = self.create_tweet(user, 'old content')
+        self.run_on_commit_callbacks()
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        old_data = memcached.get(key)
+        self.assertEqual(ObjectSerializer.deserialize(Tweet, old_data).content, 'old content')
+
+        # written when committed
+        tweet.content = 'new content'
+        tweet.save()
+        self.assertEqual(memcached.get(key), old_data)
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            cached_tweet = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertEqual(cached_tweet.content, 'new content')
+
+        # an older version never overwrites a newer one
+        self.assertEqual(MemcachedHelper.compare_and_set(key, old_data), False)
+        MemcachedHelper.set_loaded_objects(Tweet, {key: Tweet.objects.get(id=tweet.id)})
+        cached_tweet = ObjectSerializer.deserialize(Tweet, memcached.get(key))
+        self.assertEqual(cached_tweet.content, 'new content')
+        self.assertEqual(get_cache_version(cached_tweet), 2)
+
+        # profiles
+        profile = user.profile
+        profile.nickname = 'nickname'
+        profile.save()
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            profile = UserService.get_profile_through_cache(user.id)
+        self.assertEqual(profile.nickname, 'nickname')
+
+        # deleted objects are dropped
+        tweet.delete()
+        self.assertEqual(memcached.get(key), None)
+
+    @override_settings(CACHE_WRITE_THROUGH_MODELS=('Tweet',), CACHE_CAS_RETRIES=3)
+    def test_write_through_cas_conflict(self):
+        user = self.create_user('user')
+        tweet = self.create_tweet(user, 'old content')
+        self.run_on_commit_callbacks()
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        raw_key = memcached.make_key(key)
+        old_data = memcached.get(key)
+
+        # the python-memcached client, another writer changes the key between gets and cas
+        client = mock.Mock()
+        client.gets.return_value = old_data
+        client.cas.side_effect = [False, True]
+        with mock.patch('utils.cache.memcached_helper.get_cas_client', return_value=client):
+            tweet.content = 'new content'
+            tweet.save()
+            self.run_on_commit_callbacks()
+        self.assertEqual(client.gets.call_count, 2)
+        self.assertEqual(client.cas.call_count, 2)
+        self.assertEqual(client.cas.call_args[0][0], raw_key)
+        new_data = client.cas.call_args[0][1]
+        self.assertEqual(ObjectSerializer.get_version(new_data), 2)
+        self.assertEqual(ObjectSerializer.deserialize(Tweet, new_data).content, 'new content')
+        client.add.assert_not_called()
+        client.reset_cas.assert_called_once()
+
+        # the retry sees that the conflicting writer cached a newer version
+        newer_data = ObjectSerializer.serialize(tweet, 3)
+        client = mock.Mock()
+        client.gets.side_effect = [old_data, newer_data]
+        client.cas.return_value = False
+        with mock.patch('utils.cache.memcached_helper.get_cas_client', return_value=client):
+            self.assertEqual(MemcachedHelper.compare_and_set(key, new_data), False)
+        self.assertEqual(client.cas.call_count, 1)
+        client.reset_cas.assert_called_once()
+
+        # a missing key is added, so a concurrent add wins and is read on retry
+        client = mock.Mock()
+        client.gets.side_effect = [None, newer_data]
+        client.add.return_value = False
+        with mock.patch('utils.cache.memcached_helper.get_cas_client', return_value=client):
+            self.assertEqual(MemcachedHelper.compare_and_set(key, new_data), False)
+        client.add.assert_called_once()
+        client.cas.assert_not_called()
+
+        # gives up when the key keeps changing
+        client = mock.Mock()
+        client.gets.return_value = old_data
+        client.cas.return_value = False
+        with mock.patch('utils.cache.memcached_helper.get_cas_client', return_value=client):
+            self.assertEqual(MemcachedHelper.compare_and_set(key, new_data), False)
+        self.assertEqual(client.cas.call_count, 3)
+        client.reset_cas.assert_called_once()
+
+    @override_settings(CACHE_WRITE_THROUGH_MODELS=('Tweet',))
+    def test_write_through_memcached(self):
+        user = self.create_user('user')
+        tweet = self.create_tweet(user, 'old content')
+        self.run_on_commit_callbacks()
+        params = {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': '127.0.0.1:11211;127.0.0.1:11212',
+            'KEY_PREFIX': 'testing',
+        }
+        # python-memcached with the values kept in process
+        fake_memcache = SimpleNamespace(Client=InMemoryMemcacheClient)
+        with mock.patch.dict('sys.modules', {'memcache': fake_memcache}):
+            backend = MemcachedCache(params['LOCATION'], params)
+        InMemoryMemcacheClient.values.clear()
+        cas_clients.client = None
+        try:
+            with mock.patch('utils.cache.memcached_helper.memcache', fake_memcache), \
+                    mock.patch('utils.cache.memcached_helper.cache', backend), \
+                    self.settings(CACHES={CACHE_ALIAS: params}):
+                # the CAS client is set up from the settings
+                client = get_cas_client()
+                self.assertEqual(len(client.servers), 2)
+                self.assertEqual(client.cache_cas, True)
+
+                # added, then changed by CAS, and read by the backend
+                for version, content in enumerate(['new content', 'newer content'], 2):
+                    tweet.content = content
+                    tweet.save()
+                    self.run_on_commit_callbacks()
+                    with self.assertNumQueries(0):
+                        cached_tweet = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+                    self.assertEqual(cached_tweet.content, content)
+                    self.assertEqual(get_cache_version(cached_tweet), version)
+
+                # a write conflicting with another writer is retried
+                key = MemcachedHelper.get_key(Tweet, tweet.id)
+                data = ObjectSerializer.serialize(tweet, 4)
+                conflicting_data = ObjectSerializer.serialize(tweet, 3)
+                gets = client.gets
+
+                def gets_then_write(raw_key):
+                    value = gets(raw_key)
+                    client.gets = gets
+                    client.set(raw_key, conflicting_data)
+                    return value
+
+                client.gets = gets_then_write
+                self.assertEqual(MemcachedHelper.compare_and_set(key, data), True)
+                self.assertEqual(ObjectSerializer.get_version(backend.get(key)), 4)
+
+                # other Memcached libraries can not share the cache
+                with mock.patch(
+                    'utils.cache.memcached_helper.cache',
+                    BaseMemcachedCache(params['LOCATION'], params, memcache, ValueError),
+                ):
+                    with self.assertRaises(ImproperlyConfigured):
+                        check_write_through_backend()
+        finally:
+            cas_clients.client = None
+
+    @override_settings(LOCAL_CACHE_MODELS={'User': {'max_size': 2, 'ttl': 60}})
+    def test_local_cache(self):
+        LocalCache.clear()
+        users = [self.create_user('user{}'.format(index)) for index in range(3)]
+        key = MemcachedHelper.get_key(User, users[0].id)
+        user = MemcachedHelper.get_object_through_cache(User, users[0].id)
+        # read from the process even if Memcached is cleared
+        memcached.delete(key)
+        with self.assertNumQueries(0):
+            user = MemcachedHelper.get_object_through_cache(User, users[0].id)
+        self.assertEqual(user.username, 'user0')
+        # readers get copies
+        user.username = 'changed'
+        user = MemcachedHelper.get_object_through_cache(User, users[0].id)
+        self.assertEqual(user.username, 'user0')
+
+        # dropped on change
+        users[0].username = 'user0_new'
+        users[0].save()
+        user = MemcachedHelper.get_object_through_cache(User, users[0].id)
+        self.assertEqual(user.username, 'user0_new')
+        # an object read before an invalidation is not cached
+        generation = LocalCache.get_generation()
+        LocalCache.invalidate('User', key)
+        LocalCache.set('User', key, users[1], generation)
+        self.assertEqual(LocalCache.get('User', key), None)
+        # the listener thread dropping the key while it is being set waits for it
+        message = {'type': 'message', 'data': 'User|{}'.format(key).encode()}
+        lru_cache = LocalCache.get_cache('User')
+        lru_set = lru_cache.set
+        listener = threading.Thread(target=LocalCache.handle_message, args=(message,))
+
+        def set_while_dropping(key, obj):
+            listener.start()
+            listener.join(0.1)
+            lru_set(key, obj)
+
+        generation = LocalCache.get_generation()
+        with mock.patch.object(lru_cache, 'set', set_while_dropping):
+            LocalCache.set('User', key, users[1], generation)
+        listener.join()
+        self.assertEqual(LocalCache.get('User', key), None)
+        self.assertEqual(LocalCache.get_generation(), generation + 1)
+
+        # the least recently used one is evicted
+        MemcachedHelper.get_objects_through_cache(User, [user.id for user in users])
+        stats = LocalCache.get_stats()['User']
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        # models not configured are not cached in the process
+        self.assertEqual(LocalCache.get_cache('Tweet'), None)
+
+        # invalidation published by other processes
+        LocalCache.get_cache('User')
+        conn = RedisClient.get_connection()
+        for _ in range(100):
+            if conn.pubsub_numsub(LOCAL_CACHE_CHANNEL)[0][1]:
+                break
+            time.sleep(0.01)
+        key = MemcachedHelper.get_key(User, users[2].id)
+        self.assertNotEqual(LocalCache.get('User', key), None)
+        conn.publish(LOCAL_CACHE_CHANNEL, 'User|{}'.format(key))
+        for _ in range(100):
+            if LocalCache.get('User', key) is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(LocalCache.get('User', key), None)
+        LocalCache.clear()
+
+    def test_counters(self):
+        user = self.create_user('user')
+        tweet = self.create_tweet(user)
+        comment = self.create_comment(user, tweet)
+        like = self.create_like(user, tweet)
+        self.create_like(user, comment)
+        tweet.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (1, 1))
+        self.assertEqual(comment.likes_count, 1)
+
+        # loaded into Redis once, then changed in place
+        with self.assertNumQueries(1):
+            self.assertEqual(CounterService.get_counts(Tweet, [tweet.id], 'likes_count'), {tweet.id: 1})
+        with self.assertNumQueries(0):
+            self.assertEqual(CounterService.get_count(tweet, 'likes_count'), 1)
+        like.delete()
+        self.create_comment(user, tweet)
+        with self.assertNumQueries(0):
+            self.assertEqual(CounterService.get_count(tweet, 'likes_count'), 0)
+        self.assertEqual(CounterService.get_count(tweet, 'comments_count'), 2)
+
+        # a page is rendered without counting the likes and comments
+        request = APIClient().get('/').wsgi_request
+        request.user = user
+        with CaptureQueriesContext(connection) as queries:
+            TweetSerializer(
+                Tweet.objects.filter(id=tweet.id),
+                context={'request': request},
+                many=True,
+            ).data
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+
+        # drift is fixed by reconciliation
+        Tweet.objects.filter(id=tweet.id).update(likes_count=5, comments_count=None)
+        out = StringIO()
+        call_command('reconcile_counts', '--dry-run', stdout=out)
+        self.assertIn('Tweet.likes_count: 1 checked, 1 drifted (dry run)', out.getvalue())
+        self.assertEqual(Tweet.objects.get(id=tweet.id).likes_count, 5)
+        out = StringIO()
+        call_command('reconcile_counts', '--batch-size', '1', stdout=out)
+        self.assertIn('Tweet.comments_count: 1 checked, 1 drifted', out.getvalue())
+        self.assertIn('Comment.likes_count: 2 checked, 0 drifted', out.getvalue())
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (0, 2))
+        self.assertEqual(CounterService.get_count(tweet, 'likes_count'), 0)
+
+    def test_benchmark_helpers(self):
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 99), 4)
+        self.assertEqual(percentile([], 50), None)
+
+        conn = RedisClient.get_connection()
+        with RedisCounter() as counter:
+            conn.get('redis_key')
+            pipeline = conn.pipeline(transaction=False)
+            pipeline.get('redis_key')
+            pipeline.get('redis_key')
+            pipeline.execute()
+        self.assertEqual(counter.commands, 3)
+        self.assertEqual(counter.round_trips, 2)
+
+        result = summarize([measure(conn.get, 'redis_key') for _ in range(2)])
+        self.assertEqual(result['count'], 2)
+        self.assertEqual(result['db_queries'], 0)
+        self.assertEqual(result['redis_commands_per_call'], 1)
+
+
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        RedisClient.clear()
+        executed_jobs.clear()
+
+    def test_eager_mode(self):
+        JobQueue.enqueue(record_job, value=1)
+        self.assertEqual(executed_jobs, [1])
+
+    @override_settings(JOB_QUEUE_ALWAYS_EAGER=False)
+    def test_run_jobs_in_order(self):
+        JobQueue.enqueue(record_job, value=1)
+        JobQueue.enqueue(record_job, value=2)
+        self.assertEqual(executed_jobs, [])
+
+        self.assertEqual(JobQueue.run_next_job(timeout=1), True)
+        self.assertEqual(JobQueue.run_next_job(timeout=1), True)
+        self.assertEqual(JobQueue.run_next_job(timeout=1), False)
+        self.assertEqual(executed_jobs, [1, 2])
+
+    @override_settings(JOB_QUEUE_ALWAYS_EAGER=False, JOB_QUEUE_MAX_RETRIES=2)
+    def test_retry_and_dead_letter(self):
+        JobQueue.enqueue(failed_job)
+        # the first run and the first retry
+        for _ in range(2):
+            self.assertEqual(JobQueue.run_next_job(timeout=1), True)
+            self.assertEqual(JobQueue.get_dead_jobs(), [])
+        # the last retry
+        self.assertEqual(JobQueue.run_next_job(timeout=1), True)
+        self.assertEqual(JobQueue.run_next_job(timeout=1), False)
+
+        dead_jobs = JobQueue.get_dead_jobs()
+        self.assertEqual(len(dead_jobs), 1)
+        self.assertEqual(dead_jobs[0]['task'], JobQueue.get_task_name(failed_job))
+        self.assertEqual(dead_jobs[0]['attempts'], 3)
+
+    @override_settings(JOB_QUEUE_ALWAYS_EAGER=False)
+    def test_requeue_unfinished_jobs(self):
+        conn = RedisClient.get_connection()
+        JobQueue.enqueue(record_job, value=1)
+        # simulate a worker crashed after taking the job
+        conn.rpoplpush('job_queue:default', 'job_queue:default:processing')
+        self.assertEqual(JobQueue.run_next_job(timeout=1), False)
+
+        self.assertEqual(JobQueue.requeue_unfinished_jobs(), 1)
+        self.assertEqual(JobQueue.run_next_job(timeout=1), True)
+        self.assertEqual(executed_jobs, [1])
+
+    @override_settings(JOB_QUEUE_ALWAYS_EAGER=False, REDIS_SOCKET_TIMEOUT=0.5)
+    def test_block_longer_than_socket_timeout(self):
+        RedisClient.clients = None
+        try:
+            # the worker waits for a job longer than the socket timeout
+            self.assertEqual(JobQueue.run_next_job(timeout=1), False)
+            JobQueue.enqueue(record_job, value=1)
+            self.assertEqual(JobQueue.run_next_job(timeout=1), True)
+            self.assertEqual(executed_jobs, [1])
+        finally:
+            RedisClient.clients = None